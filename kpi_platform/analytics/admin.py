@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Entity, Category, PnLData, TrialBalance
+from .models import Entity, Category, PnLData, TrialBalance, UploadJob
 
 
 @admin.register(Entity)
@@ -33,4 +33,12 @@ class TrialBalanceAdmin(admin.ModelAdmin):
     search_fields = ('account_name', 'account_code', 'entity__name')
     date_hierarchy = 'period'
     # Субконто в формате JSON лучше просто отображать, но если нужно редактировать,
-    # Django автоматически подставит удобное поле для JSON
\ No newline at end of file
+    # Django автоматически подставит удобное поле для JSON
+
+@admin.register(UploadJob)
+class UploadJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'file_name', 'kind', 'entity', 'period', 'status', 'rows', 'created_by', 'created_at')
+    list_filter = ('status', 'kind', 'entity')
+    list_select_related = ('entity', 'created_by')
+    search_fields = ('file_name', 'entity__name')
+    readonly_fields = ('file_hash', 'spool_path', 'timings', 'started_at', 'finished_at')
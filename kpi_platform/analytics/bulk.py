@@ -0,0 +1,338 @@
+"""
+Пакетная загрузка: ZIP-архив с файлами ОПУ и ОСВ за месяц по многим филиалам.
+
+Филиал, тип и период файла берутся из manifest.csv в архиве (колонки file, entity, kind,
+year, month; kind — pnl/osv или ОПУ/ОСВ, можно пустым), а для файлов без строки манифеста — из имени файла
+и шапки листа: название филиала как в справочнике, "ОПУ"/"ОСВ" и период вида 05.2025,
+2025-05 или "май 2025". Если периода нет ни в имени, ни в шапке — берется месяц из формы.
+
+Файлы разбираются параллельно в пуле процессов (BULK_IMPORT_WORKERS; 0 — в текущем процессе,
+analytics.bulk_worker), запись идет в родителе по мере готовности. ОПУ и ОСВ одного филиала
+за месяц пишутся одной транзакцией под IngestionLock (analytics.ingestion): ошибка в любом
+из файлов не оставляет период загруженным наполовину, остальные периоды архива загружаются.
+Каждый записанный файл — UploadJob, поэтому он виден в "Мои загрузки" и в админке.
+"""
+import csv
+import hashlib
+import io
+import multiprocessing
+import re
+import shutil
+import time
+import uuid
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .bulk_worker import parse_file, setup_worker
+from .ingestion import acquire_locks, release_locks, spool_dir
+from .models import Entity, PnLData, TrialBalance, UploadJob
+from .services import pnl_category_attributes, resolve_categories, save_osv_rows, save_pnl_rows
+
+
+MANIFEST_NAME = 'manifest.csv'
+SUPPORTED_SUFFIXES = ('.xlsx', '.xlsm', '.xls', '.csv')
+KIND_MARKERS = {'pnl': ('pnl', 'опу'), 'osv': ('osv', 'осв')}
+KIND_LABELS = {'pnl': 'ОПУ', 'osv': 'ОСВ'}
+
+# 05.2025, 5-2025, 2025_05 — месяц и год в любом порядке. Пробел разделителем не считается:
+# в шапке он разделяет разряды сумм
+NUMERIC_PERIOD_RE = re.compile(
+    r'(?<!\d)(?:(?P<month>0?[1-9]|1[0-2])[._\-](?P<year>20\d{2})'
+    r'|(?P<year_first>20\d{2})[._\-](?P<month_last>0?[1-9]|1[0-2]))(?!\d)'
+)
+# "май 2025", "за мая 2025 г.", "янв. 2025"
+MONTH_WORD_RES = [
+    (re.compile(rf'(?<![а-я]){stem}[а-я]*\.?\s*(20\d{{2}})(?!\d)'), number)
+    for stem, number in (
+        ('янв', 1), ('фев', 2), ('мар', 3), ('апр', 4), ('ма[йя]', 5), ('июн', 6),
+        ('июл', 7), ('авг', 8), ('сен', 9), ('окт', 10), ('ноя', 11), ('дек', 12),
+    )
+]
+
+_executor = None
+
+
+def normalize_text(text):
+    return re.sub(r'\s+', ' ', str(text).lower().replace('ё', 'е')).strip()
+
+
+def find_kind(text):
+    """Тип файла по маркерам в имени ("ОПУ", "osv", ...) или None."""
+    words = set(re.split(r'[^a-zа-я]+', normalize_text(text)))
+    found = [kind for kind, markers in KIND_MARKERS.items() if words & set(markers)]
+    return found[0] if len(found) == 1 else None
+
+
+def find_period(text):
+    """Первый по тексту месяц с годом -> date или None."""
+    text = normalize_text(text)
+    found = []
+    match = NUMERIC_PERIOD_RE.search(text)
+    if match:
+        month = match.group('month') or match.group('month_last')
+        found.append((match.start(), int(match.group('year') or match.group('year_first')), int(month)))
+    for regex, month in MONTH_WORD_RES:
+        match = regex.search(text)
+        if match:
+            found.append((match.start(), int(match.group(1)), month))
+    if not found:
+        return None
+    _, year, month = min(found)
+    return date(year, month, 1)
+
+
+def find_entity(text, entities):
+    """Филиал, название которого целым словом встречается в тексте; при нескольких — самое длинное."""
+    # В именах файлов слова часто разделены подчеркиванием
+    text = normalize_text(text).replace('_', ' ')
+    found = [
+        entity for entity in entities
+        if re.search(rf'(?<!\w){re.escape(normalize_text(entity.name))}(?!\w)', text)
+    ]
+    return max(found, key=lambda entity: len(entity.name), default=None)
+
+
+def _new_item(name):
+    return {
+        'name': name, 'path': None, 'file_hash': '', 'entity': None, 'kind': None, 'period': None,
+        'rows': 0, 'seconds': 0.0, 'status': 'failed', 'message': '', 'error': '', 'job': None, 'data': None,
+    }
+
+
+def read_manifest(content, entities):
+    """manifest.csv -> {имя файла: {'entity', 'kind', 'period', 'error'}}. Разделитель — запятая или точка с запятой."""
+    text = content.decode('utf-8-sig')
+    header = text.split('\n', 1)[0]
+    delimiter = ';' if header.count(';') > header.count(',') else ','
+    by_name = {normalize_text(entity.name): entity for entity in entities}
+    by_pk = {str(entity.pk): entity for entity in entities}
+    manifest = {}
+    for row in csv.DictReader(io.StringIO(text), delimiter=delimiter):
+        row = {str(key).strip().lower(): (value or '').strip() for key, value in row.items()}
+        if not row.get('file'):
+            continue
+        entry = {'entity': None, 'kind': None, 'period': None, 'error': ''}
+        entry['entity'] = by_pk.get(row.get('entity', '')) or by_name.get(normalize_text(row.get('entity', '')))
+        entry['kind'] = find_kind(row.get('kind', ''))
+        try:
+            entry['period'] = date(int(row['year']), int(row['month']), 1)
+        except (KeyError, ValueError):
+            pass
+        # Тип можно не указывать — он определится по шапке листа
+        missing = [label for label, key in (("филиал", 'entity'), ("год и месяц", 'period')) if not entry[key]]
+        if missing:
+            entry['error'] = f"В манифесте не распознаны: {', '.join(missing)}"
+        manifest[normalize_text(Path(row['file']).name)] = entry
+    return manifest
+
+
+def extract_archive(archive, target, entities):
+    """
+    Файлы отчетов архива -> список элементов загрузки (файлы копируются в target под
+    служебными именами — имена из архива в путь не попадают). Служебные и временные файлы
+    пропускаются, манифест применяется к файлам по имени без папок.
+    """
+    items, manifest = [], {}
+    with zipfile.ZipFile(archive) as zf:
+        members = [
+            info for info in zf.infolist()
+            if not info.is_dir() and not info.filename.startswith('__MACOSX/')
+            and not Path(info.filename).name.startswith(('.', '~$'))
+        ]
+        for info in members:
+            if Path(info.filename).name.lower() == MANIFEST_NAME:
+                manifest = read_manifest(zf.read(info), entities)
+
+        for number, info in enumerate(members):
+            name = info.filename
+            suffix = Path(name).suffix.lower()
+            if Path(name).name.lower() == MANIFEST_NAME:
+                continue
+            item = _new_item(name)
+            items.append(item)
+            if suffix not in SUPPORTED_SUFFIXES:
+                item['error'] = "Неподдерживаемый тип файла"
+                continue
+
+            path = Path(target) / f"{number:04d}{suffix}"
+            digest = hashlib.sha1()
+            with zf.open(info) as source, open(path, 'wb') as f:
+                for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+            item['path'], item['file_hash'] = str(path), digest.hexdigest()
+
+            entry = manifest.get(normalize_text(Path(name).name))
+            if entry:
+                item.update(entity=entry['entity'], kind=entry['kind'], period=entry['period'], error=entry['error'])
+            else:
+                item.update(entity=find_entity(name, entities), kind=find_kind(name), period=find_period(name))
+    return items
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn: воркеру не нужен форк процесса с открытыми соединениями к БД
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.BULK_IMPORT_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=setup_worker,
+        )
+    return _executor
+
+
+def parse_items(items):
+    """(элемент, результат разбора) по мере готовности файлов."""
+    if not settings.BULK_IMPORT_WORKERS:
+        for item in items:
+            yield item, parse_file(item['path'], item['kind'])
+        return
+
+    global _executor
+    executor = _get_executor()
+    futures = {executor.submit(parse_file, item['path'], item['kind']): item for item in items}
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except Exception as error:
+            # Упавший процесс ломает весь пул: гасим его процессы, следующий импорт создаст новый
+            executor.shutdown(wait=False, cancel_futures=True)
+            if _executor is executor:
+                _executor = None
+            result = {'kind': futures[future]['kind'], 'text': '', 'rows': None, 'seconds': 0.0,
+                      'error': f"Сбой процесса разбора: {error.__class__.__name__}"}
+        yield futures[future], result
+
+
+def group_key(item):
+    if item['entity'] is None or item['period'] is None:
+        return None
+    return item['entity'].pk, item['period']
+
+
+def _load_item(item, overwrite):
+    entity, period, rows = item['entity'], item['period'], item['data']
+    if item['kind'] == 'pnl':
+        if overwrite:
+            PnLData.objects.filter(entity=entity, period=period).delete()
+        categories = resolve_categories(pnl_category_attributes(rows))
+        save_pnl_rows(rows, entity, [period] * len(rows), categories)
+        return f"ОПУ загружен за {period:%m.%Y}"
+    if overwrite:
+        TrialBalance.objects.filter(entity=entity, period=period).delete()
+    save_osv_rows(rows, entity, period)
+    return f"ОСВ загружена: {len(rows)} счетов"
+
+
+def load_group(items, overwrite=False, user=None):
+    """
+    Запись файлов одного филиала за месяц одной транзакцией. Если хоть один файл группы
+    не разобран или тип повторяется — не пишется ни один.
+    """
+    kinds = Counter(item['kind'] for item in items)
+    if any(item['error'] for item in items) or max(kinds.values()) > 1:
+        reason = ("В архиве несколько файлов одного типа за этот период" if max(kinds.values()) > 1
+                  else "Не загружен: ошибка в другом файле этого филиала за период")
+        for item in items:
+            item['error'], item['data'] = item['error'] or reason, None
+        return
+
+    now = timezone.now()
+    jobs = [
+        UploadJob.objects.create(
+            entity=item['entity'], kind=item['kind'], period=item['period'], overwrite=overwrite,
+            file_name=Path(item['name']).name[:255], file_hash=item['file_hash'], status='running',
+            created_by=user, started_at=now, timings={'parse': round(item['seconds'], 3)},
+        )
+        for item in items
+    ]
+    try:
+        start = time.perf_counter()
+        try:
+            for job in jobs:
+                # Ждать в запросе некогда: занятый период сразу уходит в ошибку
+                acquire_locks(job, wait=0)
+            lock_seconds = time.perf_counter() - start
+            with transaction.atomic():
+                for item, job in zip(items, jobs):
+                    start = time.perf_counter()
+                    item['message'] = _load_item(item, overwrite)
+                    item['rows'] = len(item['data'])
+                    job.timings.update(lock=round(lock_seconds, 3), load=round(time.perf_counter() - start, 3))
+        finally:
+            for job in jobs:
+                release_locks(job)
+        for item in items:
+            item['status'] = 'done'
+    except Exception as error:
+        for item in items:
+            item['error'], item['rows'] = str(error) or error.__class__.__name__, 0
+
+    for item, job in zip(items, jobs):
+        job.status, job.rows, job.message, job.error = item['status'], item['rows'], item['message'], item['error']
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'rows', 'message', 'error', 'timings', 'finished_at'])
+        item['job'], item['data'] = job, None
+
+
+def import_archive(archive, default_period=None, overwrite=False, user=None):
+    """
+    Загружает архив и возвращает сводку: {'items' (по файлу: имя, филиал, тип, период, статус,
+    строк, секунд разбора, ошибка), 'loaded', 'failed', 'periods', 'rows', 'seconds', 'parse_seconds'}.
+    Периоды записываются, как только разобраны все их файлы, поэтому общее время близко
+    ко времени самого долгого файла.
+    """
+    start = time.perf_counter()
+    entities = list(Entity.objects.all())
+    workdir = spool_dir() / f"bulk-{uuid.uuid4().hex}"
+    workdir.mkdir()
+    try:
+        items = extract_archive(archive, workdir, entities)
+        ready = [item for item in items if not item['error']]
+        waiting = Counter(group_key(item) for item in ready if group_key(item))
+        # Файл без филиала или периода в имени может оказаться в любой группе — до его разбора группы ждут
+        unknown = sum(1 for item in ready if not group_key(item))
+        groups = {}
+
+        for item, result in parse_items(ready):
+            key = group_key(item)
+            item.update(kind=result['kind'], data=result['rows'], seconds=result['seconds'], error=result['error'])
+            if key:
+                waiting[key] -= 1
+            else:
+                unknown -= 1
+                item['entity'] = item['entity'] or find_entity(result['text'], entities)
+                item['period'] = item['period'] or find_period(result['text']) or default_period
+                key = group_key(item)
+            if key:
+                groups.setdefault(key, []).append(item)
+            elif not item['error']:
+                item['error'] = "Не удалось определить филиал" if item['entity'] is None else "Не удалось определить период"
+
+            if not unknown:
+                for key in [key for key in groups if not waiting[key]]:
+                    load_group(groups.pop(key), overwrite, user)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for item in items:
+        item['data'] = None
+        item['kind_display'] = KIND_LABELS.get(item['kind'], '')
+    done = [item for item in items if item['status'] == 'done']
+    return {
+        'items': items,
+        'loaded': len(done),
+        'failed': len(items) - len(done),
+        'periods': len({group_key(item) for item in done}),
+        'rows': sum(item['rows'] for item in done),
+        'seconds': time.perf_counter() - start,
+        'parse_seconds': sum(item['seconds'] for item in items),
+    }
@@ -0,0 +1,63 @@
+"""
+Разбор файла пакетной загрузки (analytics.bulk) в отдельном процессе пула.
+
+Разбор pandas упирается в GIL, поэтому файлы архива разбираются параллельно в процессах.
+Воркер запускается через spawn и настраивает Django один раз при старте (setup_worker):
+разборщики лежат в analytics.services рядом с моделями, но к БД воркер не обращается —
+родителю возвращаются только разобранные строки, запись идет в родительском процессе.
+"""
+import re
+import time
+
+import pandas as pd
+
+from .readers import iter_rows, read_head
+
+
+HEAD_ROWS = 30
+# Текста шапки родителю хватает для поиска филиала и периода
+HEAD_TEXT_LIMIT = 4000
+
+
+def setup_worker():
+    import django
+    django.setup()
+
+
+def head_text(path):
+    """Текст первых HEAD_ROWS строк листа в нижнем регистре, пробелы схлопнуты."""
+    with open(path, 'rb') as file:
+        head = read_head(iter_rows(file), HEAD_ROWS)
+    text = " ".join(str(value) for value in head.to_numpy().ravel() if not pd.isna(value))
+    return re.sub(r'\s+', ' ', text).lower()[:HEAD_TEXT_LIMIT]
+
+
+def detect_kind(text):
+    """Тип файла по шапке: 'osv', 'pnl' или None."""
+    if 'оборотно-сальдовая' in text:
+        return 'osv'
+    if 'факт' in text and 'план' in text:
+        return 'pnl'
+    return None
+
+
+def parse_file(path, kind=None):
+    """
+    Разбирает файл ОПУ или ОСВ за месяц; kind=None — тип определяется по шапке.
+    Возвращает {'kind', 'text', 'rows' (DataFrame или None), 'seconds', 'error'}.
+    """
+    from .services import parse_osv_file, parse_pnl_file
+
+    start = time.perf_counter()
+    result = {'kind': kind, 'text': '', 'rows': None, 'error': ''}
+    try:
+        result['text'] = head_text(path)
+        result['kind'] = kind = kind or detect_kind(result['text'])
+        if kind is None:
+            raise ValueError("Не удалось определить тип файла (ОПУ или ОСВ) по шапке")
+        with open(path, 'rb') as file:
+            result['rows'] = parse_pnl_file(file) if kind == 'pnl' else parse_osv_file(file)
+    except Exception as error:
+        result['error'] = str(error) or error.__class__.__name__
+    result['seconds'] = time.perf_counter() - start
+    return result
@@ -2,7 +2,8 @@ from django import forms
 from .models import Entity
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Submit, Row, Column
-from datetime import datetime
+from datetime import date, datetime
+import zipfile
 
 
 class UploadFinanceForm(forms.Form):
@@ -38,4 +39,40 @@ class UploadFinanceForm(forms.Form):
             ),
             'file_pnl',
             'file_osv',
-        )
\ No newline at end of file
+        )
+
+
+class BulkUploadForm(forms.Form):
+    archive = forms.FileField(label="ZIP-архив с файлами ОПУ и ОСВ")
+    month = forms.ChoiceField(choices=[('', '---')] + UploadFinanceForm.MONTHS, label="Месяц по умолчанию", required=False)
+    year = forms.ChoiceField(choices=[('', '---')] + UploadFinanceForm.YEARS, label="Год по умолчанию", required=False)
+    overwrite = forms.BooleanField(required=False, label="Перезаписать данные загружаемых периодов")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.helper = FormHelper()
+        self.helper.form_tag = False
+        self.helper.layout = Layout(
+            'archive',
+            Row(
+                Column('month', css_class='form-group col-md-6 mb-3'),
+                Column('year', css_class='form-group col-md-6 mb-3'),
+            ),
+            'overwrite',
+        )
+
+    def clean_archive(self):
+        archive = self.cleaned_data['archive']
+        if not zipfile.is_zipfile(archive):
+            raise forms.ValidationError("Нужен ZIP-архив.")
+        archive.seek(0)
+        return archive
+
+    def clean(self):
+        cleaned_data = super().clean()
+        month, year = cleaned_data.get('month'), cleaned_data.get('year')
+        if bool(month) != bool(year):
+            raise forms.ValidationError("Укажите и месяц, и год по умолчанию — или оставьте оба пустыми.")
+        # Месяц для файлов, в имени и шапке которых периода нет
+        cleaned_data['default_period'] = date(int(year), int(month), 1) if month else None
+        return cleaned_data
@@ -0,0 +1,264 @@
+"""
+Фоновая загрузка финансовых файлов (ОПУ, ОСВ).
+
+Запрос только копирует файл на диск (INGESTION_SPOOL_DIR) и создает UploadJob,
+разбор и запись идут в пуле потоков (INGESTION_WORKERS; 0 — сразу в запросе).
+Повторная отправка того же файла, пока прежняя задача в очереди или идет,
+возвращает существующую задачу вместо новой.
+
+Перед записью задача берет IngestionLock на каждый свой (филиал, месяц, набор данных):
+вторая загрузка того же периода ждет освобождения (до INGESTION_LOCK_WAIT секунд),
+загрузки разных периодов идут параллельно. Блокировка завершившейся задачи или
+удерживаемая дольше INGESTION_LOCK_TTL (воркер упал) считается брошенной и снимается.
+
+Загрузчик пишет в одной транзакции, поэтому прогресс (строк записано) хранится
+файлом-маркером рядом с копией файла — его видит любой веб-воркер.
+Задачи, оставшиеся в очереди после перезапуска, подбирает команда process_upload_jobs.
+На SQLite пул всегда из одного потока: параллельно SQLite все равно не пишет.
+"""
+import hashlib
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import IngestionLock, UploadJob
+from .services import process_multi_pnl_file, process_osv_file, process_pnl_file
+
+
+ACTIVE_STATUSES = ('queued', 'running')
+LOCK_POLL_SECONDS = 1
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+class LockTimeout(Exception):
+    pass
+
+
+def spool_dir():
+    path = Path(settings.INGESTION_SPOOL_DIR)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def spool_upload(upload):
+    """Копирует загруженный файл на диск по частям. Возвращает (путь, SHA-1 содержимого)."""
+    digest = hashlib.sha1()
+    path = spool_dir() / f"{uuid.uuid4().hex}{Path(upload.name).suffix.lower()}"
+    with open(path, 'wb') as f:
+        for chunk in upload.chunks():
+            digest.update(chunk)
+            f.write(chunk)
+    return path, digest.hexdigest()
+
+
+def create_job(upload, entity, kind, period, overwrite=False, user=None):
+    """
+    Сохраняет файл и ставит задачу в пул после коммита. Возвращает (задача, создана ли новая):
+    если тот же файл того же филиала и периода уже в очереди или обрабатывается — ту задачу.
+    """
+    start = time.perf_counter()
+    path, file_hash = spool_upload(upload)
+    existing = UploadJob.objects.filter(
+        entity=entity, kind=kind, period=period, file_hash=file_hash, status__in=ACTIVE_STATUSES,
+    ).first()
+    if existing:
+        path.unlink(missing_ok=True)
+        return existing, False
+
+    job = UploadJob.objects.create(
+        entity=entity, kind=kind, period=period, overwrite=overwrite,
+        file_name=upload.name[:255], spool_path=str(path), file_hash=file_hash, created_by=user,
+        timings={'spool': round(time.perf_counter() - start, 3)},
+    )
+    transaction.on_commit(lambda: submit(job.pk))
+    return job, True
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        workers = 1 if connection.vendor == 'sqlite' else settings.INGESTION_WORKERS
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingestion')
+    return _executor
+
+
+def _run_in_worker(job_id):
+    try:
+        run_job(job_id)
+    finally:
+        # Подключения потока пула не закрываются сами, как после запроса
+        connections.close_all()
+
+
+def submit(job_id):
+    if not settings.INGESTION_WORKERS:
+        run_job(job_id)
+        return
+    _get_executor().submit(_run_in_worker, job_id)
+
+
+def lock_keys(job):
+    """(филиал, месяц, набор данных), которые пишет задача. Годовой ОПУ занимает все месяцы года."""
+    dataset = 'osv' if job.kind == 'osv' else 'pnl'
+    if job.kind == 'pnl_multi':
+        periods = [date(job.period.year, month, 1) for month in range(1, 13)]
+    else:
+        periods = [job.period]
+    return [(job.entity_id, period, dataset) for period in periods]
+
+
+def release_stale_locks():
+    """Снимает брошенные блокировки. Возвращает их число."""
+    cutoff = timezone.now() - timedelta(seconds=settings.INGESTION_LOCK_TTL)
+    stale = IngestionLock.objects.filter(Q(acquired_at__lt=cutoff) | ~Q(job__status='running'))
+    return stale.delete()[0]
+
+
+def acquire_locks(job, wait=None):
+    """Берет все блокировки задачи разом или ждет, пока их отпустят; по истечении wait — LockTimeout."""
+    wait = settings.INGESTION_LOCK_WAIT if wait is None else wait
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            with transaction.atomic():
+                IngestionLock.objects.bulk_create([
+                    IngestionLock(entity_id=entity_id, period=period, dataset=dataset, job=job)
+                    for entity_id, period, dataset in lock_keys(job)
+                ])
+            return
+        except IntegrityError:
+            pass
+        if release_stale_locks():
+            continue
+        if time.monotonic() >= deadline:
+            raise LockTimeout("Этот период сейчас загружается другой задачей. Повторите позже.")
+        time.sleep(LOCK_POLL_SECONDS)
+
+
+def release_locks(job):
+    IngestionLock.objects.filter(job=job).delete()
+
+
+def _progress_path(job_id):
+    return spool_dir() / f"job-{job_id}.progress"
+
+
+class Progress:
+    """progress-callback загрузчиков: число записанных строк — в файл-маркер задачи."""
+
+    def __init__(self, job_id):
+        self.path = _progress_path(job_id)
+        self.rows = 0
+
+    def __call__(self, rows):
+        self.rows = rows
+        # Через временный файл: читатель не увидит недописанное число
+        tmp = self.path.with_suffix('.tmp')
+        tmp.write_text(str(rows))
+        tmp.replace(self.path)
+
+
+def job_progress(job):
+    """Строк записано: у идущей задачи — из файла-маркера, у завершенной — из БД."""
+    if job.status != 'running':
+        return job.rows
+    try:
+        return int(_progress_path(job.pk).read_text())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _load(job, file, progress):
+    """Запись файла задачи. Возвращает текст итога."""
+    entity, period = job.entity, job.period
+    if job.kind == 'pnl_multi':
+        count = process_multi_pnl_file(file, entity, period.year, progress=progress)
+        return f"Успешно загружено месяцев: {count}"
+
+    # Старые данные периода удаляются в транзакции записи: неудачная загрузка их не тронет
+    if job.kind == 'pnl':
+        process_pnl_file(file, entity, period, progress=progress, replace=job.overwrite)
+        return f"ОПУ загружен за {period:%m.%Y}"
+    stats = process_osv_file(file, entity, period, progress=progress, replace=job.overwrite)
+    return f"ОСВ загружена: {stats['rows']} счетов ({stats['rows_per_second']:.0f} строк/с)."
+
+
+def run_job(job_id):
+    """
+    Выполняет задачу, если она еще в очереди (ее мог забрать другой воркер).
+    Возвращает задачу или None.
+    """
+    now = timezone.now()
+    if not UploadJob.objects.filter(pk=job_id, status='queued').update(status='running', started_at=now):
+        return None
+    job = UploadJob.objects.select_related('entity').get(pk=job_id)
+    job.status, job.started_at = 'running', now
+    timings = dict(job.timings, queue=round((now - job.created_at).total_seconds(), 3))
+    progress = Progress(job.pk)
+
+    try:
+        start = time.perf_counter()
+        acquire_locks(job)
+        timings['lock'] = round(time.perf_counter() - start, 3)
+        start = time.perf_counter()
+        try:
+            with open(job.spool_path, 'rb') as file:
+                job.message = _load(job, file, progress)
+        finally:
+            release_locks(job)
+        timings['load'] = round(time.perf_counter() - start, 3)
+        job.status = 'done'
+    except Exception as error:
+        logger.exception("Загрузка %s не удалась", job_id)
+        job.status, job.error = 'failed', str(error) or error.__class__.__name__
+
+    job.rows, job.timings, job.finished_at = progress.rows, timings, timezone.now()
+    job.save(update_fields=['status', 'rows', 'message', 'error', 'timings', 'finished_at'])
+    Path(job.spool_path).unlink(missing_ok=True)
+    progress.path.unlink(missing_ok=True)
+    return job
+
+
+def requeue_abandoned_jobs():
+    """
+    Задачи в статусе running дольше INGESTION_LOCK_TTL (воркер остановился посреди загрузки):
+    с сохраненным файлом — обратно в очередь, без файла — в ошибку. Возвращает id вновь поставленных.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.INGESTION_LOCK_TTL)
+    requeued = []
+    for job in UploadJob.objects.filter(status='running', started_at__lt=cutoff):
+        if Path(job.spool_path).exists():
+            job.status = 'queued'
+            requeued.append(job.pk)
+        else:
+            job.status, job.error, job.finished_at = 'failed', "Воркер остановился, файл не сохранился", timezone.now()
+        job.save(update_fields=['status', 'error', 'finished_at'])
+    return requeued
+
+
+def job_state(job):
+    """Состояние задачи для страницы загрузки (JSON)."""
+    return {
+        'id': job.pk,
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'kind': job.get_kind_display(),
+        'entity': job.entity.name,
+        'period': f"{job.period:%Y}" if job.kind == 'pnl_multi' else f"{job.period:%m.%Y}",
+        'file_name': job.file_name,
+        'rows': job_progress(job),
+        'message': job.message,
+        'error': job.error,
+        'timings': job.timings,
+    }
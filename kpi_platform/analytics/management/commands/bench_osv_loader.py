@@ -0,0 +1,104 @@
+import io
+import time
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from analytics.models import Entity, TrialBalance
+from analytics.readers import iter_rows, read_chunks
+from analytics.services import OSV_HEADER_ROWS, clean_decimal, parse_osv_rows, save_osv_rows
+from datetime import date
+
+
+PERIOD = date(2000, 1, 1)
+
+
+def sample_frame(rows, seed):
+    """Лист ОСВ без шапки: счета вперемешку со строками итогов."""
+    rng = np.random.default_rng(seed)
+    codes = [f"{1 + i // 10000}.{i // 100 % 100:02d}.{i % 100:02d}" for i in range(rows)]
+    debit = [f"{v:,.2f}".replace(',', ' ').replace('.', ',') for v in rng.uniform(0, 1e7, rows)]
+    credit = rng.uniform(0, 1e7, rows).round(2)
+    body = pd.DataFrame({0: codes, 1: [f"Счет {c}" for c in codes], 2: '', 3: '', 4: '', 5: debit, 6: credit})
+    body.loc[::500, 0] = "Итого"
+    return body
+
+
+def legacy_load(df, entity):
+    """Прежний построчный загрузчик (iterrows + update_or_create) — для сравнения."""
+    for _, row in df.iterrows():
+        account_code = str(row.iloc[0]).strip()
+        if not account_code or account_code == 'nan' or 'ИТОГО' in account_code.upper():
+            continue
+        TrialBalance.objects.update_or_create(
+            entity=entity, period=PERIOD, account_code=account_code,
+            defaults={
+                'account_name': str(row.iloc[1]).strip(),
+                'debit_turnover': clean_decimal(row.iloc[5]),
+                'credit_turnover': clean_decimal(row.iloc[6]),
+            }
+        )
+
+
+class Command(BaseCommand):
+    help = "Бенчмарк загрузчика ОСВ на синтетическом файле (данные откатываются)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=50000, help="Строк в файле")
+        parser.add_argument('--legacy-rows', type=int, default=2000,
+                            help="Строк для замера прежнего построчного загрузчика (0 — не замерять)")
+        parser.add_argument('--excel', action='store_true',
+                            help="Включить в замер потоковое чтение .xlsx (analytics.readers)")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def timed(self, func):
+        start = time.perf_counter()
+        with transaction.atomic():
+            result = func()
+            transaction.set_rollback(True)
+        return result, time.perf_counter() - start
+
+    def handle(self, *args, **options):
+        df = sample_frame(options['rows'], options['seed'])
+        entity = Entity(name="bench-osv")
+
+        read_time = 0
+        if options['excel']:
+            buffer = io.BytesIO()
+            pd.concat([pd.DataFrame([[''] * 7] * OSV_HEADER_ROWS), df]).to_excel(buffer, index=False, header=False)
+            buffer.seek(0)
+            start = time.perf_counter()
+            rows = iter_rows(buffer)
+            next(read_chunks(rows, chunk_size=OSV_HEADER_ROWS))
+            df = pd.concat(read_chunks(rows, columns=7))
+            read_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rows = parse_osv_rows(df)
+        parse_time = time.perf_counter() - start
+
+        def write():
+            entity.save()
+            save_osv_rows(rows, entity, PERIOD)
+        _, write_time = self.timed(write)
+
+        total = read_time + parse_time + write_time
+        self.stdout.write(f"Строк в файле:     {options['rows']} (счетов {len(rows)})")
+        if options['excel']:
+            self.stdout.write(f"Чтение .xlsx:      {read_time:.2f} с")
+        self.stdout.write(f"Разбор:            {parse_time:.2f} с")
+        self.stdout.write(f"Запись (upsert):   {write_time:.2f} с")
+        self.stdout.write(self.style.SUCCESS(f"Итого: {total:.2f} с, {len(rows) / total:,.0f} строк/с"))
+
+        if options['legacy_rows']:
+            legacy_df = df.iloc[:options['legacy_rows']]
+
+            def legacy():
+                entity.pk = None
+                entity.save()
+                legacy_load(legacy_df, entity)
+            _, legacy_time = self.timed(legacy)
+            legacy_rate = options['legacy_rows'] / legacy_time
+            self.stdout.write(f"Построчный загрузчик: {legacy_rate:,.0f} строк/с (на {options['legacy_rows']} строках)")
+            self.stdout.write(self.style.SUCCESS(f"Ускорение: x{len(rows) / total / legacy_rate:.1f}"))
@@ -0,0 +1,98 @@
+import io
+import multiprocessing
+import resource
+import time
+from datetime import date
+
+import openpyxl
+import pandas as pd
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from analytics.models import Entity
+from analytics.readers import CHUNK_ROWS, iter_rows, read_chunks
+from analytics.services import process_osv_file
+
+
+def osv_workbook(rows, subconto):
+    """
+    Большая ОСВ: шапка, счета с оборотами в колонках F и G и справа subconto колонок
+    аналитики (контрагент, договор, ...). Пишется в режиме write_only, чтобы сама подготовка
+    файла не занимала памяти.
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(["Оборотно-сальдовая ведомость"])
+    for _ in range(4):
+        sheet.append([])
+    for i in range(rows):
+        code = f"{60 + i % 30}.{i // 30 % 100:02d}.{i:06d}"
+        sheet.append([code, f"Счет {code}", None, None, None, 1000 + i % 997, f"{i % 991} 000,50"]
+                     + [f"Субконто {c}: контрагент {i % 5000}" for c in range(subconto)])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def _peak_rss_mb():
+    # ru_maxrss: Linux — КБ
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run(func, queue):
+    before = _peak_rss_mb()
+    start = time.perf_counter()
+    func()
+    queue.put((time.perf_counter() - start, _peak_rss_mb() - before))
+
+
+def measure(func):
+    """
+    (секунды, прирост пикового RSS в МБ). Каждый замер — в отдельном процессе (fork):
+    пик RSS процесса не сбрасывается, а у дочернего процесса он начинается с текущего RSS.
+    tracemalloc здесь не годится — разбор xlsx под ним идет на порядок медленнее.
+    """
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    # Дочерний процесс открывает свое подключение к БД, а не делит родительское
+    connections.close_all()
+    process = context.Process(target=_run, args=(func, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+class Command(BaseCommand):
+    help = (
+        "Пик памяти при чтении большой ОСВ: pd.read_excel целиком против потокового "
+        "analytics.readers и полной загрузки process_osv_file (данные откатываются). Только Linux"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10000, 50000], help="Строк в файле")
+        parser.add_argument('--subconto', type=int, default=10, help="Колонок аналитики справа от оборотов")
+        parser.add_argument('--skip-pandas', action='store_true', help="Не замерять pd.read_excel (долго на больших файлах)")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Пачка потокового чтения: {CHUNK_ROWS} строк")
+        self.stdout.write(f"{'строк':>8}  {'способ':<22}{'время, с':>10}{'память, МБ':>12}")
+        for rows in options['rows']:
+            content = osv_workbook(rows, options['subconto'])
+            upload = lambda: SimpleUploadedFile('osv.xlsx', content)
+
+            runs = []
+            if not options['skip_pandas']:
+                runs.append(("pd.read_excel", lambda: pd.read_excel(upload(), header=None)))
+            runs.append(("read_chunks", lambda: sum(len(chunk) for chunk in read_chunks(iter_rows(upload())))))
+            runs.append(("process_osv_file", lambda: self.load(upload())))
+
+            for name, func in runs:
+                seconds, peak = measure(func)
+                self.stdout.write(f"{rows:>8}  {name:<22}{seconds:>10.2f}{peak:>12.1f}")
+
+    def load(self, file):
+        with transaction.atomic():
+            entity = Entity.objects.create(name="bench-upload-memory")
+            process_osv_file(file, entity, date(2000, 1, 1))
+            transaction.set_rollback(True)
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max
+from analytics.models import PnLData, TrialBalance
+
+
+# Ключи upsert загрузчиков (уникальные ограничения моделей)
+FINANCE_KEYS = (
+    ("ОПУ", PnLData, ('entity', 'category', 'period')),
+    ("ОСВ", TrialBalance, ('entity', 'period', 'account_code')),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Удаляет повторяющиеся строки ОПУ и ОСВ (совпадает ключ загрузчика), оставляя последнюю загруженную. "
+        "Нужно один раз перед миграцией с уникальными ключами"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Только посчитать дубли")
+
+    def handle(self, *args, **options):
+        verb = "Будет удалено" if options['dry_run'] else "Удалено"
+        for label, model, key in FINANCE_KEYS:
+            groups = (
+                model.objects.values(*key)
+                .annotate(n=Count('id'), last_id=Max('id'))
+                .filter(n__gt=1)
+            )
+            removed = 0
+            with transaction.atomic():
+                for group in groups:
+                    if options['dry_run']:
+                        removed += group['n'] - 1
+                        continue
+                    duplicates = model.objects.filter(**{f: group[f] for f in key}).exclude(id=group['last_id'])
+                    removed += duplicates.delete()[0]
+            self.stdout.write(self.style.SUCCESS(f"{verb} дублей {label}: {removed}"))
@@ -0,0 +1,39 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from analytics.bulk import import_archive
+
+
+class Command(BaseCommand):
+    help = "Пакетная загрузка ZIP-архива с файлами ОПУ и ОСВ филиалов (как на странице пакетной загрузки)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('archive', help="Путь к ZIP-архиву")
+        parser.add_argument('--year', type=int, help="Год по умолчанию для файлов без периода")
+        parser.add_argument('--month', type=int, help="Месяц по умолчанию для файлов без периода")
+        parser.add_argument('--overwrite', action='store_true', help="Перезаписать данные загружаемых периодов")
+
+    def handle(self, *args, **options):
+        if bool(options['year']) != bool(options['month']):
+            raise CommandError("Укажите и --year, и --month или ни одного")
+        default_period = date(options['year'], options['month'], 1) if options['year'] else None
+
+        try:
+            with open(options['archive'], 'rb') as archive:
+                summary = import_archive(archive, default_period=default_period, overwrite=options['overwrite'])
+        except FileNotFoundError as error:
+            raise CommandError(error)
+
+        self.stdout.write(f"{'файл':<40}{'филиал':<20}{'период':<9}{'тип':<5}{'строк':>8}{'разбор, с':>11}  итог")
+        for item in summary['items']:
+            period = f"{item['period']:%m.%Y}" if item['period'] else '—'
+            entity = item['entity'].name if item['entity'] else '—'
+            self.stdout.write(
+                f"{item['name'][:39]:<40}{entity[:19]:<20}{period:<9}{item['kind_display'] or '—':<5}"
+                f"{item['rows']:>8}{item['seconds']:>11.2f}  {item['error'] or item['message']}"
+            )
+        style = self.style.WARNING if summary['failed'] else self.style.SUCCESS
+        self.stdout.write(style(
+            f"Загружено файлов: {summary['loaded']}, с ошибками: {summary['failed']}, периодов: {summary['periods']}, "
+            f"строк: {summary['rows']}. Время: {summary['seconds']:.2f} с, разбор суммарно: {summary['parse_seconds']:.2f} с"
+        ))
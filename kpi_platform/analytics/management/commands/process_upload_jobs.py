@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+from analytics.ingestion import release_stale_locks, requeue_abandoned_jobs, run_job
+from analytics.models import UploadJob
+
+
+class Command(BaseCommand):
+    help = (
+        "Обрабатывает загрузки ОПУ/ОСВ, оставшиеся в очереди (например, после перезапуска "
+        "веб-сервера), и возвращает в очередь брошенные. С --loop работает как отдельный воркер"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help="Не завершаться, проверять очередь постоянно")
+        parser.add_argument('--interval', type=float, default=5, help="Пауза между проверками очереди, с")
+
+    def handle(self, *args, **options):
+        while True:
+            requeued = requeue_abandoned_jobs()
+            if requeued:
+                self.stdout.write(f"Возвращены в очередь: {', '.join(map(str, requeued))}")
+            release_stale_locks()
+
+            queued = list(UploadJob.objects.filter(status='queued').order_by('created_at').values_list('id', flat=True))
+            for job_id in queued:
+                job = run_job(job_id)
+                if job is None:
+                    continue  # задачу забрал другой воркер
+                style = self.style.SUCCESS if job.status == 'done' else self.style.ERROR
+                self.stdout.write(style(f"#{job.pk} {job.file_name}: {job.message or job.error}"))
+
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.db import models
 
 
@@ -37,6 +38,15 @@ class PnLData(models.Model):
     class Meta:
         verbose_name = "Данные ОПУ"
         verbose_name_plural = "Данные ОПУ (План-Факт)"
+        constraints = [
+            # Ключ upsert загрузчика ОПУ (analytics.services.process_pnl_file)
+            models.UniqueConstraint(fields=['entity', 'category', 'period'], name='unique_pnl_entity_category_period'),
+        ]
+        indexes = [
+            models.Index(fields=['entity', 'period', 'category'], name='pnl_entity_period_idx'),
+            # Консолидированный отчет выбирает период по всем филиалам
+            models.Index(fields=['period', 'category'], name='pnl_period_idx'),
+        ]
 
 
 class TrialBalance(models.Model):
@@ -50,4 +60,79 @@ class TrialBalance(models.Model):
 
     class Meta:
         verbose_name = "Данные ОСВ"
-        verbose_name_plural = "Данные ОСВ"
\ No newline at end of file
+        verbose_name_plural = "Данные ОСВ"
+        constraints = [
+            # Ключ upsert загрузчика ОСВ (analytics.services.process_osv_file)
+            models.UniqueConstraint(fields=['entity', 'period', 'account_code'], name='unique_osv_entity_period_account'),
+        ]
+        indexes = [
+            models.Index(fields=['entity', 'period', 'account_code'], name='osv_entity_period_idx'),
+            models.Index(fields=['period', 'account_code'], name='osv_period_idx'),
+        ]
+
+class UploadJob(models.Model):
+    """Фоновая загрузка файла ОПУ/ОСВ (analytics.ingestion)."""
+    KIND_CHOICES = (
+        ('pnl', 'ОПУ за месяц'),
+        ('pnl_multi', 'ОПУ за несколько месяцев'),
+        ('osv', 'ОСВ'),
+    )
+    STATUS_CHOICES = (
+        ('queued', 'В очереди'),
+        ('running', 'Обрабатывается'),
+        ('done', 'Готово'),
+        ('failed', 'Ошибка'),
+    )
+
+    entity = models.ForeignKey(Entity, on_delete=models.CASCADE, verbose_name="Филиал")
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, verbose_name="Тип файла")
+    # Месяц загрузки; для годового ОПУ — 1 января года
+    period = models.DateField(verbose_name="Период")
+    overwrite = models.BooleanField(default=False, verbose_name="Перезаписать период")
+    file_name = models.CharField(max_length=255, verbose_name="Файл")
+    spool_path = models.CharField(max_length=500, blank=True, verbose_name="Копия файла на диске")
+    file_hash = models.CharField(max_length=40, db_index=True, verbose_name="SHA-1 файла")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued', verbose_name="Статус")
+    rows = models.PositiveIntegerField(default=0, verbose_name="Строк записано")
+    message = models.CharField(max_length=255, blank=True, verbose_name="Итог")
+    error = models.TextField(blank=True, verbose_name="Ошибка")
+    # Длительность этапов в секундах: spool, queue, lock, load
+    timings = models.JSONField(default=dict, blank=True, verbose_name="Этапы, с")
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Загрузка файла"
+        verbose_name_plural = "Загрузки файлов"
+        indexes = [
+            # Очередь воркера и поиск повторной отправки того же файла
+            models.Index(fields=['status', 'created_at'], name='uploadjob_status_idx'),
+            models.Index(fields=['entity', 'period', 'kind'], name='uploadjob_entity_period_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.entity_id} {self.period:%Y-%m}: {self.file_name}"
+
+
+class IngestionLock(models.Model):
+    """
+    Блокировка (филиал, месяц, набор данных) на время загрузки: две загрузки одного
+    периода не пишут одновременно. Строка существует, пока загрузка идет.
+    """
+    DATASET_CHOICES = (
+        ('pnl', 'ОПУ'),
+        ('osv', 'ОСВ'),
+    )
+
+    entity = models.ForeignKey(Entity, on_delete=models.CASCADE)
+    period = models.DateField()
+    dataset = models.CharField(max_length=10, choices=DATASET_CHOICES)
+    job = models.ForeignKey(UploadJob, on_delete=models.CASCADE, related_name='locks')
+    acquired_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['entity', 'period', 'dataset'], name='unique_ingestion_lock'),
+        ]
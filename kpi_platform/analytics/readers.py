@@ -0,0 +1,109 @@
+"""
+Потоковое чтение загружаемых файлов (ОПУ, ОСВ) с ограниченной памятью.
+
+pd.read_excel разворачивает лист целиком в DataFrame с object-колонками — большая ОСВ
+с субконто занимает так сотни мегабайт на воркер. Здесь лист читается openpyxl в режиме
+read_only по одной строке, а наружу отдаются пачки по CHUNK_ROWS строк:
+
+    rows = iter_rows(file)
+    head = read_head(rows, 5)                 # шапка — отдельно
+    for chunk in read_chunks(rows, start=5):  # данные — DataFrame по CHUNK_ROWS строк
+        ...
+
+Колонки пачки — номера колонок листа (0, 1, ...), индекс — номер строки листа с нуля,
+как у pd.read_excel(header=None). Значения ячеек типизированы (числа, строки, даты, None).
+В памяти одновременно только одна пачка, поэтому пик почти не зависит от размера файла
+(целиком openpyxl держит только таблицу общих строк xlsx).
+
+CSV читается модулем csv (пустые ячейки — None). Старый .xls openpyxl не читает —
+для него остается pd.read_excel, и память тогда не ограничена.
+"""
+import csv
+import io
+from itertools import islice
+
+import openpyxl
+import pandas as pd
+
+
+CHUNK_ROWS = 5000
+# Начало любого zip-архива, в том числе .xlsx
+ZIP_SIGNATURE = b'PK\x03\x04'
+
+
+def _rewind(file):
+    if hasattr(file, 'seek'):
+        file.seek(0)
+
+
+def _is_xlsx(file):
+    _rewind(file)
+    signature = file.read(len(ZIP_SIGNATURE))
+    _rewind(file)
+    return signature == ZIP_SIGNATURE
+
+
+def iter_rows(file):
+    """Строки первого листа (или CSV) как кортежи значений. Файл читается с начала."""
+    if getattr(file, 'name', '').lower().endswith('.csv'):
+        _rewind(file)
+        text = io.TextIOWrapper(getattr(file, 'file', file), encoding='utf-8-sig', newline='')
+        try:
+            for row in csv.reader(text):
+                yield tuple(value if value != '' else None for value in row)
+        finally:
+            # Закрытие обертки закрыло бы и сам загруженный файл
+            text.detach()
+        return
+
+    if not _is_xlsx(file):
+        df = pd.read_excel(file, header=None)
+        yield from df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+        return
+
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        # Выгрузки из учетных систем часто пишут неверный размер листа — читаем фактические строки
+        sheet.reset_dimensions()
+        yield from sheet.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def frame(rows, start=0, columns=0):
+    """
+    Список строк -> DataFrame с индексом от start и не меньше чем columns колонками
+    (короткие строки дополняются None). Фактическая ширина строк — в attrs['width'].
+    """
+    df = pd.DataFrame(rows, index=pd.RangeIndex(start, start + len(rows)))
+    width = df.shape[1]
+    if width < columns:
+        df = df.reindex(columns=range(columns))
+    df.attrs['width'] = width
+    return df
+
+
+def read_head(rows, count, columns=0):
+    """Первые count строк итератора iter_rows (итератор продолжается с count-й строки)."""
+    return frame(list(islice(rows, count)), columns=columns)
+
+
+def read_chunks(rows, start=0, chunk_size=None, columns=0, prepend=None):
+    """
+    Оставшиеся строки итератора пачками DataFrame по chunk_size (по умолчанию CHUNK_ROWS) строк;
+    start — номер первой из них в листе. prepend — уже прочитанные строки данных (кусок read_head),
+    они становятся началом первой пачки.
+    """
+    chunk_size = chunk_size or CHUNK_ROWS
+    if prepend is not None and len(prepend):
+        chunk = list(prepend.itertuples(index=False, name=None))
+        chunk += islice(rows, max(chunk_size - len(chunk), 0))
+        yield frame(chunk, start=prepend.index[0], columns=columns)
+        start = prepend.index[0] + len(chunk)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield frame(chunk, start=start, columns=columns)
+        start += len(chunk)
@@ -1,7 +1,43 @@
+import numpy as np
 import pandas as pd
-from .models import Category, PnLData, Entity
+from django.db import transaction
+from django.db.models import Q
+from .models import Category, PnLData, Entity, TrialBalance
+from .readers import frame, iter_rows, read_chunks, read_head
+from core.utils import month_bounds
+from datetime import date
 from decimal import Decimal
 import re
+import time
+
+
+ZERO = Decimal('0.00')
+# Размер пачки для bulk_create/bulk_update загрузчиков
+BATCH_SIZE = 1000
+# Шапку годового файла ОПУ ищем только в первых строках листа
+HEADER_SCAN_ROWS = 50
+# Служебные строки перед данными: в ОПУ — заголовок отчета и шапка, в ОСВ — шапка и 4 строки под ней
+PNL_HEADER_ROWS = 3
+OSV_HEADER_ROWS = 5
+PNL_COLUMNS = 4
+OSV_COLUMNS = 7
+
+# Словарик для перевода русских месяцев в числа
+RUS_MONTHS = {
+    'янв': 1, 'фев': 2, 'мар': 3, 'апр': 4, 'май': 5, 'июн': 6,
+    'июл': 7, 'авг': 8, 'сен': 9, 'окт': 10, 'ноя': 11, 'дек': 12
+}
+# Словарь синонимов для объединения категорий
+CATEGORY_MAPPING = {
+    # Слушатели
+    "количество слушателей / number of students": "Кол-во заявок на обучение / Number of enrolled students",
+    "количество слушателей": "Кол-во заявок на обучение / Number of enrolled students",
+    "количество студентов": "Кол-во заявок на обучение / Number of enrolled students",
+
+    # Прибыль
+    "чистая прибыль / net profit": "Чистая прибыль",
+    "итого чистая прибыль": "Чистая прибыль",
+}
 
 
 def clean_decimal(value):
@@ -15,87 +51,377 @@ def clean_decimal(value):
         return Decimal('0.00')
 
 
-def process_pnl_file(file, entity_obj, period_date):
-    if file.name.endswith('.csv'):
-        df = pd.read_csv(file)
-    else:
-        # Указываем header=None, чтобы самим контролировать строки
-        df = pd.read_excel(file, header=None)
-
-    # Начинаем с 4-й строки (индекс 4 в Excel, 3 в Python)
-    for index, row in df.iloc[3:].iterrows():
-        # Пробуем взять название из колонки B, если там пусто - из колонки A
-        val_a = str(row.iloc[0]).strip()
-        val_b = str(row.iloc[1]).strip()
-
-        # Если в B пусто (nan), берем значение из А.
-        # Это часто бывает в итоговых строках Excel при экспорте
-        if val_b == 'nan' or not val_b:
-            name = val_a
-        else:
-            name = val_b
-
-        # Пропускаем, если совсем ничего нет
-        if not name or name == 'nan' or 'наименование' in name.lower():
-            continue
-
-        # ЛОГИКА ИТОГА: если в колонке А нет ни одной цифры
-        # (в итоговых строках там либо пусто, либо текст "Итого")
-        has_digit = any(char.isdigit() for char in val_a)
-        is_total = not has_digit
-
-        category, _ = Category.objects.update_or_create(
-            name=name,
-            defaults={
-                'order': index,
-                'is_total': is_total
-            }
-        )
-
-        # Значения План/Факт обычно в 3 и 4 колонках (индексы 2 и 3)
-        fact_val = clean_decimal(row.iloc[2])
-        plan_val = clean_decimal(row.iloc[3])
-
-        PnLData.objects.update_or_create(
-            entity=entity_obj,
-            category=category,
-            period=period_date,
-            defaults={'fact': fact_val, 'plan': plan_val}
-        )
-
-
-def process_osv_file(file, entity_obj, period_date):
-    if file.name.endswith('.csv'):
-        df = pd.read_csv(file)
-    else:
-        df = pd.read_excel(file)
-
-    # В твоем файле ОСВ заголовки на 4-й строке (индекс 3)
-    # Колонки: 0: Счет, 1: Наименование, 5: Дебет оборот, 6: Кредит оборот
-    df_data = df.iloc[4:].reset_index(drop=True)
-
-    from .models import TrialBalance
-
-    for index, row in df_data.iterrows():
-        account_code = str(row.iloc[0]).strip()
-        account_name = str(row.iloc[1]).strip()
-
-        # Пропускаем пустые строки и итоги
-        if not account_code or account_code == 'nan' or 'ИТОГО' in account_code.upper():
-            continue
-
-        # Очищаем цифры
-        debit_val = clean_decimal(row.iloc[5])
-        credit_val = clean_decimal(row.iloc[6])
-
-        # Сохраняем в БД
-        TrialBalance.objects.update_or_create(
-            entity=entity_obj,
-            period=period_date,
-            account_code=account_code,
-            defaults={
-                'account_name': account_name,
-                'debit_turnover': debit_val,
-                'credit_turnover': credit_val,
-            }
-        )
\ No newline at end of file
+def clean_decimal_column(column):
+    """
+    clean_decimal для целой колонки: очистка и проверка числа — векторные операции pandas,
+    пустые и нечисловые значения дают 0. Возвращает список Decimal.
+    """
+    cleaned = (
+        column.astype('string').str.strip()
+        .str.replace(r'[^\d.,-]', '', regex=True)
+        .str.replace(',', '.', regex=False)
+    )
+    valid = pd.to_numeric(cleaned, errors='coerce').notna()
+    return [Decimal(value) if ok else ZERO for value, ok in zip(cleaned.fillna(''), valid)]
+
+
+def clean_float_block(frame):
+    """
+    Блок ячеек с числами -> np.ndarray float той же формы. Числа из Excel берутся как есть,
+    строки ("1 000,50") очищаются как в clean_decimal; пустые и нечисловые значения дают 0.
+    """
+    block = np.zeros(frame.shape)
+    for i in range(frame.shape[1]):
+        column = frame.iloc[:, i]
+        values = pd.to_numeric(column, errors='coerce').to_numpy(dtype=float, na_value=np.nan, copy=True)
+        text = np.isnan(values) & column.notna().to_numpy()
+        if text.any():
+            cleaned = (
+                column[text].astype('string').str.replace(r'[^\d.,-]', '', regex=True)
+                .str.replace(',', '.', regex=False)
+            )
+            values[text] = pd.to_numeric(cleaned, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        block[:, i] = np.nan_to_num(values, nan=0.0)
+    return block
+
+
+def normalize_category_names(names):
+    """normalize_category_name для целой колонки названий."""
+    clean = names.str.replace(r'\s+', ' ', regex=True).str.strip()
+    return clean.str.lower().map(CATEGORY_MAPPING).fillna(clean)
+
+
+def normalize_category_name(raw_name):
+    """Очищает строку и заменяет синонимы на эталонные названия."""
+    if not raw_name: return ""
+    return normalize_category_names(pd.Series([str(raw_name)], dtype='string'))[0]
+
+
+def parse_pnl_rows(data):
+    """
+    Строки статей ОПУ -> DataFrame(name, order, is_total, fact, plan), без обращений к БД.
+    Код в колонке A, название в B (или в A, если B пуста), факт и план — в C и D;
+    order — номер строки листа. Повтор статьи: как и раньше, побеждает последняя строка.
+    """
+    col_a = data.iloc[:, 0].astype('string').str.strip()
+    col_b = data.iloc[:, 1].astype('string').str.strip()
+
+    # Если в B пусто (nan), берем значение из А — так бывает в итоговых строках при экспорте
+    b_empty = col_b.isna() | col_b.isin(['', 'nan'])
+    name = col_b.mask(b_empty, col_a).fillna('')
+    keep = ~name.isin(['', 'nan']) & ~name.str.lower().str.contains('наименование', regex=False)
+
+    rows = pd.DataFrame({
+        'name': name,
+        'order': data.index,
+        # Итоговая строка: в колонке A нет ни одной цифры
+        'is_total': ~col_a.fillna('').str.contains(r'\d', regex=True),
+        'fact': clean_decimal_column(data.iloc[:, 2]),
+        'plan': clean_decimal_column(data.iloc[:, 3]),
+    }, index=data.index)[keep.to_numpy()]
+    return rows.drop_duplicates('name', keep='last')
+
+
+def resolve_categories(attributes, update=True):
+    """
+    {название: (order, is_total)} -> {название: Category}.
+    Недостающие статьи создаются одним bulk_create, у существующих order/is_total
+    обновляются одним bulk_update (только если изменились и update=True).
+    """
+    categories = {}
+    for category in Category.objects.filter(name__in=list(attributes)).order_by('-id'):
+        categories[category.name] = category  # при дублях названия берется самая ранняя
+
+    changed = []
+    for name, (order, is_total) in attributes.items():
+        category = categories.get(name)
+        if update and category and (category.order, category.is_total) != (order, is_total):
+            category.order, category.is_total = order, is_total
+            changed.append(category)
+    if changed:
+        Category.objects.bulk_update(changed, ['order', 'is_total'], batch_size=BATCH_SIZE)
+
+    missing = [
+        Category(name=name, order=order, is_total=is_total)
+        for name, (order, is_total) in attributes.items() if name not in categories
+    ]
+    for category in Category.objects.bulk_create(missing, batch_size=BATCH_SIZE):
+        categories[category.name] = category
+    return categories
+
+
+def require_columns(width, columns, message):
+    if width < columns:
+        raise ValueError(message)
+
+
+def save_pnl_rows(rows, entity_obj, periods, categories):
+    """
+    Upsert строк ОПУ (periods — период каждой строки) по ключу (entity, category, period):
+    повтор статьи в следующей пачке перезапишет предыдущий.
+    """
+    PnLData.objects.bulk_create(
+        [
+            PnLData(entity=entity_obj, category=categories[name], period=period, fact=fact, plan=plan)
+            for name, period, fact, plan in zip(rows['name'], periods, rows['fact'], rows['plan'])
+        ],
+        batch_size=BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['entity', 'category', 'period'],
+        update_fields=['fact', 'plan'],
+    )
+
+
+def iter_pnl_chunks(file):
+    """
+    Разобранные пачки ОПУ за месяц (parse_pnl_rows), без обращений к БД. Лист читается потоково
+    (analytics.readers); проверка ширины — после последней пачки, поэтому ошибка формата
+    откатывает транзакцию, в которой пачки уже записаны.
+    """
+    rows = iter_rows(file)
+    width = read_head(rows, PNL_HEADER_ROWS).attrs['width']
+    for chunk in read_chunks(rows, start=PNL_HEADER_ROWS, columns=PNL_COLUMNS):
+        width = max(width, chunk.attrs['width'])
+        yield parse_pnl_rows(chunk)
+    require_columns(width, PNL_COLUMNS, "В файле ОПУ меньше 4 колонок (код, статья, факт, план)")
+
+
+def pnl_category_attributes(parsed):
+    return {
+        name: (int(order), bool(is_total))
+        for name, order, is_total in zip(parsed['name'], parsed['order'], parsed['is_total'])
+    }
+
+
+def process_pnl_file(file, entity_obj, period_date, progress=None, replace=False):
+    """
+    Загрузка ОПУ филиала за месяц. Каждая пачка iter_pnl_chunks пишется сразу после разбора
+    (в памяти одна пачка): статьи пачкой и upsert PnLData. Все пачки — в одной транзакции,
+    replace удаляет прежние данные периода в ней же, поэтому ошибка формата в конце файла
+    оставляет старые данные. progress(строк записано) вызывается после каждой пачки.
+    Возвращает число загруженных статей.
+    """
+    names = set()
+    with transaction.atomic():
+        if replace:
+            PnLData.objects.filter(entity=entity_obj, period=period_date).delete()
+        for parsed in iter_pnl_chunks(file):
+            categories = resolve_categories(pnl_category_attributes(parsed))
+            save_pnl_rows(parsed, entity_obj, [period_date] * len(parsed), categories)
+            names.update(parsed['name'])
+            if progress:
+                progress(len(names))
+    return len(names)
+
+
+def parse_pnl_file(file):
+    """Весь ОПУ за месяц одним DataFrame (повтор статьи — побеждает последняя строка), без обращений к БД."""
+    chunks = list(iter_pnl_chunks(file))
+    if not chunks:
+        return parse_pnl_rows(frame([], columns=PNL_COLUMNS))
+    return pd.concat(chunks).drop_duplicates('name', keep='last')
+
+
+def find_multi_pnl_header(df):
+    """
+    Строка шапки годового файла ОПУ среди первых HEADER_SCAN_ROWS строк и ее формат.
+    Первый формат: строка с "Факт" и "План", месяцы — строкой выше. Второй: месяцы
+    ("Январь", "Февраль", ...) в самой строке шапки. Возвращает (номер строки, есть ли колонки Факт/План).
+    """
+    prefix = df.iloc[:HEADER_SCAN_ROWS]
+    cells = prefix.stack().astype('string').str.lower()
+    row = cells.index.get_level_values(0)
+    has_fact = cells.str.contains('факт', regex=False).groupby(row).any()
+    has_plan = cells.str.contains('план', regex=False).groupby(row).any()
+    has_month = cells.str.contains('январь|февраль', regex=True).groupby(row).any()
+
+    # Строка месяцев первого формата сама похожа на шапку второго, поэтому Факт/План проверяется первым
+    for found, is_split_format in ((has_fact & has_plan, True), (has_month, False)):
+        rows = found.index[found.to_numpy()]
+        if len(rows):
+            return prefix.index.get_loc(rows[0]), is_split_format
+    raise ValueError("Не удалось распознать формат заголовка годового ОПУ")
+
+
+def _month_numbers(cells, exact):
+    """Номер месяца для каждой ячейки (0 — не месяц). При нескольких совпадениях — последний, как раньше."""
+    month = pd.Series(0, index=cells.index)
+    for name, number in RUS_MONTHS.items():
+        match = cells.str.fullmatch(name + r'[а-я]*\.?') if exact else cells.str.contains(name, regex=False)
+        month = month.mask(match.fillna(False).to_numpy(), number)
+    return month.to_numpy()
+
+
+def multi_pnl_columns(df, header_idx, is_split_format):
+    """
+    Колонки месяцев -> (номера месяцев, колонки факта, колонки плана или None).
+    Первый формат: месяц указан над первой колонкой пары Факт/План и действует до следующего,
+    итоговые пары ("Итого за год") пропускаются. Второй формат: колонка = месяц, плана нет.
+    """
+    header = df.iloc[header_idx].astype('string').str.lower().str.strip()
+    if not is_split_format:
+        months = _month_numbers(header, exact=True)
+        fact_cols = np.flatnonzero(months)
+        return months[fact_cols], fact_cols, None
+
+    if header_idx == 0:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=int)
+    above = df.iloc[header_idx - 1].astype('string').str.lower().str.strip()
+    current = pd.Series(_month_numbers(above, exact=False)).replace(0, np.nan).ffill().fillna(0).to_numpy()
+    is_total = above.str.contains('итого', regex=False).fillna(False).to_numpy()
+    fact_cols = np.flatnonzero((header == 'факт').fillna(False).to_numpy() & (current > 0) & ~is_total)
+    # План — колонка справа от факта; у последней колонки листа плана нет
+    fact_cols = fact_cols[fact_cols + 1 < df.shape[1]]
+    return current[fact_cols].astype(int), fact_cols, fact_cols + 1
+
+
+def multi_pnl_layout(head):
+    """Первые строки годового листа ОПУ -> (строка шапки, месяцы, колонки факта, колонки плана или None)."""
+    require_columns(head.attrs.get('width', head.shape[1]), 2, "В годовом файле ОПУ меньше 2 колонок")
+    header_idx, is_split_format = find_multi_pnl_header(head)
+    return (header_idx, *multi_pnl_columns(head, header_idx, is_split_format))
+
+
+def parse_multi_pnl_rows(data, months, fact_cols, plan_cols):
+    """
+    Строки статей годового ОПУ -> DataFrame(name, month, fact, plan), без обращений к БД.
+    Название статьи — более длинное из колонок A и B, синонимы сводятся normalize_category_names.
+    Нулевые пары факт/план не записываются; если несколько строк свелись к одной статье,
+    за месяц остается последняя.
+    """
+    col_a = data.iloc[:, 0].astype('string').str.strip().fillna('')
+    col_b = data.iloc[:, 1].astype('string').str.strip().fillna('')
+    raw = col_a.where(col_a.str.len() >= col_b.str.len(), col_b)
+    names = normalize_category_names(raw)
+    keep = (
+        ~raw.str.lower().isin(['', 'nan', 'none', 'факт', 'план'])
+        & (names.str.lower() != 'итого')
+    ).to_numpy()
+
+    names = names[keep].to_numpy()
+    facts = clean_float_block(data.iloc[keep, fact_cols])
+    plans = clean_float_block(data.iloc[keep, plan_cols]) if plan_cols is not None else np.zeros(facts.shape)
+
+    # Матрицы (строки x месяцы) разворачиваются построчно — порядок как в файле
+    rows = pd.DataFrame({
+        'name': np.repeat(names, len(months)),
+        'month': np.tile(months, len(names)),
+        'fact': facts.ravel(),
+        'plan': plans.ravel(),
+    })
+    rows = rows[(rows['fact'] != 0) | (rows['plan'] != 0)]
+    return rows.drop_duplicates(['name', 'month'], keep='last')
+
+
+def process_multi_pnl_file(file, entity, year, progress=None):
+    """
+    Загрузка годового ОПУ филиала: данные за месяцы из файла заменяются целиком.
+    Шапка ищется в первых HEADER_SCAN_ROWS строках, остальное читается потоково пачками;
+    в одной транзакции удаляются прежние месяцы, затем каждая пачка разбирается векторно
+    (parse_multi_pnl_rows) и сразу пишется upsert-ом.
+    progress(строк записано) вызывается после каждой пачки. Возвращает число загруженных месяцев.
+    """
+    rows = iter_rows(file)
+    head = read_head(rows, HEADER_SCAN_ROWS)
+    header_idx, month_numbers, fact_cols, plan_cols = multi_pnl_layout(head)
+    months = sorted(set(month_numbers.tolist()))
+    periods = {month: date(year, month, 1) for month in months}
+    written = 0
+
+    with transaction.atomic():
+        # Диапазоны дат вместо period__month: условие идет по индексу (entity, period, category)
+        month_filter = Q()
+        for month in months:
+            month_start, month_end = month_bounds(date(year, month, 1))
+            month_filter |= Q(period__gte=month_start, period__lt=month_end)
+        if months:
+            PnLData.objects.filter(month_filter, entity=entity).delete()
+
+        data = read_chunks(rows, start=len(head), columns=head.shape[1], prepend=head.iloc[header_idx + 1:])
+        for chunk in data:
+            parsed = parse_multi_pnl_rows(chunk, month_numbers, fact_cols, plan_cols)
+            # Существующие статьи не меняются: порядок и признак итога задает помесячный ОПУ
+            categories = resolve_categories({name: (0, False) for name in parsed['name'].unique()}, update=False)
+            save_pnl_rows(parsed, entity, [periods[month] for month in parsed['month']], categories)
+            written += len(parsed)
+            if progress:
+                progress(written)
+    return len(months)
+
+
+def parse_osv_rows(data):
+    """
+    Строки счетов ОСВ -> DataFrame(account_code, account_name, debit, credit), без обращений к БД.
+    Колонки: 0 — счет, 1 — наименование, 5 — дебет оборот, 6 — кредит оборот. Пустые строки
+    и итоги отбрасываются маской, повтор счета — побеждает последняя строка.
+    """
+    code = data.iloc[:, 0].astype('string').str.strip()
+    keep = (
+        code.notna() & ~code.isin(['', 'nan'])
+        & ~code.str.upper().str.contains('ИТОГО', regex=False).fillna(False)
+    ).to_numpy()
+
+    data, code = data[keep], code[keep]
+    rows = pd.DataFrame({
+        'account_code': code,
+        'account_name': data.iloc[:, 1].astype('string').str.strip().fillna(''),
+        'debit': clean_decimal_column(data.iloc[:, 5]),
+        'credit': clean_decimal_column(data.iloc[:, 6]),
+    }, index=data.index)
+    return rows.drop_duplicates('account_code', keep='last')
+
+
+def save_osv_rows(rows, entity_obj, period_date, batch_size=BATCH_SIZE):
+    """Upsert строк ОСВ пачками по ключу (entity, period, account_code)."""
+    TrialBalance.objects.bulk_create(
+        [
+            TrialBalance(entity=entity_obj, period=period_date, account_code=code, account_name=name,
+                         debit_turnover=debit, credit_turnover=credit)
+            for code, name, debit, credit in zip(
+                rows['account_code'], rows['account_name'], rows['debit'], rows['credit'])
+        ],
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['entity', 'period', 'account_code'],
+        update_fields=['account_name', 'debit_turnover', 'credit_turnover'],
+    )
+
+
+def iter_osv_chunks(file, chunk_size=None):
+    """Разобранные пачки ОСВ (parse_osv_rows) по chunk_size строк листа, без обращений к БД."""
+    rows = iter_rows(file)
+    width = read_head(rows, OSV_HEADER_ROWS).attrs['width']
+    for chunk in read_chunks(rows, start=OSV_HEADER_ROWS, chunk_size=chunk_size, columns=OSV_COLUMNS):
+        width = max(width, chunk.attrs['width'])
+        yield parse_osv_rows(chunk)
+    require_columns(width, OSV_COLUMNS, "В файле ОСВ меньше 7 колонок (счет, наименование, ..., дебет, кредит)")
+
+
+def process_osv_file(file, entity_obj, period_date, chunk_size=None, progress=None, replace=False):
+    """
+    Загрузка ОСВ филиала за месяц. Лист читается потоково (iter_osv_chunks): в памяти одна пачка
+    строк (chunk_size, по умолчанию CHUNK_ROWS), она разбирается векторно и сразу пишется upsert-ом,
+    поэтому пик памяти не зависит от размера файла. Все пачки — в одной транзакции, replace удаляет
+    прежние данные периода в ней же: ОСВ загружается (или заменяется) целиком или никак.
+    progress(строк записано) вызывается после каждой пачки. Возвращает {'rows', 'seconds', 'rows_per_second'}.
+    """
+    start = time.perf_counter()
+    count = 0
+    with transaction.atomic():
+        if replace:
+            TrialBalance.objects.filter(entity=entity_obj, period=period_date).delete()
+        for parsed in iter_osv_chunks(file, chunk_size):
+            save_osv_rows(parsed, entity_obj, period_date)
+            count += len(parsed)
+            if progress:
+                progress(count)
+    seconds = time.perf_counter() - start
+    return {'rows': count, 'seconds': seconds, 'rows_per_second': count / seconds if seconds else 0}
+
+
+def parse_osv_file(file):
+    """Вся ОСВ одним DataFrame (повтор счета — побеждает последняя строка), без обращений к БД."""
+    chunks = list(iter_osv_chunks(file))
+    if not chunks:
+        return parse_osv_rows(frame([], columns=OSV_COLUMNS))
+    return pd.concat(chunks).drop_duplicates('account_code', keep='last')
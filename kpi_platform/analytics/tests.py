@@ -1,3 +1,530 @@
-from django.test import TestCase
+import io
+import shutil
+import tempfile
+import zipfile
+from datetime import date, timedelta
+from pathlib import Path
+from decimal import Decimal
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
 
-# Create your tests here.
+import pandas as pd
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+
+from core.testing import assert_uses_index
+from core.utils import month_bounds, year_bounds
+from users.models import User
+from . import bulk
+from .bulk import find_entity, find_kind, find_period, import_archive
+from .ingestion import LockTimeout, acquire_locks, create_job, job_state, run_job
+from .models import Entity, Category, IngestionLock, PnLData, TrialBalance, UploadJob
+from .readers import iter_rows, read_chunks, read_head
+from .services import parse_osv_rows, process_multi_pnl_file, process_osv_file, process_pnl_file, save_osv_rows
+
+
+PERIOD = date(2025, 3, 1)
+MONTHS = ("Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
+          "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь")
+
+
+def excel_file(rows, name='upload.xlsx'):
+    buffer = io.BytesIO()
+    pd.DataFrame(rows).to_excel(buffer, header=False, index=False)
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+def pnl_rows(categories):
+    rows = [["ОПУ за март"], [], ["Код", "Наименование статьи", "Факт", "План"]]
+    rows += [[f"1.{c}", f"Статья {c}", f"{1000 + c} 500,50", 900 + c] for c in range(categories)]
+    return rows
+
+
+def osv_rows(accounts):
+    # Шапка таблицы (header=0) и четыре служебные строки, затем счета
+    rows = [["Оборотно-сальдовая ведомость"]] + [[] for _ in range(4)]
+    rows += [[f"10.{a:02d}", f"Счет {a}", None, None, None, f"{a} 000,50", a] for a in range(accounts)]
+    return rows
+
+
+def multi_pnl_rows(categories, months=("Январь", "Февраль", "Март")):
+    # Первый формат: месяц над парой Факт/План, в конце — итог за год
+    months_row, header = ["", ""], ["Код", "Статья"]
+    for name in list(months) + ["Итого за год"]:
+        months_row += [name, ""]
+        header += ["Факт", "План"]
+    rows = [["ОПУ за год"], months_row, header]
+    rows += [[f"1.{c}", f"Статья {c}"] + [f"{c} 000,50", c] * len(months) + [1, 1] for c in range(categories)]
+    return rows
+
+
+class QueryPlanTests(TestCase):
+    """Выборки ОПУ/ОСВ по филиалу и периоду идут по индексам (entity, period, ...)."""
+
+    def setUp(self):
+        self.entity = Entity.objects.create(name="Филиал")
+        category = Category.objects.create(name="Выручка")
+        PnLData.objects.create(entity=self.entity, category=category, period=PERIOD, plan=10, fact=8)
+        TrialBalance.objects.create(entity=self.entity, period=PERIOD, account_code='1.02.10',
+                                    account_name="Банк", debit_turnover=5, credit_turnover=3)
+
+    def test_pnl_month_of_entity(self):
+        start, end = month_bounds(PERIOD)
+        assert_uses_index(self, PnLData.objects.filter(entity=self.entity, period__gte=start, period__lt=end))
+
+    def test_upload_calendar_year(self):
+        start, end = year_bounds(PERIOD.year)
+        for model in (PnLData, TrialBalance):
+            qs = model.objects.filter(period__gte=start, period__lt=end).values_list('entity_id', 'period').distinct()
+            assert_uses_index(self, qs)
+
+    def test_consolidated_period(self):
+        assert_uses_index(self, PnLData.objects.filter(period=PERIOD), tables=[PnLData])
+        assert_uses_index(self, TrialBalance.objects.filter(period=PERIOD))
+
+    def test_trial_balance_accounts_of_entity(self):
+        qs = TrialBalance.objects.filter(entity=self.entity, period=PERIOD, account_code__startswith='1.02')
+        assert_uses_index(self, qs)
+
+
+class PnLLoaderTests(TestCase):
+
+    def setUp(self):
+        self.entity = Entity.objects.create(name="Филиал")
+
+    def test_rows_totals_and_numbers(self):
+        rows = pnl_rows(2) + [
+            [None, "Итого выручка", "-", None],
+            ["1.0", "Статья 0", "7,25", "abc"],  # повтор статьи: берется последняя строка
+        ]
+        self.assertEqual(process_pnl_file(excel_file(rows), self.entity, PERIOD), 3)
+
+        data = {p.category.name: p for p in PnLData.objects.select_related('category')}
+        self.assertEqual(set(data), {"Статья 0", "Статья 1", "Итого выручка"})
+        self.assertEqual((data["Статья 0"].fact, data["Статья 0"].plan), (Decimal('7.25'), Decimal('0')))
+        self.assertEqual((data["Статья 1"].fact, data["Статья 1"].plan), (Decimal('1001500.50'), Decimal('901')))
+        self.assertEqual(data["Итого выручка"].fact, Decimal('0'))
+        self.assertTrue(data["Итого выручка"].category.is_total)
+        self.assertFalse(data["Статья 1"].category.is_total)
+
+    def test_reload_updates_in_place(self):
+        process_pnl_file(excel_file(pnl_rows(3)), self.entity, PERIOD)
+        rows = pnl_rows(3)
+        rows[-1][2] = 5
+        process_pnl_file(excel_file(rows), self.entity, PERIOD)
+
+        self.assertEqual(PnLData.objects.count(), 3)
+        self.assertEqual(Category.objects.count(), 3)
+        self.assertEqual(PnLData.objects.get(category__name="Статья 2").fact, Decimal('5'))
+
+    def test_query_count_does_not_depend_on_rows(self):
+        with CaptureQueriesContext(connection) as small:
+            process_pnl_file(excel_file(pnl_rows(3)), self.entity, PERIOD)
+        with CaptureQueriesContext(connection) as large:
+            process_pnl_file(excel_file(pnl_rows(300)), self.entity, date(2025, 4, 1))
+
+        self.assertEqual(PnLData.objects.count(), 303)
+        self.assertLessEqual(len(large.captured_queries), len(small.captured_queries) + 1)
+        self.assertLessEqual(len(large.captured_queries), 6)
+
+    def test_replace_keeps_old_rows_when_file_is_bad(self):
+        process_pnl_file(excel_file(pnl_rows(3)), self.entity, PERIOD)
+        with self.assertRaisesMessage(ValueError, "меньше 4 колонок"):
+            process_pnl_file(excel_file([["ОПУ"], [], ["Код", "Статья"], ["1", "А"]]), self.entity, PERIOD, replace=True)
+        self.assertEqual(PnLData.objects.count(), 3)
+
+        process_pnl_file(excel_file(pnl_rows(2)), self.entity, PERIOD, replace=True)
+        self.assertEqual(PnLData.objects.count(), 2)
+
+
+class OSVLoaderTests(TestCase):
+
+    def setUp(self):
+        self.entity = Entity.objects.create(name="Филиал")
+
+    def test_totals_and_blank_rows_skipped(self):
+        rows = osv_rows(2) + [
+            [None, "Пустая строка", None, None, None, 1, 1],
+            ["Итого по счету", None, None, None, None, "2 000,50", 1],
+            ["10.00", "Счет 0 (повтор)", None, None, None, "-", "abc"],
+        ]
+        result = process_osv_file(excel_file(rows), self.entity, PERIOD)
+
+        self.assertEqual(result['rows'], 2)
+        data = {t.account_code: t for t in TrialBalance.objects.all()}
+        self.assertEqual(set(data), {"10.00", "10.01"})
+        self.assertEqual(data["10.00"].account_name, "Счет 0 (повтор)")
+        self.assertEqual((data["10.00"].debit_turnover, data["10.00"].credit_turnover), (Decimal('0'), Decimal('0')))
+        self.assertEqual((data["10.01"].debit_turnover, data["10.01"].credit_turnover), (Decimal('1000.50'), Decimal('1')))
+
+    def test_reload_updates_in_place(self):
+        process_osv_file(excel_file(osv_rows(3)), self.entity, PERIOD)
+        rows = osv_rows(3)
+        rows[-1][5] = "7,5"
+        process_osv_file(excel_file(rows), self.entity, PERIOD)
+
+        self.assertEqual(TrialBalance.objects.count(), 3)
+        self.assertEqual(TrialBalance.objects.get(account_code="10.02").debit_turnover, Decimal('7.5'))
+
+    def test_query_count_does_not_depend_on_rows(self):
+        with CaptureQueriesContext(connection) as small:
+            process_osv_file(excel_file(osv_rows(3)), self.entity, PERIOD)
+        with CaptureQueriesContext(connection) as large:
+            process_osv_file(excel_file(osv_rows(90)), self.entity, date(2025, 4, 1))
+
+        self.assertEqual(TrialBalance.objects.count(), 93)
+        self.assertEqual(len(large.captured_queries), len(small.captured_queries))
+
+    def test_each_chunk_is_written_before_the_next_is_parsed(self):
+        steps = []
+
+        def parse(data):
+            steps.append('parse')
+            return parse_osv_rows(data)
+
+        def save(rows, *args):
+            steps.append('save')
+            return save_osv_rows(rows, *args)
+
+        with mock.patch('analytics.services.parse_osv_rows', side_effect=parse), \
+                mock.patch('analytics.services.save_osv_rows', side_effect=save):
+            process_osv_file(excel_file(osv_rows(5)), self.entity, PERIOD, chunk_size=2)
+        # Разобранные пачки не копятся: в памяти одна пачка независимо от размера файла
+        self.assertEqual(steps, ['parse', 'save'] * 3)
+
+    def test_replace_keeps_old_rows_when_file_is_bad(self):
+        process_osv_file(excel_file(osv_rows(3)), self.entity, PERIOD)
+        with self.assertRaisesMessage(ValueError, "меньше 7 колонок"):
+            process_osv_file(excel_file([["ОСВ"], ["Счет", "Сумма"]] + [["20.00", "Счет"]] * 5), self.entity, PERIOD,
+                             chunk_size=2, replace=True)
+        # Удаление и записанные до ошибки пачки откатываются вместе
+        self.assertEqual(TrialBalance.objects.count(), 3)
+
+        process_osv_file(excel_file(osv_rows(2)), self.entity, PERIOD, replace=True)
+        self.assertEqual(set(TrialBalance.objects.values_list('account_code', flat=True)), {"10.00", "10.01"})
+
+
+class MultiPnLLoaderTests(TestCase):
+
+    def setUp(self):
+        self.entity = Entity.objects.create(name="Филиал")
+
+    def data(self):
+        return {
+            (p.category.name, p.period.month): (p.fact, p.plan)
+            for p in PnLData.objects.select_related('category')
+        }
+
+    def test_fact_plan_format(self):
+        rows = multi_pnl_rows(2) + [
+            ["", "Итого", 5, 5, 5, 5, 5, 5, 5, 5],
+            ["Чистая прибыль / Net profit", None, "x", 3, 0, 0, None, None, 9, 9],
+            [None, None, 0, 0, 0, 0, 0, 0, 0, 0],
+        ]
+        self.assertEqual(process_multi_pnl_file(excel_file(rows), self.entity, 2025), 3)
+
+        data = self.data()
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[("Статья 1", 2)], (Decimal('1000.50'), Decimal('1')))
+        # Строка "Итого", итог за год и нулевые пары факт/план не записываются
+        self.assertEqual(data[("Статья 0", 1)], (Decimal('0.50'), Decimal('0')))
+        self.assertEqual(data[("Чистая прибыль", 1)], (Decimal('0'), Decimal('3')))
+        self.assertNotIn(("Чистая прибыль", 2), data)
+        self.assertNotIn("Итого", {name for name, _ in data})
+
+    def test_month_columns_format(self):
+        rows = [["Отчет"], ["Статья (январь-март)", "янв", "Фев", "март", "итого"]]
+        rows += [["Статья 0", 1, "1 200", None, 9], ["  Количество   студентов ", 4, 0, 2, 6]]
+        self.assertEqual(process_multi_pnl_file(excel_file(rows), self.entity, 2025), 3)
+
+        data = self.data()
+        self.assertEqual(data[("Статья 0", 2)], (Decimal('1200'), Decimal('0')))
+        self.assertNotIn(("Статья 0", 3), data)
+        self.assertEqual(data[("Кол-во заявок на обучение / Number of enrolled students", 3)][0], Decimal('2'))
+
+    def test_reload_replaces_months(self):
+        Category.objects.create(name="Статья 0", order=7, is_total=True)
+        process_multi_pnl_file(excel_file(multi_pnl_rows(3)), self.entity, 2025)
+        process_multi_pnl_file(excel_file(multi_pnl_rows(2)), self.entity, 2025)
+
+        self.assertEqual(PnLData.objects.count(), 6)
+        self.assertEqual(Category.objects.count(), 3)
+        # Порядок существующей статьи задает помесячный ОПУ, годовой файл его не трогает
+        self.assertEqual(Category.objects.values_list('order', 'is_total').get(name="Статья 0"), (7, True))
+
+    def test_unknown_header(self):
+        with self.assertRaises(ValueError):
+            process_multi_pnl_file(excel_file([["Статья", "Сумма"], ["А", 1]]), self.entity, 2025)
+
+    def test_query_count_does_not_depend_on_rows(self):
+        with CaptureQueriesContext(connection) as small:
+            process_multi_pnl_file(excel_file(multi_pnl_rows(3)), self.entity, 2024)
+        with CaptureQueriesContext(connection) as large:
+            process_multi_pnl_file(excel_file(multi_pnl_rows(200, months=MONTHS)), self.entity, 2025)
+
+        self.assertEqual(PnLData.objects.count(), 3 * 3 + 200 * 12)
+        # Растет только число пачек INSERT (в SQLite пачка ограничена числом параметров)
+        def lookups(queries):
+            return [q['sql'] for q in queries if not q['sql'].startswith('INSERT')]
+        self.assertEqual(len(lookups(large.captured_queries)), len(lookups(small.captured_queries)))
+
+
+class ReaderTests(TestCase):
+
+    def test_chunks_keep_sheet_row_numbers(self):
+        rows = iter_rows(excel_file([["Шапка"], ["a", 1], ["b", 2, None, "x"], ["c"]]))
+        head = read_head(rows, 1)
+        chunks = list(read_chunks(rows, start=1, chunk_size=2, columns=6))
+
+        self.assertEqual(head.iloc[0, 0], "Шапка")
+        self.assertEqual([list(chunk.index) for chunk in chunks], [[1, 2], [3]])
+        self.assertEqual(chunks[0].iloc[1].tolist()[:2], ["b", 2])
+        # Короткие строки дополняются до columns пустыми колонками
+        self.assertEqual(chunks[1].shape, (1, 6))
+        self.assertEqual(chunks[1].attrs['width'], 4)
+
+    def test_prepend_starts_first_chunk(self):
+        rows = iter_rows(excel_file([["Шапка"], ["a"], ["b"], ["c"], ["d"]]))
+        head = read_head(rows, 3)
+        chunks = list(read_chunks(rows, start=3, chunk_size=3, prepend=head.iloc[1:]))
+        self.assertEqual([chunk[0].tolist() for chunk in chunks], [["a", "b", "c"], ["d"]])
+        self.assertEqual(list(chunks[0].index), [1, 2, 3])
+
+    def test_csv(self):
+        content = "ОПУ\n\n\nКод,Статья,Факт,План\n1.1,Выручка,\"1 000,5\",3\n".encode('utf-8-sig')
+        upload = SimpleUploadedFile('pnl.csv', content)
+        self.assertEqual(process_pnl_file(upload, Entity.objects.create(name="Филиал"), PERIOD), 2)
+        self.assertEqual(PnLData.objects.get(category__name="Выручка").fact, Decimal('1000.5'))
+        self.assertFalse(upload.closed)
+
+    def test_osv_loaded_in_chunks(self):
+        entity = Entity.objects.create(name="Филиал")
+        rows = osv_rows(5)
+        rows[-1][0] = "10.00"  # повтор счета в следующей пачке перезаписывает предыдущий
+        result = process_osv_file(excel_file(rows), entity, PERIOD, chunk_size=2)
+
+        self.assertEqual(TrialBalance.objects.count(), 4)
+        self.assertEqual(TrialBalance.objects.get(account_code="10.00").account_name, "Счет 4")
+        self.assertEqual(result['rows'], 5)
+
+
+class UploadJobTests(TestCase):
+
+    def setUp(self):
+        self.spool = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.spool, ignore_errors=True)
+        settings = override_settings(INGESTION_SPOOL_DIR=self.spool, INGESTION_WORKERS=0, INGESTION_LOCK_WAIT=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = User.objects.create(username='uploader')
+        self.client.force_login(self.user)
+        self.entity = Entity.objects.create(name="Филиал")
+
+    def post(self, **files):
+        data = {'entity': self.entity.pk, 'year': PERIOD.year, 'month': PERIOD.month, **files}
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('upload_financial_data'), data)
+
+    def test_upload_runs_job(self):
+        response = self.post(file_pnl=excel_file(pnl_rows(3)), file_osv=excel_file(osv_rows(4)))
+        self.assertRedirects(response, reverse('upload_financial_data'))
+
+        jobs = {job.kind: job for job in UploadJob.objects.all()}
+        self.assertEqual({kind: job.status for kind, job in jobs.items()}, {'pnl': 'done', 'osv': 'done'})
+        self.assertEqual((jobs['pnl'].rows, jobs['osv'].rows), (3, 4))
+        self.assertEqual(set(jobs['osv'].timings), {'spool', 'queue', 'lock', 'load'})
+        self.assertEqual((PnLData.objects.count(), TrialBalance.objects.count()), (3, 4))
+        # Копии файлов, маркеры прогресса и блокировки убраны
+        self.assertEqual(list(self.spool.iterdir()), [])
+        self.assertFalse(IngestionLock.objects.exists())
+
+        status = self.client.get(reverse('upload_jobs_status'), {'ids': f"{jobs['pnl'].pk},{jobs['osv'].pk}"}).json()
+        self.assertEqual(sorted(job['rows'] for job in status['jobs']), [3, 4])
+
+    def test_failed_job_keeps_error(self):
+        self.post(file_osv=excel_file([["ОСВ"], ["Счет", "Сумма"]]))
+        job = UploadJob.objects.get()
+        self.assertEqual(job.status, 'failed')
+        self.assertIn("меньше 7 колонок", job.error)
+
+    def test_failed_overwrite_keeps_period_data(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            create_job(excel_file(osv_rows(3)), self.entity, 'osv', PERIOD)
+            create_job(excel_file([["ОСВ"], ["Счет", "Сумма"]]), self.entity, 'osv', PERIOD, overwrite=True)
+        self.assertEqual(list(UploadJob.objects.order_by('id').values_list('status', flat=True)), ['done', 'failed'])
+        self.assertEqual(TrialBalance.objects.count(), 3)
+
+    def test_resubmit_returns_queued_job(self):
+        # Те же байты: xlsx хранит время создания, два вызова excel_file могут дать разные файлы
+        upload = excel_file(pnl_rows(2))
+        first, created = create_job(upload, self.entity, 'pnl', PERIOD, user=self.user)
+        upload.seek(0)
+        second, created_again = create_job(upload, self.entity, 'pnl', PERIOD, user=self.user)
+
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(len(list(self.spool.iterdir())), 1)
+
+    def test_overlapping_period_waits_for_lock(self):
+        annual, _ = create_job(excel_file(multi_pnl_rows(2)), self.entity, 'pnl_multi', date(2025, 1, 1))
+        monthly, _ = create_job(excel_file(pnl_rows(2)), self.entity, 'pnl', PERIOD)
+        UploadJob.objects.filter(pk=annual.pk).update(status='running')
+        acquire_locks(annual)
+
+        # Годовой ОПУ держит все месяцы года: месячная загрузка ОПУ ждет, ОСВ того же месяца — нет
+        job = run_job(monthly.pk)
+        self.assertEqual(job.status, 'failed')
+        self.assertIn("загружается другой задачей", job.error)
+        osv, _ = create_job(excel_file(osv_rows(2)), self.entity, 'osv', PERIOD)
+        self.assertEqual(run_job(osv.pk).status, 'done')
+
+        # Блокировка завершившейся задачи брошена и снимается
+        UploadJob.objects.filter(pk=annual.pk).update(status='failed')
+        monthly_again, _ = create_job(excel_file(pnl_rows(2)), self.entity, 'pnl', PERIOD)
+        self.assertEqual(run_job(monthly_again.pk).status, 'done')
+
+    def test_stale_lock_released_after_ttl(self):
+        holder, _ = create_job(excel_file(pnl_rows(2)), self.entity, 'pnl', PERIOD)
+        UploadJob.objects.filter(pk=holder.pk).update(status='running')
+        acquire_locks(holder)
+        IngestionLock.objects.update(acquired_at=timezone.now() - timedelta(hours=2))
+
+        other = UploadJob(pk=holder.pk + 100, entity=self.entity, kind='pnl', period=PERIOD)
+        with self.assertRaises(LockTimeout):
+            with override_settings(INGESTION_LOCK_TTL=3 * 3600):
+                acquire_locks(other)
+        other.save()
+        acquire_locks(other)
+        self.assertEqual(IngestionLock.objects.get().job_id, other.pk)
+
+
+def zip_file(files, name='month.zip'):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for file_name, content in files.items():
+            archive.writestr(file_name, content if isinstance(content, (str, bytes)) else content.read())
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+class BulkImportTests(TestCase):
+
+    def setUp(self):
+        self.spool = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.spool, ignore_errors=True)
+        settings = override_settings(INGESTION_SPOOL_DIR=self.spool, BULK_IMPORT_WORKERS=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.almaty = Entity.objects.create(name="Алматы")
+        self.astana = Entity.objects.create(name="Астана")
+
+    def test_recognition(self):
+        entities = [self.almaty, self.astana, Entity(name="Алматы Юг")]
+        self.assertEqual(find_entity("Алматы_юг/ОПУ_03.2025.xlsx", entities).name, "Алматы Юг")
+        self.assertEqual(find_entity("almaty.xlsx", entities), None)
+        self.assertEqual(find_kind("Астана osv.xlsx"), 'osv')
+        self.assertEqual(find_kind("ОПУ и ОСВ.xlsx"), None)
+        self.assertEqual(find_period("2025-03_opu.xlsx"), PERIOD)
+        self.assertEqual(find_period("оборотно-сальдовая ведомость за марта 2025 г. сумма 1 2024"), PERIOD)
+        self.assertEqual(find_period("итого 1 2025 000"), None)
+
+    def test_archive_summary(self):
+        archive = zip_file({
+            "Алматы_ОПУ_03.2025.xlsx": excel_file(pnl_rows(3)),
+            "Алматы/ОСВ_03.2025.xlsx": excel_file(osv_rows(4)),
+            # Период — из формы
+            "Астана ОСВ.xlsx": excel_file(osv_rows(2)),
+            "readme.txt": "не отчет",
+        })
+        user = User.objects.create(username='accountant')
+        self.client.force_login(user)
+        response = self.client.post(reverse('bulk_upload_financial_data'),
+                                    {'archive': archive, 'month': PERIOD.month, 'year': PERIOD.year})
+
+        summary = response.context['summary']
+        self.assertEqual((summary['loaded'], summary['failed'], summary['periods'], summary['rows']), (3, 1, 2, 9))
+        self.assertEqual(summary['items'][-1]['error'], "Неподдерживаемый тип файла")
+        self.assertEqual(PnLData.objects.filter(entity=self.almaty, period=PERIOD).count(), 3)
+        self.assertEqual(TrialBalance.objects.filter(entity=self.astana, period=PERIOD).count(), 2)
+        self.assertEqual(set(UploadJob.objects.values_list('status', 'created_by')), {('done', user.pk)})
+        self.assertFalse(IngestionLock.objects.exists())
+        # Распакованные файлы удалены
+        self.assertEqual(list(self.spool.iterdir()), [])
+
+    def test_manifest_and_header(self):
+        archive = zip_file({
+            "manifest.csv": "file;entity;kind;year;month\n1.xlsx;Астана;;2025;3\n2.xlsx;Караганда;osv;2025;3\n",
+            "1.xlsx": excel_file(osv_rows(2)),
+            "2.xlsx": excel_file(osv_rows(2)),
+            # Филиал и период — из шапки листа
+            "3.xlsx": excel_file([["ОПУ филиала Алматы за март 2025"], [], ["Код", "Статья", "Факт", "План"], ["1.1", "Выручка", 10, 12]]),
+            "4.xlsx": excel_file(pnl_rows(1)),
+        })
+        items = {item['name']: item for item in import_archive(archive)['items']}
+
+        self.assertEqual((items['1.xlsx']['status'], items['1.xlsx']['kind']), ('done', 'osv'))
+        self.assertEqual(items['2.xlsx']['error'], "В манифесте не распознаны: филиал")
+        self.assertEqual((items['3.xlsx']['entity'], items['3.xlsx']['period']), (self.almaty, PERIOD))
+        self.assertEqual(items['4.xlsx']['error'], "Не удалось определить филиал")
+        self.assertEqual(PnLData.objects.get(entity=self.almaty).fact, Decimal('10.00'))
+
+    def test_entity_period_is_atomic(self):
+        archive = zip_file({
+            "Алматы ОПУ 03.2025.xlsx": excel_file(pnl_rows(3)),
+            "Алматы ОСВ 03.2025.xlsx": excel_file([["Оборотно-сальдовая ведомость"], ["Счет"]]),
+            "Астана ОПУ 03.2025.xlsx": excel_file(pnl_rows(2)),
+            "Астана ОПУ 2025-03 копия.xlsx": excel_file(pnl_rows(2)),
+        })
+        items = {item['name']: item for item in import_archive(archive)['items']}
+
+        self.assertIn("меньше 7 колонок", items["Алматы ОСВ 03.2025.xlsx"]['error'])
+        self.assertEqual(items["Алматы ОПУ 03.2025.xlsx"]['error'], "Не загружен: ошибка в другом файле этого филиала за период")
+        self.assertEqual(items["Астана ОПУ 03.2025.xlsx"]['error'], "В архиве несколько файлов одного типа за этот период")
+        self.assertFalse(PnLData.objects.exists())
+
+    def test_locked_period_fails(self):
+        holder, _ = create_job(excel_file(pnl_rows(1)), self.almaty, 'pnl', PERIOD)
+        UploadJob.objects.filter(pk=holder.pk).update(status='running')
+        acquire_locks(holder)
+
+        summary = import_archive(zip_file({
+            "Алматы ОПУ 03.2025.xlsx": excel_file(pnl_rows(2)),
+            "Астана ОПУ 03.2025.xlsx": excel_file(pnl_rows(2)),
+        }))
+        self.assertEqual((summary['loaded'], summary['failed']), (1, 1))
+        self.assertEqual(UploadJob.objects.filter(entity=self.almaty, status='failed').count(), 1)
+        self.assertFalse(PnLData.objects.filter(entity=self.almaty).exists())
+
+    def test_process_pool(self):
+        self.addCleanup(lambda: bulk._executor and bulk._executor.shutdown())
+        self.addCleanup(setattr, bulk, '_executor', None)
+        with override_settings(BULK_IMPORT_WORKERS=2):
+            summary = import_archive(zip_file({
+                "Алматы ОПУ 03.2025.xlsx": excel_file(pnl_rows(3)),
+                "Астана ОСВ 03.2025.xlsx": excel_file(osv_rows(4)),
+            }))
+        self.assertEqual((summary['loaded'], summary['rows']), (2, 7))
+        self.assertEqual(PnLData.objects.count() + TrialBalance.objects.count(), 7)
+
+    def test_crashed_pool_is_shut_down(self):
+        def submit(*args):
+            future = Future()
+            future.set_exception(BrokenProcessPool("воркер упал"))
+            return future
+
+        broken = mock.Mock(submit=submit)
+        self.addCleanup(setattr, bulk, '_executor', None)
+        bulk._executor = broken
+        items = [{'path': 'a.xlsx', 'kind': 'pnl'}, {'path': 'b.xlsx', 'kind': 'osv'}]
+        with override_settings(BULK_IMPORT_WORKERS=2):
+            results = list(bulk.parse_items(items))
+
+        self.assertEqual([result['error'] for _, result in results], ["Сбой процесса разбора: BrokenProcessPool"] * 2)
+        # Процессы сломанного пула погашены, следующий импорт создаст новый
+        broken.shutdown.assert_called_with(wait=False, cancel_futures=True)
+        self.assertIsNone(bulk._executor)
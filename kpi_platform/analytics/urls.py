@@ -1,6 +1,8 @@
 from django.urls import path
 from .views import (
     upload_financial_data,
+    upload_jobs_status,
+    bulk_upload_financial_data,
     EntityListView,
     EntityCreateView,
     EntityUpdateView,
@@ -25,6 +27,8 @@ urlpatterns = [
     path('annual_analytics/', annual_analytics, name='annual_analytics'),
     path('cash_flow/', cash_flow_analytics, name='cash_flow'),
     path('upload/', upload_financial_data, name='upload_financial_data'),
+    path('upload/jobs/', upload_jobs_status, name='upload_jobs_status'),
+    path('upload/bulk/', bulk_upload_financial_data, name='bulk_upload_financial_data'),
     # Справочник филиалов
     path('entities/', EntityListView.as_view(), name='entity_list'),
     path('entities/add/', EntityCreateView.as_view(), name='entity_create'),
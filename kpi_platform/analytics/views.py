@@ -1,10 +1,13 @@
 from django.shortcuts import render, redirect
+from django.http import JsonResponse
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from .forms import UploadFinanceForm
+from .forms import BulkUploadForm, UploadFinanceForm
+from .bulk import import_archive
 from django.db.models.functions import TruncMonth
-from .services import process_pnl_file, process_osv_file
-from .models import Entity, PnLData, TrialBalance, Category
+from .ingestion import create_job, job_state
+from .readers import iter_rows, read_head
+from .models import Entity, PnLData, TrialBalance, Category, UploadJob
 from datetime import datetime
 from django.views.generic import ListView, CreateView, UpdateView, DeleteView
 from django.urls import reverse_lazy
@@ -18,159 +21,7 @@ import numpy as np
 from django.contrib.auth.mixins import LoginRequiredMixin
 import re
 from django.db import transaction
-
-
-# Словарик для перевода русских месяцев в числа
-RUS_MONTHS = {
-    'янв': 1, 'фев': 2, 'мар': 3, 'апр': 4, 'май': 5, 'июн': 6,
-    'июл': 7, 'авг': 8, 'сен': 9, 'окт': 10, 'ноя': 11, 'дек': 12
-}
-# Словарь синонимов для объединения категорий
-CATEGORY_MAPPING = {
-    # Слушатели
-    "количество слушателей / number of students": "Кол-во заявок на обучение / Number of enrolled students",
-    "количество слушателей": "Кол-во заявок на обучение / Number of enrolled students",
-    "количество студентов": "Кол-во заявок на обучение / Number of enrolled students",
-
-    # Прибыль
-    "чистая прибыль / net profit": "Чистая прибыль",
-    "итого чистая прибыль": "Чистая прибыль",
-}
-
-
-def normalize_category_name(raw_name):
-    """Очищает строку и заменяет синонимы на эталонные названия."""
-    if not raw_name: return ""
-    # Убираем лишние пробелы и переносы строк внутри текста
-    clean_name = " ".join(str(raw_name).split())
-    # Ищем в маппинге (в нижнем регистре для точности)
-    lookup_name = clean_name.lower()
-    return CATEGORY_MAPPING.get(lookup_name, clean_name)
-
-
-def force_float(val):
-    """Преобразует строку/число из Excel в float."""
-    if pd.isna(val): return 0.0
-    if isinstance(val, (int, float)): return float(val)
-    s = str(val).replace('\xa0', '').replace(' ', '').replace(',', '.')
-    s = re.sub(r'[^\d\.\-]', '', s)
-    try:
-        return float(s) if s else 0.0
-    except:
-        return 0.0
-
-
-def process_multi_pnl_file(file, entity, year):
-    # Читаем все листы или первый
-    df = pd.read_excel(file, header=None)
-
-    # 1. Поиск шапки и определение формата
-    header_idx = None
-    is_split_format = False  # True если есть Факт/План
-
-    for i, row in df.iterrows():
-        row_str = " ".join([str(x).lower() for x in row.values if not pd.isna(x)])
-        # Проверяем первый формат (Факт + План)
-        if 'факт' in row_str and 'план' in row_str:
-            header_idx = i
-            is_split_format = True
-            break
-        # Проверяем второй формат (Школа - просто месяцы)
-        if 'январь' in row_str or 'февраль' in row_str:
-            header_idx = i
-            is_split_format = False
-            break
-
-    if header_idx is None:
-        print("ОШИБКА: Не удалось распознать формат заголовка.")
-        return 0
-
-    # 2. Определение колонок месяцев
-    month_configs = []
-
-    if is_split_format:
-        # ЛОГИКА ФОРМАТА 1 (Месяцы строкой выше)
-        months_row = df.iloc[header_idx - 1]
-        columns_row = df.iloc[header_idx]
-        current_m = None
-        for col_idx in range(len(columns_row)):
-            cell_m = str(months_row.iloc[col_idx]).lower().strip()
-            for m_name, m_num in RUS_MONTHS.items():
-                if m_name in cell_m:
-                    current_m = m_num
-
-            col_name = str(columns_row.iloc[col_idx]).lower().strip()
-            if col_name == 'факт' and current_m:
-                if 'итого' not in cell_m:
-                    month_configs.append({'month': current_m, 'f': col_idx, 'p': col_idx + 1})
-    else:
-        # ЛОГИКА ФОРМАТА 2 (Месяцы в той же строке, что и статьи)
-        header_row = df.iloc[header_idx]
-        for col_idx in range(len(header_row)):
-            cell_val = str(header_row.iloc[col_idx]).lower().strip()
-            for m_name, m_num in RUS_MONTHS.items():
-                if m_name == cell_val:  # Прямое совпадение месяца
-                    month_configs.append({'month': m_num, 'f': col_idx, 'p': None})
-
-    # 3. Сбор и сохранение данных
-    with transaction.atomic():
-        target_months = [cfg['month'] for cfg in month_configs]
-        PnLData.objects.filter(
-            entity=entity,
-            period__year=year,
-            period__month__in=target_months
-        ).delete()
-
-        data_rows = df.iloc[header_idx + 1:]
-        to_create = []
-
-        for _, row in data_rows.iterrows():
-            # 1. Более агрессивное получение названия статьи
-            # Проверяем колонку 0, если там пусто — берем 1, и наоборот
-            c0 = str(row.iloc[0]).strip() if not pd.isna(row.iloc[0]) else ""
-            c1 = str(row.iloc[1]).strip() if not pd.isna(row.iloc[1]) else ""
-
-            # Выбираем самое длинное/содержательное значение из первых двух колонок
-            raw_cat_name = c0 if len(c0) >= len(c1) else c1
-
-            # Очищаем от технических артефактов
-            if not raw_cat_name or raw_cat_name.lower() in ['nan', 'none', 'факт', 'план']:
-                continue
-
-            # 2. НОРМАЛИЗАЦИЯ (теперь учитываем "Чистую прибыль")
-            final_cat_name = normalize_category_name(raw_cat_name)
-
-            # УБИРАЕМ "итого" из фильтрации, если это важная статья
-            # Если строка называется просто "Итого" - скипаем,
-            # но если "Итого чистая прибыль" - оставляем.
-            if final_cat_name.lower() == 'итого':
-                continue
-
-            category_obj, _ = Category.objects.get_or_create(name=final_cat_name)
-
-            for cfg in month_configs:
-                f_val = force_float(row.iloc[cfg['f']])
-                # Если во втором формате нет колонки плана, ставим 0
-                p_val = force_float(row.iloc[cfg['p']]) if cfg['p'] is not None else 0.0
-
-                if f_val == 0 and p_val == 0:
-                    continue
-
-                to_create.append(PnLData(
-                    entity=entity,
-                    period=date(year, cfg['month'], 1),
-                    category=category_obj,
-                    fact=f_val,
-                    plan=p_val
-                ))
-
-        if to_create:
-            PnLData.objects.bulk_create(to_create)
-            print(f"УСПЕХ: Записано {len(to_create)} строк для {len(target_months)} мес.")
-        else:
-            print("ВНИМАНИЕ: Данные для записи не найдены.")
-
-    return len(target_months)
+from core.utils import month_bounds, year_bounds
 
 
 @login_required
@@ -187,50 +38,81 @@ def upload_financial_data(request):
 
             if not is_multi_month and not month_val:
                 messages.error(request, "Выберите месяц для одиночной загрузки.")
-                return render(request, 'analytics/upload.html', {'form': form})
+                return render(request, 'analytics/upload.html', {'form': form, 'jobs': recent_upload_jobs(request.user)})
 
-            # Обработка ОПУ
+            # Файлы только сохраняются и ставятся в очередь, разбор идет в фоне (analytics.ingestion)
+            jobs = []
             if 'file_pnl' in request.FILES:
-                f_pnl = request.FILES['file_pnl']
-                try:
-                    if is_multi_month:
-                        count = process_multi_pnl_file(f_pnl, entity, year)
-                        messages.success(request, f"Успешно загружено месяцев: {count}")
-                    else:
-                        period = date(year, int(month_val), 1)
-                        if overwrite:
-                            PnLData.objects.filter(entity=entity, period=period).delete()
-                        # Убедитесь, что внутри process_pnl_file тоже используются поля category, fact, plan
-                        process_pnl_file(f_pnl, entity, period)
-                        messages.success(request, f"ОПУ загружен за {month_val}.{year}")
-                except Exception as e:
-                    messages.error(request, f"Ошибка ОПУ: {str(e)}")
-
-            # Обработка ОСВ
+                if is_multi_month:
+                    kind, period = 'pnl_multi', date(year, 1, 1)
+                else:
+                    kind, period = 'pnl', date(year, int(month_val), 1)
+                jobs.append(create_job(request.FILES['file_pnl'], entity, kind, period, overwrite, request.user))
+
             if 'file_osv' in request.FILES:
-                period = date(year, int(month_val), 1) if month_val else None
-                if period:
-                    if overwrite:
-                        TrialBalance.objects.filter(entity=entity, period=period).delete()
-                    process_osv_file(request.FILES['file_osv'], entity, period)
-                    messages.success(request, f"ОСВ загружена.")
+                if month_val:
+                    period = date(year, int(month_val), 1)
+                    jobs.append(create_job(request.FILES['file_osv'], entity, 'osv', period, overwrite, request.user))
+                else:
+                    messages.error(request, "ОСВ загружается за один месяц — выберите месяц.")
+
+            for job, created in jobs:
+                if created:
+                    messages.info(request, f"{job.get_kind_display()}: файл {job.file_name} поставлен в очередь.")
+                else:
+                    messages.warning(request, f"Файл {job.file_name} уже загружается — повторная отправка пропущена.")
 
             return redirect('upload_financial_data')
     else:
         form = UploadFinanceForm()
 
-    return render(request, 'analytics/upload.html', {'form': form})
+    return render(request, 'analytics/upload.html', {'form': form, 'jobs': recent_upload_jobs(request.user)})
+
+
+def recent_upload_jobs(user, limit=10):
+    return list(UploadJob.objects.filter(created_by=user).select_related('entity').order_by('-created_at')[:limit])
+
+
+@login_required
+def upload_jobs_status(request):
+    """Состояние загрузок пользователя для опроса со страницы загрузки: ?ids=1,2,3"""
+    ids = [int(value) for value in request.GET.get('ids', '').split(',') if value.isdigit()][:50]
+    jobs = UploadJob.objects.filter(pk__in=ids, created_by=request.user).select_related('entity')
+    return JsonResponse({'jobs': [job_state(job) for job in jobs]})
+
+
+@login_required
+def bulk_upload_financial_data(request):
+    """Архив с файлами многих филиалов за месяц: разбор параллельно, итог — сводка по файлам."""
+    summary = None
+    if request.method == 'POST':
+        form = BulkUploadForm(request.POST, request.FILES)
+        if form.is_valid():
+            summary = import_archive(
+                form.cleaned_data['archive'],
+                default_period=form.cleaned_data['default_period'],
+                overwrite=form.cleaned_data['overwrite'],
+                user=request.user,
+            )
+            if summary['failed']:
+                messages.warning(request, f"Загружено файлов: {summary['loaded']}, с ошибками: {summary['failed']}.")
+            else:
+                messages.success(request, f"Загружено файлов: {summary['loaded']} за {summary['seconds']:.1f} с.")
+    else:
+        form = BulkUploadForm()
+
+    return render(request, 'analytics/bulk_upload.html', {'form': form, 'summary': summary})
 
 
 @login_required
 def validate_file_type(file, expected_type):
     try:
-        # Читаем первые 30 строк без заголовков
-        df = pd.read_excel(file, nrows=30, header=None)
+        # Читаем первые 30 строк без заголовков (потоково — остальной файл не загружается)
+        df = read_head(iter_rows(file), 30)
 
-        # Превращаем в список строк, убирая пустые значения (nan)
-        flat_list = df.astype(str).values.flatten()
-        all_text = " ".join([str(x) for x in flat_list if str(x).lower() != 'nan']).lower()
+        # Превращаем в список строк, убирая пустые значения
+        flat_list = df.values.flatten()
+        all_text = " ".join([str(x) for x in flat_list if not pd.isna(x)]).lower()
 
         # Убираем лишние пробелы и переносы
         all_text = re.sub(r'\s+', ' ', all_text)
@@ -441,18 +323,27 @@ def upload_audit_calendar(request):
     entities = Entity.objects.all()
     months = range(1, 13)
 
+    # Наличие ОПУ и ОСВ за год — по одному запросу на таблицу вместо 24 на филиал
+    year_start, year_end = year_bounds(year)
+    pnl_months = {
+        (entity_id, period.month) for entity_id, period in
+        PnLData.objects.filter(period__gte=year_start, period__lt=year_end)
+        .values_list('entity_id', 'period').distinct()
+    }
+    osv_months = {
+        (entity_id, period.month) for entity_id, period in
+        TrialBalance.objects.filter(period__gte=year_start, period__lt=year_end)
+        .values_list('entity_id', 'period').distinct()
+    }
+
     audit_data = []
     for entity in entities:
         entity_months = []
         for month in months:
-            # Проверяем наличие ОПУ и ОСВ за конкретный год и месяц
-            has_pnl = PnLData.objects.filter(entity=entity, period__year=year, period__month=month).exists()
-            has_osv = TrialBalance.objects.filter(entity=entity, period__year=year, period__month=month).exists()
-
             entity_months.append({
                 'month': month,
-                'has_pnl': has_pnl,
-                'has_osv': has_osv,
+                'has_pnl': (entity.id, month) in pnl_months,
+                'has_osv': (entity.id, month) in osv_months,
             })
         audit_data.append({
             'entity': entity,
@@ -567,23 +458,26 @@ def annual_analytics(request):
     global_trends = {}
 
     for cat_key, db_names in synonyms_map.items():
-        m_vals = []
-        for m in months:
-            # Ищем по полю name в связанной модели Category
-            val = historical_data.filter(
-                period__month=m,
-                category__name__in=db_names
-            ).aggregate(total=Sum('fact'))['total'] or 0
-            m_vals.append(float(val))
+        # Суммы по периодам одним запросом, раскладываем по месяцам года уже в Python
+        # (period__month оборачивает колонку в функцию и не дает использовать индекс)
+        by_month = dict.fromkeys(months, 0.0)
+        period_totals = historical_data.filter(
+            category__name__in=db_names
+        ).order_by().values('period').annotate(total=Sum('fact'))
+        for row in period_totals:
+            if row['period'].month in by_month:
+                by_month[row['period'].month] += float(row['total'] or 0)
+        m_vals = [by_month[m] for m in months]
 
         total_mean = np.mean(m_vals) if np.mean(m_vals) != 0 else 1
         seasonality_map[cat_key] = [v / total_mean for v in m_vals]
 
         # База прогноза (предыдущий год)
-        last_year = date.today().year - 1
+        last_year_start, last_year_end = year_bounds(date.today().year - 1)
         last_year_avg = historical_data.filter(
             category__name__in=db_names,
-            period__year=last_year
+            period__gte=last_year_start,
+            period__lt=last_year_end
         ).aggregate(avg=Sum('fact'))['avg']
 
         if last_year_avg:
@@ -708,13 +602,15 @@ def cash_flow_analytics(request):
     last_trends = {}
 
     for key, cfg in cash_categories.items():
-        m_vals = []
-        for m in months:
-            qs = TrialBalance.objects.filter(period__month=m)
-            if entity_id: qs = qs.filter(entity_id=entity_id)
-            final_qs = get_filtered_qs(qs, cfg['code'], cfg['field'])
-            val = float(final_qs.aggregate(total=Sum(cfg['field']))['total'] or 0)
-            m_vals.append(val)
+        # Один сгруппированный по периодам запрос вместо 12 с period__month
+        qs = TrialBalance.objects.all()
+        if entity_id: qs = qs.filter(entity_id=entity_id)
+        final_qs = get_filtered_qs(qs, cfg['code'], cfg['field'])
+        by_month = dict.fromkeys(months, 0.0)
+        for row in final_qs.order_by().values('period').annotate(total=Sum(cfg['field'])):
+            if row['period'].month in by_month:
+                by_month[row['period'].month] += float(row['total'] or 0)
+        m_vals = [by_month[m] for m in months]
 
         avg_val = np.mean(m_vals) if np.mean(m_vals) > 0 else 1
         seasonality_map[key] = [v / avg_val for v in m_vals]
@@ -4,6 +4,5 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     name = "core"
 
-
-def ready(self):
-    from . import signals
\ No newline at end of file
+    def ready(self):
+        from . import signals
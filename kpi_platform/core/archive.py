@@ -0,0 +1,207 @@
+"""
+Архив AuditLog: старые записи переносятся из таблицы в сжатые файлы по месяцам.
+
+Файл месяца — AUDIT_ARCHIVE_DIR/auditlog-YYYY-MM.jsonl.gz, одна запись на строку.
+Каждый прогон дописывает в файл отдельный gzip-член (gzip.open читает их подряд),
+после чего строки удаляются из таблицы. Если процесс упал между записью и удалением,
+повторный прогон допишет те же строки еще раз — при чтении дубликаты по id отбрасываются,
+а до повторного прогона лента показывает такие записи из таблицы.
+
+audit_page() листает историю по ключу (timestamp, id): сначала горячая таблица,
+затем, когда она исчерпана, архивные месяцы — для просмотра это одна лента.
+"""
+import gzip
+import json
+import os
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import lru_cache
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from users.models import User
+from .models import AuditLog
+
+
+ARCHIVE_FILE_RE = re.compile(r'^auditlog-(?P<month>\d{4}-\d{2})\.jsonl\.gz$')
+ARCHIVE_FIELDS = ('id', 'user_id', 'action', 'model_name', 'object_id', 'timestamp', 'changes', 'diff')
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def archive_dir():
+    path = Path(settings.AUDIT_ARCHIVE_DIR)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def archive_path(month):
+    return archive_dir() / f"auditlog-{month:%Y-%m}.jsonl.gz"
+
+
+def archived_months():
+    """Месяцы, по которым есть архив, от новых к старым."""
+    months = []
+    for name in os.listdir(archive_dir()):
+        match = ARCHIVE_FILE_RE.match(name)
+        if match:
+            months.append(datetime.strptime(match['month'], '%Y-%m').date())
+    return sorted(months, reverse=True)
+
+
+def archive_cutoff(months):
+    """Начало месяца, отстоящего на months назад от текущего: все, что раньше, уходит в архив."""
+    today = datetime.now(dt_timezone.utc).date().replace(day=1)
+    year, month = divmod(today.year * 12 + today.month - 1 - months, 12)
+    return datetime(year, month + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def archive_audit_log(before, batch_size=5000):
+    """
+    Переносит записи с timestamp < before в архив пачками по batch_size.
+    Возвращает {месяц: число записей}.
+    """
+    moved = {}
+    while True:
+        with transaction.atomic():
+            rows = list(
+                AuditLog.objects.filter(timestamp__lt=before)
+                .order_by('id')
+                .values(*ARCHIVE_FIELDS)[:batch_size]
+            )
+            if not rows:
+                break
+
+            by_month = {}
+            for row in rows:
+                by_month.setdefault(row['timestamp'].date().replace(day=1), []).append(row)
+                # Полная точность (DjangoJSONEncoder обрезает до миллисекунд, а по timestamp идет курсор)
+                row['timestamp'] = row['timestamp'].isoformat()
+            for month, month_rows in by_month.items():
+                lines = ''.join(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n' for row in month_rows)
+                with gzip.open(archive_path(month), 'at', encoding='utf-8') as f:
+                    f.write(lines)
+                moved[month] = moved.get(month, 0) + len(month_rows)
+
+            # Удаляем только после того, как строки легли на диск
+            AuditLog.objects.filter(id__in=[row['id'] for row in rows]).delete()
+    return moved
+
+
+@lru_cache(maxsize=4)
+def _read_month(path, mtime):
+    """Записи архивного месяца от новых к старым (кэш по пути и времени изменения файла)."""
+    rows = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            row = json.loads(line)
+            row['timestamp'] = parse_datetime(row['timestamp'])
+            rows[row['id']] = row
+    return sorted(rows.values(), key=lambda r: (r['timestamp'], r['id']), reverse=True)
+
+
+def read_archived_month(month):
+    path = archive_path(month)
+    if not path.exists():
+        return []
+    return _read_month(str(path), path.stat().st_mtime_ns)
+
+
+def encode_cursor(timestamp, pk):
+    micros = (timestamp - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}-{pk}"
+
+
+def decode_cursor(value):
+    try:
+        micros, pk = value.split('-')
+        return EPOCH + timedelta(microseconds=int(micros)), int(pk)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def _matches(row, filters, cursor):
+    if filters.get('model_name') and row['model_name'] != filters['model_name']:
+        return False
+    if filters.get('object_id') and row['object_id'] != filters['object_id']:
+        return False
+    if filters.get('user_id') and row['user_id'] != filters['user_id']:
+        return False
+    if filters.get('date_from') and row['timestamp'] < filters['date_from']:
+        return False
+    if filters.get('date_to') and row['timestamp'] >= filters['date_to']:
+        return False
+    if cursor and (row['timestamp'], row['id']) >= cursor:
+        return False
+    return True
+
+
+def _archived_rows(filters, cursor, needed):
+    """
+    До needed архивных записей после курсора, от новых к старым. Записи, которые еще лежат
+    в таблице (прогон архивации прервался между записью файла и удалением), пропускаются —
+    таблица их уже показала.
+    """
+    rows = []
+    for month in archived_months():
+        if cursor and month > cursor[0].date():
+            continue
+        if filters.get('date_to') and month >= filters['date_to'].date():
+            continue
+        if filters.get('date_from') and month < filters['date_from'].date().replace(day=1):
+            break
+        matching = (row for row in read_archived_month(month) if _matches(row, filters, cursor))
+        while len(rows) < needed:
+            chunk = list(islice(matching, needed - len(rows)))
+            if not chunk:
+                break
+            in_table = set(AuditLog.objects.filter(id__in=[row['id'] for row in chunk]).values_list('id', flat=True))
+            rows += [row for row in chunk if row['id'] not in in_table]
+        if len(rows) >= needed:
+            break
+    return rows
+
+
+def audit_page(filters, before=None, limit=50):
+    """
+    Страница истории (новые сверху) из таблицы и архива.
+    filters: model_name, object_id, user_id, date_from, date_to (aware datetime, правая граница не включается).
+    Возвращает (записи AuditLog, курсор следующей страницы или None). У архивных записей archived=True.
+    """
+    cursor = decode_cursor(before) if before else None
+
+    qs = AuditLog.objects.select_related('user')
+    if filters.get('model_name'):
+        qs = qs.filter(model_name=filters['model_name'])
+    if filters.get('object_id'):
+        qs = qs.filter(object_id=filters['object_id'])
+    if filters.get('user_id'):
+        qs = qs.filter(user_id=filters['user_id'])
+    if filters.get('date_from'):
+        qs = qs.filter(timestamp__gte=filters['date_from'])
+    if filters.get('date_to'):
+        qs = qs.filter(timestamp__lt=filters['date_to'])
+    if cursor:
+        qs = qs.filter(Q(timestamp__lt=cursor[0]) | Q(timestamp=cursor[0], id__lt=cursor[1]))
+
+    page = list(qs.order_by('-timestamp', '-id')[:limit + 1])
+    for entry in page:
+        entry.archived = False
+
+    if len(page) <= limit:
+        # Горячая таблица закончилась — продолжаем по архиву (он целиком старше таблицы)
+        archived_rows = _archived_rows(filters, cursor, limit + 1 - len(page))
+        users = User.objects.in_bulk({row['user_id'] for row in archived_rows if row['user_id']})
+        for row in archived_rows:
+            entry = AuditLog(**{field: row[field] for field in ARCHIVE_FIELDS})
+            entry.user = users.get(row['user_id'])
+            entry.archived = True
+            page.append(entry)
+
+    next_cursor = encode_cursor(page[limit - 1].timestamp, page[limit - 1].id) if len(page) > limit else None
+    return page[:limit], next_cursor
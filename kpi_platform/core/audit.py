@@ -0,0 +1,108 @@
+"""
+Буферизованная запись AuditLog с пополевым diff.
+
+Записи не вставляются по одной внутри каждого save(): record() кладет их в пачку
+текущей транзакции (core.dispatch), и они уходят одним bulk_create после коммита
+или раньше — как только в пачке наберется AUDIT_BUFFER_SIZE записей.
+
+Diff хранится в AuditLog.diff как {"поле": [старое, новое]}. Исходные значения
+берутся из снимка, сделанного при загрузке объекта из БД (track_original),
+поэтому лишних запросов на аудит нет. Пользователь подставляется из
+AuditUserMiddleware (core.middleware), если не передан явно.
+"""
+import json
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .dispatch import dispatch
+from .models import AuditLog
+
+
+current_request = ContextVar('audit_current_request', default=None)
+
+
+def current_user():
+    """Аутентифицированный пользователь текущего запроса или None (команды, фоновые задачи)."""
+    request = current_request.get()
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user
+    return None
+
+
+def track_original(instance):
+    """Запоминает значения полей объекта (post_init для объектов с pk и после каждого save)."""
+    instance._audit_original = {
+        field.attname: instance.__dict__.get(field.attname)
+        for field in instance._meta.concrete_fields
+    }
+
+
+def _jsonable(value):
+    # Даты, Decimal и т.п. приводим к тому виду, в каком они окажутся в JSONField
+    return json.loads(json.dumps(value, cls=DjangoJSONEncoder))
+
+
+def _is_default(field, value):
+    return value == field.get_default() or (value in (None, '') and field.get_default() in (None, ''))
+
+
+def field_diff(instance, created=False, deleted=False):
+    """
+    {attname: [старое, новое]} только по изменившимся полям.
+    Для созданного объекта старое — None, для удаленного новое — None; в обоих случаях
+    пишутся только поля со значением не по умолчанию, без id и полей, которые
+    вычисляются сами (editable=False: даты создания, хранимые баллы).
+    """
+    original = getattr(instance, '_audit_original', None) or {}
+    # Отложенные (.only()/.defer()) поля не загружены и не сохраняются — в diff их нет
+    deferred = instance.get_deferred_fields()
+    diff = {}
+    for field in instance._meta.concrete_fields:
+        name = field.attname
+        if name in deferred:
+            continue
+        current = getattr(instance, name)
+        if created or deleted:
+            value = original.get(name, current) if deleted else current
+            if field.primary_key or not field.editable or _is_default(field, value):
+                continue
+            old, new = (value, None) if deleted else (None, value)
+        else:
+            old, new = original.get(name), current
+        if old != new and not (old in (None, '') and new in (None, '')):
+            diff[name] = [_jsonable(old), _jsonable(new)]
+    return diff
+
+
+def write_audit_logs(entries):
+    """Записывает накопленные записи аудита одним INSERT"""
+    AuditLog.objects.bulk_create(entries)
+
+
+def record(action, model_name, object_id, changes='', diff=None, user=None):
+    """Ставит запись аудита в буфер текущей транзакции/запроса."""
+    dispatch(write_audit_logs, AuditLog(
+        user=user or current_user(),
+        action=action,
+        model_name=model_name,
+        object_id=object_id,
+        changes=changes,
+        diff=diff or {},
+    ), max_batch=getattr(settings, 'AUDIT_BUFFER_SIZE', 200))
+
+
+def record_instance(instance, action, created=False, deleted=False, user=None):
+    """
+    Аудит сохранения/удаления объекта. Сохранение без изменений полей не пишется.
+    Возвращает False, если запись пропущена.
+    """
+    diff = field_diff(instance, created=created, deleted=deleted)
+    if not diff and not created and not deleted:
+        return False
+    record(action, type(instance).__name__, instance.pk, changes=str(instance), diff=diff, user=user)
+    if not deleted:
+        track_original(instance)
+    return True
@@ -0,0 +1,318 @@
+"""
+Нагрузочный стенд: синтетические данные заданного масштаба и замеры тяжелых страниц.
+
+seed(scale) заполняет БД через bulk_create: отделы, должности, сотрудники с цепочкой
+руководителей, KPI с индикаторами и бонусами за несколько месяцев, филиалы с ОПУ и ОСВ.
+Масштаб 1 — 5 отделов по 20 сотрудников и 3 филиала; отделы и филиалы растут линейно.
+
+run_scenarios() прогоняет сценарии (страницы и загрузчики файлов) и для каждого
+возвращает время (лучший из repeat прогонов), число запросов и пик памяти Python
+(tracemalloc). Каждый прогон идет в транзакции с откатом, поэтому загрузчики
+не меняют данные между прогонами. Сравнение с сохраненными результатами — compare().
+"""
+import io
+import json
+import random
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import date, timedelta
+
+import pandas as pd
+from django.contrib.auth.hashers import make_password
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import Client
+
+from analytics.models import Category, Entity, PnLData, TrialBalance
+from kpi.models import KPI, Indicator, KPIBonus, open_lineages
+from users.models import Department, Position, User
+
+
+SCALE_UNIT = {
+    'departments': 5,
+    'employees_per_department': 20,
+    'kpis_per_employee': 3,
+    'indicators_per_kpi': 4,
+    'entities': 3,
+    'categories': 40,
+    'accounts': 60,
+}
+KPI_MONTHS = 3
+FINANCE_YEAR = date.today().year - 1
+
+# Статьи, которые ищут annual_analytics и cash_flow_analytics
+NAMED_CATEGORIES = ["ИТОГО ПРОДАЖИ / Total sales", "Чистая прибыль", "Количество слушателей"]
+NAMED_ACCOUNTS = [
+    ('1.01.10', "Касса"), ('1.01.11', "Касса валютная"), ('1.01.30', "Переводы в пути"),
+    ('1.02.10', "Банк"), ('1.02.50', "Банк валютный"),
+]
+MONTH_NAMES = ["Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
+               "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь"]
+INDICATOR_STATUSES = ['draft', 'on_review', 'approved', 'approved', 'rejected']
+
+
+def scaled(name, scale):
+    return max(1, round(SCALE_UNIT[name] * scale)) if name in ('departments', 'entities') else SCALE_UNIT[name]
+
+
+def kpi_months():
+    """Последние KPI_MONTHS месяцев, включая текущий."""
+    month = date.today().replace(day=1)
+    months = [month]
+    for _ in range(KPI_MONTHS - 1):
+        month = (month - timedelta(days=1)).replace(day=1)
+        months.append(month)
+    return sorted(months)
+
+
+def seed(scale=1, random_seed=42, batch_size=2000):
+    """Заполняет БД данными масштаба scale. Возвращает число созданных строк по моделям."""
+    from kpi.rollups import rebuild_rollups
+    from kpi.services import refresh_kpi_scores
+    from kpi.snapshots import refresh_month_snapshots
+
+    rng = random.Random(random_seed)
+    months = kpi_months()
+    password = make_password(None)
+    counts = {}
+
+    with transaction.atomic():
+        departments = Department.objects.bulk_create([
+            Department(name=f"bench-dept-{d}") for d in range(scaled('departments', scale))
+        ])
+        positions = Position.objects.bulk_create([
+            Position(name=f"bench-{kind}-{dept.pk}", department=dept)
+            for dept in departments for kind in ('head', 'staff')
+        ])
+        head_positions, staff_positions = positions[::2], positions[1::2]
+
+        # Цепочка руководителей: директор -> руководители отделов -> сотрудники
+        # Номер прогона в логинах: seed можно запускать повторно на той же БД
+        run = User.objects.filter(role='admin', username__startswith='bench-').count()
+        ceo = User.objects.create(username=f"bench-{run}-ceo", role='admin', password=password)
+        heads = User.objects.bulk_create([
+            User(username=f"{ceo.username}-head-{dept.pk}", role='dept_head', department=dept,
+                 position=position, superior=ceo, password=password)
+            for dept, position in zip(departments, head_positions)
+        ])
+        employees = User.objects.bulk_create([
+            User(username=f"{head.username}-{e}", role='employee', department=head.department,
+                 position=position, superior=head, password=password)
+            for head, position in zip(heads, staff_positions)
+            for e in range(SCALE_UNIT['employees_per_department'])
+        ], batch_size=batch_size)
+        counts['users'] = 1 + len(heads) + len(employees)
+
+        indicator_names = [f"Показатель {i}" for i in range(SCALE_UNIT['indicators_per_kpi'])]
+        kpis = [
+            KPI(name=f"KPI {k}", period='monthly', target_type='employee', employee=employee, for_month=month)
+            for month in months for employee in heads + employees
+            for k in range(SCALE_UNIT['kpis_per_employee'])
+        ] + [
+            KPI(name=f"KPI отдела {dept.name}", period='monthly', target_type='department',
+                department=dept, for_month=month)
+            for month in months for dept in departments
+        ]
+        kpis = KPI.objects.bulk_create(kpis, batch_size=batch_size)
+        open_lineages(kpis, batch_size=batch_size)
+
+        indicators = []
+        weight = 100 // len(indicator_names)
+        for kpi in kpis:
+            for name in indicator_names:
+                quantitative, qualitative = rng.uniform(50, 130), rng.uniform(50, 130)
+                indicators.append(Indicator(
+                    kpi=kpi, name=name, indicator_type='percent', plan_value=100, weight=weight,
+                    status=rng.choice(INDICATOR_STATUSES) if kpi.employee_id else 'draft',
+                    fact_quantitative=quantitative, fact_qualitative=qualitative,
+                    weighted_score=(quantitative + qualitative) / 2 * weight / 100,
+                ))
+        Indicator.objects.bulk_create(indicators, batch_size=batch_size)
+        KPIBonus.objects.bulk_create([
+            KPIBonus(kpi=kpi, target_amount=rng.choice([50000, 100000, 150000]))
+            for kpi in kpis if kpi.employee_id
+        ], batch_size=batch_size)
+        refresh_kpi_scores([kpi.pk for kpi in kpis])
+        rebuild_rollups()
+        for month in months:
+            refresh_month_snapshots(month)
+        counts['kpis'] = len(kpis)
+        counts['indicators'] = len(indicators)
+
+        entities = Entity.objects.bulk_create([
+            Entity(name=f"bench-entity-{e}", is_hq=(e == 0)) for e in range(scaled('entities', scale))
+        ])
+        # Справочник статей общий: повторный seed не плодит дубликаты
+        category_names = NAMED_CATEGORIES + [f"bench-category-{c}" for c in range(SCALE_UNIT['categories'])]
+        existing = set(Category.objects.filter(name__in=category_names).values_list('name', flat=True))
+        Category.objects.bulk_create([
+            Category(name=name, order=i) for i, name in enumerate(category_names) if name not in existing
+        ])
+        categories = list(Category.objects.filter(name__in=category_names))
+        finance_months = [date(FINANCE_YEAR, m, 1) for m in range(1, 13)]
+        pnl = PnLData.objects.bulk_create([
+            PnLData(entity=entity, category=category, period=period,
+                    plan=rng.randint(1000, 100000), fact=rng.randint(1000, 100000))
+            for entity in entities for category in categories for period in finance_months
+        ], batch_size=batch_size)
+        accounts = NAMED_ACCOUNTS + [(f"{2 + a // 30}.{a % 30:02d}.10", f"Счет {a}") for a in range(SCALE_UNIT['accounts'])]
+        osv = TrialBalance.objects.bulk_create([
+            TrialBalance(entity=entity, period=period, account_code=code, account_name=name,
+                         debit_turnover=rng.randint(0, 500000), credit_turnover=rng.randint(0, 500000))
+            for entity in entities for code, name in accounts for period in finance_months
+        ], batch_size=batch_size)
+        counts['pnl_rows'] = len(pnl)
+        counts['osv_rows'] = len(osv)
+
+    return counts
+
+
+def _excel(rows):
+    buffer = io.BytesIO()
+    pd.DataFrame(rows).to_excel(buffer, header=False, index=False)
+    return buffer.getvalue()
+
+
+def pnl_file(categories=SCALE_UNIT['categories']):
+    """Файл ОПУ за месяц в формате process_pnl_file: статьи с 4-й строки, колонки A-D."""
+    rows = [["ОПУ"], [], ["Код", "Наименование", "Факт", "План"]]
+    rows += [[f"1.{c}", f"bench-category-{c}", 1000 + c, 900 + c] for c in range(categories)]
+    return _excel(rows)
+
+
+def osv_file(accounts=SCALE_UNIT['accounts']):
+    """Файл ОСВ в формате process_osv_file: счета с 6-й строки, обороты в колонках F и G."""
+    rows = [["ОСВ"], [], [], [], ["Счет", "Наименование", "", "", "", "Дебет", "Кредит"], []]
+    rows += [[f"2.{a:02d}.10", f"Счет {a}", "", "", "", 100 * a, 50 * a] for a in range(accounts)]
+    return _excel(rows)
+
+
+def multi_pnl_file(categories=SCALE_UNIT['categories']):
+    """Годовой файл ОПУ (process_multi_pnl_file): месяцы строкой выше пар Факт/План."""
+    months_row, header = ["", ""], ["Код", "Статья"]
+    for name in MONTH_NAMES:
+        months_row += [name, ""]
+        header += ["Факт", "План"]
+    rows = [["ОПУ за год"], months_row, header]
+    rows += [[f"1.{c}", f"bench-category-{c}"] + [1000 + c, 900 + c] * 12 for c in range(categories)]
+    return _excel(rows)
+
+
+def scenarios():
+    """{имя: функция без аргументов} — все, что замеряет стенд."""
+    from analytics.services import process_multi_pnl_file, process_osv_file, process_pnl_file
+    from kpi.reports import build_report_context
+
+    admin = User.objects.filter(role='admin', username__startswith='bench-').first()
+    client = Client()
+    client.force_login(admin)
+    month = kpi_months()[-1]
+    period = date(FINANCE_YEAR, 6, 1)
+    entity = Entity.objects.filter(name__startswith='bench-entity-').first()
+    files = {'pnl': pnl_file(), 'osv': osv_file(), 'multi_pnl': multi_pnl_file()}
+
+    def get(url):
+        def run():
+            response = client.get(url)
+            assert response.status_code == 200, f"{url}: {response.status_code}"
+        return run
+
+    return {
+        'dashboard': get(f"/kpi/dashboard/?month={month:%Y-%m}"),
+        'report_context': lambda: build_report_context(month),
+        'consolidated_report': get(f"/analytics/consolidated/?period={period}"),
+        'consolidated_osv': get(f"/analytics/consolidated_osv/?period={period}"),
+        'annual_analytics': get(f"/analytics/annual_analytics/?years={FINANCE_YEAR}"),
+        'cash_flow': get(f"/analytics/cash_flow/?years={FINANCE_YEAR}"),
+        'parse_pnl': lambda: process_pnl_file(SimpleUploadedFile('pnl.xlsx', files['pnl']), entity, period),
+        'parse_osv': lambda: process_osv_file(SimpleUploadedFile('osv.xlsx', files['osv']), entity, period),
+        'parse_multi_pnl': lambda: process_multi_pnl_file(
+            SimpleUploadedFile('pnl_year.xlsx', files['multi_pnl']), entity, FINANCE_YEAR),
+    }
+
+
+def _in_rollback(func):
+    # Отладочный вывод представлений (print) в замеры не попадает
+    with transaction.atomic(), redirect_stdout(io.StringIO()):
+        try:
+            func()
+        finally:
+            transaction.set_rollback(True)
+
+
+class QueryCounter:
+    """
+    Счетчик запросов через execute_wrapper. CaptureQueriesContext здесь не подходит:
+    тестовый клиент шлет request_started, и Django очищает connection.queries_log.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def measure(func, repeat=3):
+    """{'time': сек (лучший прогон), 'queries': число запросов, 'peak_kb': пик памяти}."""
+    # Прогрев: импорт модулей и компиляция шаблонов не должны попадать в замер
+    _in_rollback(func)
+
+    # Запросы и память — отдельным прогоном: tracemalloc заметно замедляет код
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        tracemalloc.start()
+        try:
+            _in_rollback(func)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _in_rollback(func)
+        timings.append(time.perf_counter() - start)
+    return {'time': min(timings), 'queries': queries.count, 'peak_kb': round(peak / 1024, 1)}
+
+
+def run_scenarios(names=None, repeat=3):
+    results = {}
+    for name, func in scenarios().items():
+        if names and name not in names:
+            continue
+        results[name] = measure(func, repeat)
+    return results
+
+
+def load_baselines(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baselines(path, baselines):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(baselines, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(result, baseline, tolerance=0.25):
+    """
+    Список регрессий замера относительно базового: время и память — сверх допуска
+    tolerance (доля), число запросов — любой рост.
+    """
+    if not baseline:
+        return []
+    regressions = []
+    if result['queries'] > baseline['queries']:
+        regressions.append(f"запросов {baseline['queries']} -> {result['queries']}")
+    if result['time'] > baseline['time'] * (1 + tolerance):
+        regressions.append(f"время {baseline['time'] * 1000:.1f} -> {result['time'] * 1000:.1f} мс")
+    if result['peak_kb'] > baseline['peak_kb'] * (1 + tolerance):
+        regressions.append(f"память {baseline['peak_kb']:.0f} -> {result['peak_kb']:.0f} КБ")
+    return regressions
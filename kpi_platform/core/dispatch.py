@@ -0,0 +1,134 @@
+"""
+Отложенные побочные эффекты сохранений (аудит, уведомления, пересчеты).
+
+Обработчики сигналов не пишут в БД сразу, а вызывают dispatch(handler, item).
+Элементы копятся в пачке текущей транзакции и уходят одним вызовом
+handler(items) на transaction.on_commit. Вне транзакции пачка сбрасывается сразу,
+при откате транзакции — отбрасывается вместе с ней.
+
+Пачка своя у каждой точки сохранения (вложенного atomic): ее flush регистрируется
+через on_commit внутри этой точки, поэтому при откате точки Django убирает его
+вместе с остальными ее колбэками, а эффекты внешней транзакции остаются.
+
+Массовые операции могут управлять этим явно:
+
+    with deferred_side_effects():      # все эффекты блока — одной пачкой в конце
+        ...
+    with suppressed_side_effects():    # эффекты блока не выполняются вовсе
+        ...
+
+Эффекты из вложенных atomic внутри deferred_side_effects попадают в пачку блока
+только после коммита своей точки сохранения, откаченные — отбрасываются.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+
+
+_local = threading.local()
+_SUPPRESS = object()
+
+
+class SideEffectBatch:
+    def __init__(self, parent=None):
+        # handler -> список элементов; порядок обработчиков сохраняется
+        self.items = {}
+        self.limits = {}
+        self.flushed = False
+        # Пачка блока deferred_side_effects, в которую переходят элементы при flush
+        self.parent = parent
+        # Уровень транзакции (atomic, точки сохранения), на котором открыт блок deferred_side_effects
+        self.level = None
+
+    def add(self, handler, item, max_batch=None):
+        items = self.items.setdefault(handler, [])
+        items.append(item)
+        self.limits[handler] = max_batch
+        if max_batch and len(items) >= max_batch:
+            # Пачка выросла до порога — сбрасываем ее сразу (внутри транзакции:
+            # при откате записанное откатится вместе с ней)
+            self.items[handler] = []
+            handler(items)
+
+    def flush(self):
+        self.flushed = True
+        items, self.items = self.items, {}
+        for handler, handler_items in items.items():
+            if self.parent is not None and not self.parent.flushed:
+                for item in handler_items:
+                    self.parent.add(handler, item, self.limits[handler])
+            else:
+                handler(handler_items)
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _level():
+    return connection.in_atomic_block, tuple(connection.savepoint_ids)
+
+
+def _transaction_batch(parent=None):
+    """Пачка текущей точки сохранения (создается при первом эффекте в ней)."""
+    queued = {func for _, func, _ in connection.run_on_commit}
+    # Пачки, чей flush уже выполнен или убран из очереди on_commit, завершились (коммит или откат)
+    batches = {
+        key: batch for key, batch in getattr(_local, 'transaction_batches', {}).items()
+        if batch.flush in queued and not batch.flushed
+    }
+    _local.transaction_batches = batches
+
+    key = (id(parent), tuple(connection.savepoint_ids))
+    batch = batches.get(key)
+    if batch is None:
+        batch = batches[key] = SideEffectBatch(parent)
+        transaction.on_commit(batch.flush)
+    return batch
+
+
+def dispatch(handler, item, max_batch=None):
+    """
+    Ставит item в очередь обработчика handler(items).
+    max_batch — порог, при котором накопленное отдается обработчику досрочно.
+    """
+    scope = _stack()[-1] if _stack() else None
+    if scope is _SUPPRESS:
+        return
+    if scope is not None and scope.level == _level():
+        scope.add(handler, item, max_batch)
+    elif connection.in_atomic_block:
+        _transaction_batch(scope).add(handler, item, max_batch)
+    else:
+        handler([item])
+
+
+@contextmanager
+def deferred_side_effects():
+    """
+    Собирает эффекты блока и выполняет их одной пачкой: после коммита,
+    если блок внутри транзакции, иначе — на выходе из блока.
+    """
+    scope = _stack()[-1] if _stack() else None
+    batch = SideEffectBatch(None if scope is _SUPPRESS else scope)
+    batch.level = _level()
+    _stack().append(batch)
+    try:
+        yield batch
+    finally:
+        _stack().pop()
+        # Внутри atomic flush уйдет вместе с этой точкой сохранения: при ее откате — отбросится
+        transaction.on_commit(batch.flush)
+
+
+@contextmanager
+def suppressed_side_effects():
+    """Отключает побочные эффекты сигналов внутри блока (пересчет делает сама операция)."""
+    _stack().append(_SUPPRESS)
+    try:
+        yield
+    finally:
+        _stack().pop()
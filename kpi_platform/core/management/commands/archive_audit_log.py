@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core.archive import archive_audit_log, archive_cutoff
+from core.models import AuditLog
+
+
+class Command(BaseCommand):
+    help = "Переносит записи аудита старше N месяцев в сжатые архивы по месяцам (AUDIT_ARCHIVE_DIR)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=settings.AUDIT_RETENTION_MONTHS,
+                            help="Сколько последних месяцев оставить в таблице")
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--dry-run', action='store_true', help="Только посчитать записи к переносу")
+
+    def handle(self, *args, **options):
+        cutoff = archive_cutoff(options['months'])
+        if options['dry_run']:
+            count = AuditLog.objects.filter(timestamp__lt=cutoff).count()
+            self.stdout.write(f"К архивированию (раньше {cutoff:%d.%m.%Y}): {count}")
+            return
+
+        moved = archive_audit_log(cutoff, batch_size=options['batch_size'])
+        for month, count in sorted(moved.items()):
+            self.stdout.write(f"{month:%m.%Y}: {count}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Перенесено в архив: {sum(moved.values())} (раньше {cutoff:%d.%m.%Y})"
+        ))
@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from core.benchmark import compare, load_baselines, run_scenarios, save_baselines, seed
+from pathlib import Path
+
+
+class Command(BaseCommand):
+    help = (
+        "Замеряет страницы KPI/аналитики и загрузчики файлов на синтетических данных нескольких масштабов "
+        "и сравнивает с сохраненными базовыми замерами. Работает во временной тестовой БД"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='1,4', help="Масштабы через запятую (по умолчанию 1,4)")
+        parser.add_argument('--repeat', type=int, default=3, help="Прогонов на замер времени (берется лучший)")
+        parser.add_argument('--only', nargs='*', help="Только эти сценарии")
+        parser.add_argument('--baseline', default=str(settings.BENCHMARK_BASELINES), help="Файл базовых замеров")
+        parser.add_argument('--save-baseline', action='store_true', help="Записать результаты как новые базовые")
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help="Допустимый рост времени и памяти относительно базовых (доля)")
+        parser.add_argument('--fail-on-regression', action='store_true', help="Код ошибки при регрессии")
+
+    def handle(self, *args, **options):
+        try:
+            scales = [float(s) for s in options['scales'].split(',')]
+        except ValueError:
+            raise CommandError("--scales: ожидаются числа через запятую")
+        baseline_path = Path(options['baseline'])
+        baselines = load_baselines(baseline_path)
+        results, regressions = {}, []
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            for scale in scales:
+                call_command('flush', interactive=False, verbosity=0)
+                counts = seed(scale)
+                key = f"{connection.vendor}:scale={scale:g}"
+                self.stdout.write(self.style.MIGRATE_HEADING(
+                    f"\nМасштаб {scale:g}: " + ", ".join(f"{name} {count}" for name, count in counts.items())
+                ))
+                self.stdout.write(f"{'сценарий':<20} {'время, мс':>10} {'запросы':>8} {'память, КБ':>11}")
+
+                results[key] = run_scenarios(options['only'], repeat=options['repeat'])
+                for name, result in results[key].items():
+                    found = compare(result, baselines.get(key, {}).get(name), options['tolerance'])
+                    line = f"{name:<20} {result['time'] * 1000:>10.1f} {result['queries']:>8} {result['peak_kb']:>11.0f}"
+                    if found:
+                        regressions.append(f"{key} {name}: {'; '.join(found)}")
+                        line = self.style.ERROR(f"{line}  {'; '.join(found)}")
+                    self.stdout.write(line)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['save_baseline']:
+            for key, scenario_results in results.items():
+                baselines.setdefault(key, {}).update(scenario_results)
+            save_baselines(baseline_path, baselines)
+            self.stdout.write(self.style.SUCCESS(f"Базовые замеры сохранены в {baseline_path}"))
+
+        if regressions:
+            message = "Регрессии относительно базовых замеров:\n" + "\n".join(regressions)
+            if options['fail_on_regression']:
+                raise CommandError(message)
+            self.stdout.write(self.style.WARNING(message))
+        elif baselines:
+            self.stdout.write(self.style.SUCCESS("Регрессий нет"))
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from core.benchmark import SCALE_UNIT, seed
+
+
+class Command(BaseCommand):
+    help = "Заполняет текущую БД синтетическими данными для нагрузочных замеров (см. core.benchmark)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1,
+                            help=f"Масштаб: 1 = {SCALE_UNIT['departments']} отделов "
+                                 f"по {SCALE_UNIT['employees_per_department']} сотрудников и {SCALE_UNIT['entities']} филиала")
+        parser.add_argument('--seed', type=int, default=42, help="Зерно генератора случайных значений")
+        parser.add_argument('--force', action='store_true', help="Разрешить запуск при DEBUG=False")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError("DEBUG=False: похоже на рабочую БД. Для запуска добавьте --force")
+        counts = seed(options['scale'], random_seed=options['seed'])
+        for name, count in counts.items():
+            self.stdout.write(f"{name}: {count}")
+        self.stdout.write(self.style.SUCCESS(f"Данные масштаба {options['scale']:g} созданы"))
@@ -0,0 +1,93 @@
+import cProfile
+import random
+import re
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .audit import current_request
+from .profiling import (
+    RequestProfile, configure_slow_log, current_profile, instrument_templates, log_slow_request,
+)
+
+
+class AuditUserMiddleware:
+    """
+    Делает текущий запрос доступным аудиту (core.audit.current_user).
+    Сам пользователь не загружается: request.user остается ленивым до первой записи аудита.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = current_request.set(request)
+        try:
+            return self.get_response(request)
+        finally:
+            current_request.reset(token)
+
+
+class ProfilingMiddleware:
+    """
+    Время запроса, SQL и шаблонов в заголовке Server-Timing; медленные запросы —
+    в лог PROFILING_SLOW_LOG, доля PROFILING_SAMPLE_RATE запросов — под cProfile
+    (файлы .prof в PROFILING_PROFILE_DIR). Включается PROFILING_ENABLED, при
+    выключенном профилировании Django убирает middleware из цепочки.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_threshold = settings.PROFILING_SLOW_REQUEST_MS / 1000
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0)
+        instrument_templates()
+        configure_slow_log()
+
+    def __call__(self, request):
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        # Обертки подключений — свои у каждого потока, снимаются по ссылке в finally
+        wrapped = list(connections.all())
+        for connection in wrapped:
+            connection.execute_wrappers.append(profile)
+        profiler = self.start_profiler() if self.sample_rate and random.random() < self.sample_rate else None
+        try:
+            response = self.get_response(request)
+        finally:
+            if profiler:
+                profiler.disable()
+            for connection in wrapped:
+                connection.execute_wrappers.remove(profile)
+            current_profile.reset(token)
+
+        profile.finish()
+        response['Server-Timing'] = profile.server_timing()
+        profile_path = self.dump_profile(profiler, request) if profiler else None
+        if profile.total >= self.slow_threshold or profile_path:
+            log_slow_request(profile.as_log_record(request, response, profile_path))
+        return response
+
+    @staticmethod
+    def start_profiler():
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # В этом потоке уже работает другой профилировщик
+            return None
+        return profiler
+
+    @staticmethod
+    def dump_profile(profiler, request):
+        directory = Path(settings.PROFILING_PROFILE_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        slug = re.sub(r'[^\w-]+', '_', request.path).strip('_')[:80] or 'root'
+        path = directory / f"{time.strftime('%Y%m%d-%H%M%S')}-{request.method}-{slug}-{uuid.uuid4().hex[:8]}.prof"
+        profiler.dump_stats(path)
+        return path
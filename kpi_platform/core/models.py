@@ -8,4 +8,15 @@ class AuditLog(models.Model):
     model_name = models.CharField(max_length=100)
     object_id = models.PositiveIntegerField()
     timestamp = models.DateTimeField(auto_now_add=True)
-    changes = models.TextField(blank=True) # Здесь можно хранить JSON старых/новых значений
\ No newline at end of file
+    changes = models.TextField(blank=True) # Краткое описание объекта/действия
+    diff = models.JSONField(default=dict, blank=True)  # {"поле": [старое, новое]}, см. core.audit
+
+    class Meta:
+        indexes = [
+            # История объекта X
+            models.Index(fields=['model_name', 'object_id', '-timestamp'], name='audit_object_history_idx'),
+            # Действия пользователя за период
+            models.Index(fields=['user', '-timestamp'], name='audit_user_time_idx'),
+            # Лента без фильтров и выборка под архивирование
+            models.Index(fields=['-timestamp', '-id'], name='audit_time_idx'),
+        ]
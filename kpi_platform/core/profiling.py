@@ -0,0 +1,126 @@
+"""
+Профилирование запросов (core.middleware.ProfilingMiddleware).
+
+На время запроса собирается RequestProfile: SQL-запросы (через execute_wrapper
+всех подключений), время рендера шаблонов и общее время. Итог уходит в заголовок
+Server-Timing, медленные запросы — в ротируемый лог PROFILING_SLOW_LOG (JSON на строку).
+Повтор одного и того же SQL много раз за запрос — типичный N+1 — попадает в лог
+отдельным списком.
+
+Все это подключается, только когда PROFILING_ENABLED=True; иначе middleware
+отключается при старте (MiddlewareNotUsed), а Template.render не трогается.
+"""
+import json
+import logging
+import time
+from collections import Counter
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+from django.conf import settings
+from django.template.base import Template
+
+
+current_profile = ContextVar('profiling_current_profile', default=None)
+
+slow_log = logging.getLogger('core.profiling.slow_requests')
+
+
+class RequestProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.total = 0.0
+        self.sql_time = 0.0
+        self.sql = Counter()
+        self.template_time = 0.0
+        self.template_depth = 0
+
+    @property
+    def query_count(self):
+        return sum(self.sql.values())
+
+    def duplicates(self, threshold=2):
+        """[(sql, сколько раз), ...] для запросов, выполненных не меньше threshold раз."""
+        return [(sql, count) for sql, count in self.sql.most_common() if count >= threshold]
+
+    def __call__(self, execute, sql, params, many, context):
+        # execute_wrapper: SQL без параметров — одинаковые по форме запросы считаются вместе
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - start
+            self.sql[sql] += 1
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+
+    def server_timing(self):
+        app = max(self.total - self.sql_time - self.template_time, 0)
+        duplicated = sum(count - 1 for _, count in self.duplicates())
+        return ", ".join([
+            f'total;dur={self.total * 1000:.1f}',
+            f'sql;dur={self.sql_time * 1000:.1f};desc="{self.query_count} queries ({duplicated} duplicate)"',
+            f'tpl;dur={self.template_time * 1000:.1f}',
+            f'app;dur={app * 1000:.1f}',
+        ])
+
+    def as_log_record(self, request, response, profile_path=None):
+        threshold = getattr(settings, 'PROFILING_DUPLICATE_THRESHOLD', 5)
+        return {
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'total_ms': round(self.total * 1000, 1),
+            'sql_ms': round(self.sql_time * 1000, 1),
+            'queries': self.query_count,
+            'template_ms': round(self.template_time * 1000, 1),
+            # Кандидаты в N+1: один и тот же запрос threshold и больше раз
+            'repeated_sql': [{'sql': sql[:300], 'count': count} for sql, count in self.duplicates(threshold)[:5]],
+            'profile': str(profile_path) if profile_path else None,
+        }
+
+
+_original_render = Template.render
+
+
+def _profiled_render(self, context):
+    profile = current_profile.get()
+    if profile is None:
+        return _original_render(self, context)
+    # {% include %} вызывает render вложенно — время считаем только у внешнего шаблона
+    profile.template_depth += 1
+    start = time.perf_counter()
+    try:
+        return _original_render(self, context)
+    finally:
+        profile.template_depth -= 1
+        if not profile.template_depth:
+            profile.template_time += time.perf_counter() - start
+
+
+def instrument_templates():
+    Template.render = _profiled_render
+
+
+def configure_slow_log():
+    """Ротируемый файл для медленных запросов (если логгер не настроен через LOGGING)."""
+    if slow_log.handlers:
+        return
+    path = Path(settings.PROFILING_SLOW_LOG)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    handler = RotatingFileHandler(
+        path,
+        maxBytes=getattr(settings, 'PROFILING_SLOW_LOG_MAX_BYTES', 10 * 1024 * 1024),
+        backupCount=getattr(settings, 'PROFILING_SLOW_LOG_BACKUPS', 5),
+        encoding='utf-8',
+    )
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    slow_log.addHandler(handler)
+    slow_log.setLevel(logging.INFO)
+    slow_log.propagate = False
+
+
+def log_slow_request(record):
+    slow_log.info(json.dumps(record, ensure_ascii=False))
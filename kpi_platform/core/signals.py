@@ -1,28 +1,37 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_init, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from kpi.models import KPI, Indicator
-from .models import AuditLog
+from .audit import record_instance, track_original
+
+
+@receiver(post_init, sender=KPI)
+@receiver(post_init, sender=Indicator)
+def remember_original(sender, instance, **kwargs):
+    # Снимок только у объектов из БД (с pk): по нему считается diff при сохранении
+    if instance.pk is not None:
+        track_original(instance)
+
 
 @receiver(post_save, sender=KPI)
 @receiver(post_save, sender=Indicator)
 def log_save(sender, instance, created, **kwargs):
-    action = "Created" if created else "Updated"
-    # Пытаемся получить пользователя, если это возможно
-    # Примечание: В сигналах нет прямого доступа к request.user без костылей, 
-    # поэтому обычно здесь пишется системный лог или используется middleware.
-    AuditLog.objects.create(
-        action=action,
-        model_name=sender.__name__,
-        object_id=instance.id,
-        changes=f"{instance}"
-    )
+    # Пользователь берется из AuditUserMiddleware, запись уходит в БД пачкой (core.audit)
+    record_instance(instance, "Created" if created else "Updated", created=created)
+
+
+@receiver(pre_delete, sender=KPI)
+@receiver(pre_delete, sender=Indicator)
+def load_deferred_fields(sender, instance, **kwargs):
+    # После удаления отложенные поля уже не прочитать, а они нужны аудиту и пересчетам
+    deferred = instance.get_deferred_fields()
+    if deferred:
+        instance.refresh_from_db(fields=list(deferred))
+        original = getattr(instance, '_audit_original', None)
+        if original is not None:
+            original.update({name: instance.__dict__[name] for name in deferred})
+
 
 @receiver(post_delete, sender=KPI)
 @receiver(post_delete, sender=Indicator)
 def log_delete(sender, instance, **kwargs):
-    AuditLog.objects.create(
-        action="Deleted",
-        model_name=sender.__name__,
-        object_id=instance.id,
-        changes=f"Deleted object: {instance}"
-    )
\ No newline at end of file
+    record_instance(instance, "Deleted", deleted=True)
@@ -0,0 +1,46 @@
+"""
+Проверка планов запросов в тестах: горячие выборки должны идти по индексу.
+
+    assert_uses_index(self, KPI.objects.filter(...))
+
+SQLite: план (EXPLAIN QUERY PLAN) не должен содержать полного прохода
+(SCAN <таблица>) по проверяемым таблицам — только SEARCH по индексу.
+PostgreSQL: последовательное сканирование отключается (enable_seqscan=off),
+и план не должен содержать "Seq Scan on <таблица>" — если Seq Scan все равно
+остался, подходящего индекса нет. По умолчанию проверяются все таблицы запроса.
+"""
+import re
+
+from django.db import connections
+
+
+def query_plan(queryset):
+    """Текстовый план запроса для текущей БД."""
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+    return queryset.explain()
+
+
+def full_scans(queryset, tables=None):
+    """Таблицы из tables (по умолчанию — все таблицы запроса), которые план читает целиком."""
+    connection = connections[queryset.db]
+    plan = query_plan(queryset)
+    if connection.vendor == 'postgresql':
+        scanned = re.findall(r'Seq Scan on "?(\w+)"?', plan)
+    else:
+        # "SCAN kpi_kpi", "SCAN kpi_kpi AS T3", "SCAN kpi_kpi USING INDEX ..." (полный проход по индексу
+        # тоже считается); "SCAN CONSTANT ROW" к таблицам не относится
+        scanned = [t for t in re.findall(r'\bSCAN (?:TABLE )?"?(\w+)"?', plan) if t != 'CONSTANT']
+    if tables is not None:
+        scanned = [table for table in scanned if table in tables]
+    return sorted(set(scanned)), plan
+
+
+def assert_uses_index(testcase, queryset, tables=None):
+    """Падает, если план запроса содержит полный проход по одной из таблиц."""
+    if tables is not None:
+        tables = {t if isinstance(t, str) else t._meta.db_table for t in tables}
+    scanned, plan = full_scans(queryset, tables)
+    testcase.assertFalse(scanned, f"Полный проход по {', '.join(scanned)}:\n{plan}\n\n{queryset.query}")
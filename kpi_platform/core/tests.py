@@ -1,3 +1,387 @@
-from django.test import TestCase
+import json
+from io import StringIO
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+import tempfile
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import QuerySet
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from analytics.models import PnLData
+from kpi.models import KPI, Indicator
+from notifications.models import Notification
+from users.models import User
+from .archive import archive_audit_log, audit_page, read_archived_month
+from .dispatch import deferred_side_effects, dispatch, suppressed_side_effects
+from .benchmark import compare, measure, run_scenarios, seed
+from .audit import record
+from .middleware import AuditUserMiddleware, ProfilingMiddleware
+from .models import AuditLog
+from .profiling import slow_log
+
+
+class BenchmarkHarnessTests(TestCase):
+    """Стенд должен оставаться рабочим: seed на минимальном масштабе и прогон сценариев."""
+
+    def test_seed_and_scenarios(self):
+        counts = seed(scale=0.2)
+        self.assertEqual(KPI.objects.count(), counts['kpis'])
+        self.assertEqual(PnLData.objects.count(), counts['pnl_rows'])
+        self.assertTrue(User.objects.filter(role='employee', superior__superior__role='admin').exists())
+
+        results = run_scenarios(repeat=1)
+        self.assertIn('dashboard', results)
+        self.assertGreater(results['dashboard']['queries'], 0)
+        # Загрузчики работают в транзакции с откатом и данных не меняют
+        self.assertEqual(PnLData.objects.count(), counts['pnl_rows'])
+
+    def test_compare_flags_growth(self):
+        baseline = {'time': 0.1, 'queries': 10, 'peak_kb': 100}
+        self.assertEqual(compare({'time': 0.11, 'queries': 10, 'peak_kb': 110}, baseline), [])
+        self.assertEqual(len(compare({'time': 0.2, 'queries': 11, 'peak_kb': 200}, baseline)), 3)
+        self.assertEqual(compare(measure(lambda: None, repeat=1), None), [])
+
+
+def repeated_query_view(request):
+    # Три одинаковых запроса (как в цикле N+1) и рендер шаблона
+    for _ in range(3):
+        User.objects.filter(pk=0).exists()
+    return HttpResponse(Template("{% for i in items %}{{ i }}{% endfor %}").render(Context({'items': range(10)})))
+
+
+class ProfilingMiddlewareTests(TestCase):
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(self.reset_slow_log)
+
+    @staticmethod
+    def reset_slow_log():
+        for handler in list(slow_log.handlers):
+            handler.close()
+            slow_log.removeHandler(handler)
+
+    def profiled(self, **overrides):
+        options = dict(PROFILING_ENABLED=True, PROFILING_SLOW_REQUEST_MS=0, PROFILING_DUPLICATE_THRESHOLD=3,
+                       PROFILING_SLOW_LOG=self.tmp / 'slow.log', PROFILING_PROFILE_DIR=self.tmp / 'profiles')
+        options.update(overrides)
+        with override_settings(**options):
+            middleware = ProfilingMiddleware(repeated_query_view)
+            return middleware(RequestFactory().get('/kpi/dashboard/?month=2026-01'))
+
+    def test_disabled_middleware_is_removed(self):
+        with override_settings(PROFILING_ENABLED=False):
+            with self.assertRaises(MiddlewareNotUsed):
+                ProfilingMiddleware(repeated_query_view)
+
+    def test_server_timing_and_slow_log(self):
+        response = self.profiled()
+
+        timing = dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timing), {'total', 'sql', 'tpl', 'app'})
+        self.assertIn('desc="3 queries (2 duplicate)"', timing['sql'])
+
+        record = json.loads((self.tmp / 'slow.log').read_text(encoding='utf-8').split(' ', 2)[2])
+        self.assertEqual(record['path'], '/kpi/dashboard/?month=2026-01')
+        self.assertEqual(record['queries'], 3)
+        self.assertEqual(record['repeated_sql'][0]['count'], 3)
+        self.assertGreater(record['template_ms'], 0)
+
+    def test_fast_request_is_not_logged_and_sampling_writes_profile(self):
+        self.profiled(PROFILING_SLOW_REQUEST_MS=60000)
+        self.assertEqual((self.tmp / 'slow.log').read_text(encoding='utf-8'), '')
+
+        self.reset_slow_log()
+        self.profiled(PROFILING_SLOW_REQUEST_MS=60000, PROFILING_SAMPLE_RATE=1)
+        self.assertEqual(len(list((self.tmp / 'profiles').glob('*.prof'))), 1)
+
+
+class DispatchTests(TransactionTestCase):
+    """Пачки core.dispatch на настоящих коммитах и откатах (без обертки TestCase)."""
+
+    def setUp(self):
+        self.calls = []
+
+    def handler(self, items):
+        self.calls.append(items)
+
+    def test_outside_transaction_runs_immediately(self):
+        dispatch(self.handler, 1)
+        self.assertEqual(self.calls, [[1]])
+
+    def test_commit_flushes_one_batch(self):
+        with transaction.atomic():
+            dispatch(self.handler, 1)
+            dispatch(self.handler, 2)
+            self.assertEqual(self.calls, [])
+        self.assertEqual(self.calls, [[1, 2]])
+
+    def test_rollback_drops_batch(self):
+        with self.assertRaises(ZeroDivisionError):
+            with transaction.atomic():
+                dispatch(self.handler, 1)
+                1 / 0
+        self.assertEqual(self.calls, [])
+
+        # Следующая транзакция начинает новую пачку
+        with transaction.atomic():
+            dispatch(self.handler, 2)
+        self.assertEqual(self.calls, [[2]])
+
+    def test_savepoint_rollback_drops_only_its_items(self):
+        with transaction.atomic():
+            dispatch(self.handler, 'outer')
+            with self.assertRaises(ZeroDivisionError):
+                with transaction.atomic():
+                    dispatch(self.handler, 'rolled back')
+                    1 / 0
+            with transaction.atomic():
+                dispatch(self.handler, 'released')
+            dispatch(self.handler, 'outer again')
+        self.assertEqual(self.calls, [['outer', 'outer again'], ['released']])
+
+    def test_max_batch_flushes_early(self):
+        with transaction.atomic():
+            for item in range(5):
+                dispatch(self.handler, item, max_batch=2)
+            self.assertEqual(self.calls, [[0, 1], [2, 3]])
+        self.assertEqual(self.calls, [[0, 1], [2, 3], [4]])
+
+    def test_deferred_outside_transaction_flushes_once_at_exit(self):
+        with deferred_side_effects():
+            dispatch(self.handler, 1)
+            # Построчные транзакции массовой операции копятся в пачке блока
+            with transaction.atomic():
+                dispatch(self.handler, 2)
+            with self.assertRaises(ZeroDivisionError):
+                with transaction.atomic():
+                    dispatch(self.handler, 'rolled back')
+                    1 / 0
+            with transaction.atomic():
+                dispatch(self.handler, 3)
+            self.assertEqual(self.calls, [])
+        self.assertEqual(self.calls, [[1, 2, 3]])
+
+    def test_deferred_inside_transaction_waits_for_commit(self):
+        with transaction.atomic():
+            with deferred_side_effects():
+                dispatch(self.handler, 1)
+                with transaction.atomic():
+                    dispatch(self.handler, 2)
+            dispatch(self.handler, 'after block')
+            self.assertEqual(self.calls, [])
+        self.assertEqual(self.calls, [[1, 2], ['after block']])
+
+        with self.assertRaises(ZeroDivisionError):
+            with transaction.atomic():
+                with deferred_side_effects():
+                    dispatch(self.handler, 'rolled back')
+                1 / 0
+        self.assertEqual(self.calls, [[1, 2], ['after block']])
+
+    def test_suppressed_block_drops_effects(self):
+        with transaction.atomic():
+            dispatch(self.handler, 1)
+            with suppressed_side_effects():
+                dispatch(self.handler, 'suppressed')
+                with deferred_side_effects():
+                    dispatch(self.handler, 'deferred')
+            dispatch(self.handler, 2)
+        # Вложенный deferred внутри suppressed работает сам по себе
+        self.assertEqual(self.calls, [[1, 2], ['deferred']])
+
+
+class AuditTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='auditor')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.kpi = KPI.objects.create(name="Продажи", period='monthly', target_type='employee',
+                                          employee=self.user, for_month=date(2026, 1, 1))
+
+    def last_log(self, **filters):
+        return AuditLog.objects.filter(**filters).latest('id')
+
+    def test_create_diff_has_only_set_fields(self):
+        log = self.last_log(action="Created", model_name='KPI')
+        self.assertEqual(log.object_id, self.kpi.pk)
+        self.assertEqual(log.diff, {
+            'name': [None, "Продажи"], 'period': [None, 'monthly'], 'target_type': [None, 'employee'],
+            'employee_id': [None, self.user.pk], 'for_month': [None, '2026-01-01'],
+        })
+
+    def test_update_diff_has_only_changed_fields(self):
+        kpi = KPI.objects.get(pk=self.kpi.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            kpi.name = "Продажи Q1"
+            kpi.save()
+            # Сохранение без изменений в аудит не попадает
+            kpi.save()
+        self.assertEqual(AuditLog.objects.filter(action="Updated").count(), 1)
+        self.assertEqual(self.last_log(action="Updated").diff, {'name': ["Продажи", "Продажи Q1"]})
+
+    def test_delete_keeps_marker_and_set_fields(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            KPI.objects.get(pk=self.kpi.pk).delete()
+        log = self.last_log(action="Deleted")
+        self.assertEqual(log.diff['name'], ["Продажи", None])
+        self.assertNotIn('is_active', log.diff)
+
+    def test_buffer_flushes_at_threshold(self):
+        with override_settings(AUDIT_BUFFER_SIZE=3):
+            with self.captureOnCommitCallbacks(execute=True):
+                for object_id in range(4):
+                    record("Updated", 'KPI', object_id)
+                # Первые три ушли одним INSERT до коммита, четвертая ждет его
+                self.assertEqual(AuditLog.objects.filter(action="Updated").count(), 3)
+        self.assertEqual(AuditLog.objects.filter(action="Updated").count(), 4)
+
+    def test_rolled_back_changes_leave_no_audit_or_notification(self):
+        superior = User.objects.create(username='boss')
+        User.objects.filter(pk=self.user.pk).update(superior=superior)
+        indicator = Indicator.objects.create(kpi=self.kpi, name="A", indicator_type='percent', plan_value=100, weight=50)
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ZeroDivisionError):
+                with transaction.atomic():
+                    indicator.weight = 70
+                    indicator.status = 'on_review'
+                    indicator.save()
+                    1 / 0
+        self.assertFalse(AuditLog.objects.filter(model_name='Indicator', action="Updated").exists())
+        self.assertFalse(Notification.objects.exists())
+
+    def test_middleware_attributes_user(self):
+        def view(request):
+            kpi = KPI.objects.get(pk=self.kpi.pk)
+            kpi.name = "Из запроса"
+            kpi.save()
+            return HttpResponse()
+
+        request = RequestFactory().post('/kpi/')
+        request.user = self.user
+        with self.captureOnCommitCallbacks(execute=True):
+            AuditUserMiddleware(view)(request)
+            # Вне запроса пользователя нет
+            record("Updated", 'KPI', self.kpi.pk, changes="команда")
+        self.assertEqual(self.last_log(changes__startswith="Из запроса").user, self.user)
+        self.assertIsNone(self.last_log(changes="команда").user)
+
+
+class AuditArchiveTests(TestCase):
+    CUTOFF = datetime(2025, 3, 1, tzinfo=dt_timezone.utc)
+
+    def setUp(self):
+        settings_override = override_settings(AUDIT_ARCHIVE_DIR=tempfile.mkdtemp())
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create(username='auditor', role='admin')
+        # 7 записей до границы (январь и февраль), одна ровно на границе и две после
+        stamps = [datetime(2025, 1, day, 12, tzinfo=dt_timezone.utc) for day in (3, 10, 17, 24)]
+        stamps += [datetime(2025, 2, day, 12, tzinfo=dt_timezone.utc) for day in (5, 12, 19)]
+        stamps += [self.CUTOFF, self.CUTOFF + timedelta(days=3), self.CUTOFF + timedelta(days=10)]
+        self.ids = []
+        for number, stamp in enumerate(stamps):
+            log = AuditLog.objects.create(user=self.user, action="Updated", model_name='KPI',
+                                          object_id=number % 2, changes=f"запись {number}")
+            AuditLog.objects.filter(pk=log.pk).update(timestamp=stamp)
+            self.ids.append(log.pk)
+        self.all_ids = list(AuditLog.objects.order_by('-timestamp', '-id').values_list('id', flat=True))
+        self.old_ids = set(AuditLog.objects.filter(timestamp__lt=self.CUTOFF).values_list('id', flat=True))
+
+    def archived_ids(self, *months):
+        return [row['id'] for month in months for row in read_archived_month(month)]
+
+    def walk(self, filters=None, limit=3):
+        entries, before = [], None
+        while True:
+            page, before = audit_page(filters or {}, before=before, limit=limit)
+            entries += page
+            if before is None:
+                return entries
+
+    def test_moves_rows_before_cutoff_across_batches(self):
+        with CaptureQueriesContext(connection) as queries:
+            moved = archive_audit_log(self.CUTOFF, batch_size=3)
+        self.assertEqual(moved, {date(2025, 1, 1): 4, date(2025, 2, 1): 3})
+        # 7 записей по 3 — три пачки, каждая удаляется своим DELETE
+        self.assertEqual(sum(query['sql'].startswith('DELETE') for query in queries.captured_queries), 3)
+
+        # Запись ровно на границе и более новые остаются в таблице
+        remaining = AuditLog.objects.all()
+        self.assertEqual(remaining.count(), 3)
+        self.assertFalse(remaining.filter(timestamp__lt=self.CUTOFF).exists())
+        self.assertTrue(remaining.filter(timestamp=self.CUTOFF).exists())
+
+        archived = self.archived_ids(date(2025, 2, 1), date(2025, 1, 1))
+        self.assertEqual(len(archived), len(set(archived)))
+        self.assertEqual(set(archived), self.old_ids)
+        # Повторный прогон ничего не переносит
+        self.assertEqual(archive_audit_log(self.CUTOFF, batch_size=3), {})
+
+    def test_failed_delete_keeps_rows_and_rerun_does_not_duplicate(self):
+        real_delete = QuerySet.delete
+        calls = []
+
+        def failing_delete(qs):
+            calls.append(qs)
+            if len(calls) == 2:
+                raise RuntimeError("сбой при удалении")
+            return real_delete(qs)
+
+        with mock.patch.object(QuerySet, 'delete', failing_delete):
+            with self.assertRaises(RuntimeError):
+                archive_audit_log(self.CUTOFF, batch_size=3)
+        # Первая пачка перенесена, вторая записана в файл, но откатилась и осталась в таблице
+        self.assertEqual(AuditLog.objects.filter(timestamp__lt=self.CUTOFF).count(), 4)
+        # До повторного прогона лента показывает каждую запись один раз
+        self.assertEqual([entry.id for entry in self.walk()], self.all_ids)
+
+        archive_audit_log(self.CUTOFF, batch_size=3)
+        self.assertFalse(AuditLog.objects.filter(timestamp__lt=self.CUTOFF).exists())
+        archived = self.archived_ids(date(2025, 2, 1), date(2025, 1, 1))
+        self.assertEqual(sorted(archived), sorted(self.old_ids))
+        self.assertEqual([entry.id for entry in self.walk()], self.all_ids)
+
+    def test_pages_cross_from_table_to_archive(self):
+        archive_audit_log(self.CUTOFF, batch_size=3)
+        for limit in (1, 3, 4, 50):
+            entries = self.walk(limit=limit)
+            self.assertEqual([entry.id for entry in entries], self.all_ids)
+            self.assertEqual({entry.id for entry in entries if entry.archived}, self.old_ids)
+        self.assertTrue(all(entry.user == self.user for entry in entries))
+
+        # Фильтры работают и по архиву
+        filtered = self.walk({'object_id': 1, 'date_to': self.CUTOFF + timedelta(days=5)}, limit=2)
+        self.assertEqual([entry.id for entry in filtered], [self.ids[7], self.ids[5], self.ids[3], self.ids[1]])
+
+    def test_view_shows_archived_rows(self):
+        archive_audit_log(self.CUTOFF, batch_size=3)
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('audit_log'), {'from': '2025-02-01', 'to': '2025-03-01'})
+        self.assertEqual(response.status_code, 200)
+        entries = response.context['entries']
+        # Запись на границе из таблицы, за ней февраль из архива
+        self.assertEqual([entry.id for entry in entries], [self.ids[7], self.ids[6], self.ids[5], self.ids[4]])
+        self.assertEqual([entry.archived for entry in entries], [False, True, True, True])
+        self.assertContains(response, '<span class="badge bg-secondary ms-1">архив</span>', count=3, html=True)
+
+    def test_command_reports_counts_and_dry_run(self):
+        out = StringIO()
+        with mock.patch('core.management.commands.archive_audit_log.archive_cutoff', return_value=self.CUTOFF):
+            call_command('archive_audit_log', '--dry-run', stdout=out)
+            self.assertIn("К архивированию (раньше 01.03.2025): 7", out.getvalue())
+            self.assertEqual(AuditLog.objects.count(), 10)
+
+            call_command('archive_audit_log', '--batch-size', '2', stdout=out)
+        self.assertIn("01.2025: 4", out.getvalue())
+        self.assertIn("Перенесено в архив: 7", out.getvalue())
+        self.assertEqual(AuditLog.objects.count(), 3)
@@ -0,0 +1,6 @@
+from django.urls import path
+from .views import AuditLogListView
+
+urlpatterns = [
+    path('', AuditLogListView.as_view(), name='audit_log'),
+]
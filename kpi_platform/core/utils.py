@@ -1,11 +1,40 @@
-from .models import AuditLog
+from datetime import date
+
+from .audit import record
 
 
 def log_action(user, action, obj, changes=""):
-    AuditLog.objects.create(
-        user=user,
-        action=action,
-        model_name=obj.__class__.__name__,
-        object_id=obj.id,
-        changes=changes
-    )
\ No newline at end of file
+    # Запись уходит в БД вместе с остальным аудитом транзакции (core.audit)
+    record(action, obj.__class__.__name__, obj.id, changes=changes, user=user)
+
+
+def month_bounds(day):
+    """
+    [начало месяца, начало следующего) для фильтра по диапазону.
+    В отличие от field__month/field__year, такое условие может идти по индексу.
+    """
+    start = date(day.year, day.month, 1)
+    end = date(day.year + 1, 1, 1) if day.month == 12 else date(day.year, day.month + 1, 1)
+    return start, end
+
+
+def year_bounds(year):
+    """[1 января, 1 января следующего года) — диапазон для фильтра по году."""
+    return date(year, 1, 1), date(year + 1, 1, 1)
+
+
+def exclude_db_maintained(instance, save_kwargs, fields):
+    """
+    Полный save() объекта, загруженного из БД, не должен перезаписывать поля, которые
+    ведутся в базе UPDATE-ами (суммы, счетчики): значение в памяти могло устареть.
+    Подставляет в save_kwargs update_fields без этих полей (и без отложенных — их save()
+    и так не пишет). Создание и явные update_fields не трогаются.
+    """
+    if (save_kwargs.get('update_fields') is not None or save_kwargs.get('force_insert')
+            or instance._state.adding or instance.pk is None):
+        return
+    deferred = instance.get_deferred_fields()
+    save_kwargs['update_fields'] = [
+        field.name for field in instance._meta.concrete_fields
+        if not field.primary_key and field.name not in fields and field.attname not in deferred
+    ]
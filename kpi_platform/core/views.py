@@ -1,3 +1,58 @@
+from datetime import datetime, time, timedelta
+
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.shortcuts import render
+from django.utils import timezone
+from django.views.generic import ListView
+
+from users.models import User
+from .archive import audit_page
+from .models import AuditLog
+
+
+AUDIT_PAGE_SIZE = 50
+
+
+class AuditLogListView(LoginRequiredMixin, UserPassesTestMixin, ListView):
+    """Журнал аудита: таблица и архив одной лентой, постранично по ключу"""
+    model = AuditLog
+    template_name = 'core/audit_log.html'
+    context_object_name = 'entries'
+
+    def test_func(self):
+        return self.request.user.role in ['admin', 'hr']
+
+    def get_filters(self):
+        params = self.request.GET
+        filters = {
+            'model_name': params.get('model') or None,
+            'object_id': int(params['object_id']) if params.get('object_id', '').isdigit() else None,
+            'user_id': int(params['user']) if params.get('user', '').isdigit() else None,
+        }
+        # Даты — включительно по дню, в текущей таймзоне
+        for key, param, shift in (('date_from', 'from', 0), ('date_to', 'to', 1)):
+            try:
+                day = datetime.strptime(params.get(param, ''), '%Y-%m-%d').date()
+            except ValueError:
+                filters[key] = None
+                continue
+            filters[key] = timezone.make_aware(datetime.combine(day + timedelta(days=shift), time.min))
+        return filters
+
+    def get_queryset(self):
+        self.filters = self.get_filters()
+        entries, self.next_cursor = audit_page(self.filters, before=self.request.GET.get('before'),
+                                               limit=AUDIT_PAGE_SIZE)
+        return entries
 
-# Create your views here.
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.copy()
+        query.pop('before', None)
+        context['filter_query'] = query.urlencode()
+        context['filters'] = self.filters
+        context['next_cursor'] = self.next_cursor
+        context['is_first_page'] = not self.request.GET.get('before')
+        context['users'] = User.objects.order_by('username').only('id', 'username', 'first_name', 'last_name')
+        context['model_names'] = ['KPI', 'Indicator']
+        return context
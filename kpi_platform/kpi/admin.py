@@ -1,13 +1,14 @@
 from django.contrib import admin
-from .models import KPI, Indicator, KPIBonus, MonthStatus
+from .models import KPI, Indicator, KPIBonus, MonthStatus, DepartmentIndicatorRollup, EmployeeMonthSnapshot
+from .versioning import create_new_versions
 
 
 # Экшн для создания новой версии
 @admin.action(description="Создать новую версию (архивировать текущую)")
 def make_new_version(modeladmin, request, queryset):
-    for kpi in queryset:
-        if kpi.is_active:
-            kpi.create_new_version()
+    # Все выбранные KPI — одной транзакцией и пачкой INSERT (архивные пропускаются)
+    new_versions = create_new_versions(queryset, user=request.user)
+    modeladmin.message_user(request, f"Создано новых версий: {len(new_versions)}")
 
 
 class IndicatorInline(admin.TabularInline):
@@ -17,8 +18,11 @@ class IndicatorInline(admin.TabularInline):
 
 @admin.register(KPI)
 class KPIAdmin(admin.ModelAdmin):
-    list_display = ('name', 'employee', 'period', 'version', 'is_active', 'created_at')
+    list_display = ('name', 'employee', 'period', 'version', 'lineage_id', 'total_score', 'is_active', 'created_at')
     list_filter = ('period', 'target_type', 'is_active')
+    list_select_related = ('employee',)
+    # Поиск по номеру цепочки показывает все версии одного KPI
+    search_fields = ('name', '=lineage_id')
     inlines = [IndicatorInline]
     actions = [make_new_version]
 
@@ -38,4 +42,15 @@ class KPIBonus(admin.ModelAdmin):
 
 @admin.register(MonthStatus)
 class MonthStatus(admin.ModelAdmin):
-    list_display = ('month', 'is_closed', 'closed_by', 'closed_at')
\ No newline at end of file
+    list_display = ('month', 'is_closed', 'closed_by', 'closed_at')
+
+@admin.register(DepartmentIndicatorRollup)
+class DepartmentIndicatorRollupAdmin(admin.ModelAdmin):
+    list_display = ('department', 'indicator_name', 'month', 'approved_count', 'fact_quantitative_sum', 'fact_qualitative_sum')
+    list_filter = ('department', 'month')
+
+
+@admin.register(EmployeeMonthSnapshot)
+class EmployeeMonthSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('employee', 'month', 'score', 'payout', 'kpi_count', 'indicators_approved', 'updated_at')
+    list_filter = ('month',)
@@ -0,0 +1,94 @@
+"""
+Графики для PDF-отчета, которые рисуются локально (без обращений к внешним сервисам).
+Результат — SVG в виде data URI, его можно сразу подставить в <img src="...">.
+"""
+import base64
+import math
+from functools import lru_cache
+from xml.sax.saxutils import escape
+
+
+PIE_COLORS = ['#0d6efd', '#198754', '#ffc107', '#dc3545', '#6610f2', '#fd7e14', '#20c997']
+
+PIE_SIZE = 240        # Диаметр круга + поля
+LEGEND_WIDTH = 260    # Место под легенду справа
+LEGEND_ROW = 22
+
+
+def _slice_path(cx, cy, r, start, end):
+    """SVG path сектора круга от угла start до end (радианы, 0 — сверху, по часовой)."""
+    x1 = cx + r * math.sin(start)
+    y1 = cy - r * math.cos(start)
+    x2 = cx + r * math.sin(end)
+    y2 = cy - r * math.cos(end)
+    large_arc = 1 if end - start > math.pi else 0
+    return f"M{cx},{cy} L{x1:.2f},{y1:.2f} A{r},{r} 0 {large_arc} 1 {x2:.2f},{y2:.2f} Z"
+
+
+@lru_cache(maxsize=64)
+def _render_pie_svg(labels, values):
+    cx = cy = PIE_SIZE / 2
+    r = PIE_SIZE / 2 - 10
+    total = sum(v for v in values if v > 0)
+    height = max(PIE_SIZE, LEGEND_ROW * len(labels) + 20)
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{PIE_SIZE + LEGEND_WIDTH}" height="{height}" '
+        f'viewBox="0 0 {PIE_SIZE + LEGEND_WIDTH} {height}" font-family="DejaVu Sans, Arial, sans-serif">'
+    ]
+
+    if total <= 0:
+        parts.append(f'<circle cx="{cx}" cy="{cy}" r="{r}" fill="#e9ecef"/>')
+    else:
+        angle = 0.0
+        for i, value in enumerate(values):
+            if value <= 0:
+                continue
+            color = PIE_COLORS[i % len(PIE_COLORS)]
+            share = value / total
+            if share >= 1:
+                # Единственный сектор — это целый круг, дугой его не нарисовать
+                parts.append(f'<circle cx="{cx}" cy="{cy}" r="{r}" fill="{color}"/>')
+                break
+            end = angle + share * 2 * math.pi
+            parts.append(f'<path d="{_slice_path(cx, cy, r, angle, end)}" fill="{color}" '
+                         f'stroke="#ffffff" stroke-width="1"/>')
+            angle = end
+
+    for i, (label, value) in enumerate(zip(labels, values)):
+        color = PIE_COLORS[i % len(PIE_COLORS)]
+        y = 20 + i * LEGEND_ROW
+        share = (value / total * 100) if total > 0 else 0
+        parts.append(f'<rect x="{PIE_SIZE + 10}" y="{y - 11}" width="12" height="12" fill="{color}"/>')
+        parts.append(f'<text x="{PIE_SIZE + 30}" y="{y}" font-size="12" fill="#212529">'
+                     f'{escape(str(label))} ({share:.1f}%)</text>')
+
+    parts.append('</svg>')
+    svg = ''.join(parts)
+    return "data:image/svg+xml;base64," + base64.b64encode(svg.encode('utf-8')).decode('ascii')
+
+
+def pie_chart_data_uri(labels, values):
+    """
+    Круговая диаграмма долей (например, бонусного фонда по отделам).
+    Результат кэшируется по входным данным: повторный экспорт с теми же цифрами не перерисовывает график.
+    """
+    return _render_pie_svg(tuple(str(label) for label in labels), tuple(float(v) for v in values))
+
+
+def sparkline_points(values, width=160, height=40, padding=3):
+    """
+    Координаты для <polyline points="..."> мини-графика динамики (например, балла по месяцам).
+    Ось Y — от 0 до максимума ряда (не меньше 100%), чтобы разные сотрудники были сопоставимы.
+    """
+    values = [float(v) for v in values]
+    if not values:
+        return ""
+    top = max(max(values), 100.0)
+    step = (width - 2 * padding) / (len(values) - 1) if len(values) > 1 else 0
+    points = []
+    for i, value in enumerate(values):
+        x = padding + i * step if len(values) > 1 else width / 2
+        y = height - padding - (value / top) * (height - 2 * padding)
+        points.append(f"{x:.1f},{y:.1f}")
+    return " ".join(points)
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from kpi.versioning import backfill_lineage
+
+
+class Command(BaseCommand):
+    help = "Связывает в цепочки версий (KPI.lineage_id) KPI, созданные до появления цепочек"
+
+    def handle(self, *args, **options):
+        updated = backfill_lineage()
+        self.stdout.write(self.style.SUCCESS(f"KPI привязано к цепочкам: {updated}"))
@@ -0,0 +1,59 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from kpi.payouts import calculate_payouts
+
+
+def scalar_payouts(scores, targets, t_mins, t_maxs):
+    """Старая построчная формула (как была в представлениях) — для сравнения."""
+    result = []
+    for score, target, t_min, t_max in zip(scores, targets, t_mins, t_maxs):
+        score = float(score)
+        if score >= float(t_min):
+            result.append((min(score, float(t_max)) / 100) * float(target))
+        else:
+            result.append(0)
+    return result
+
+
+class Command(BaseCommand):
+    help = "Бенчмарк движка выплат на синтетическом месяце"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kpis', type=int, default=50000, help="Количество KPI в месяце")
+        parser.add_argument('--repeat', type=int, default=5, help="Сколько раз повторить замер")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        n = options['kpis']
+        rng = np.random.default_rng(options['seed'])
+        scores = rng.uniform(0, 140, n).tolist()
+        targets = rng.integers(10000, 200000, n).tolist()
+        t_mins = rng.choice([70.0, 80.0, 90.0], n).tolist()
+        t_maxs = rng.choice([110.0, 120.0, 125.0], n).tolist()
+
+        def best_of(func):
+            timings = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                func()
+                timings.append(time.perf_counter() - start)
+            return min(timings)
+
+        columns = [np.asarray(c) for c in (scores, targets, t_mins, t_maxs)]
+        vector_time = best_of(lambda: calculate_payouts(*columns))
+        lists_time = best_of(lambda: calculate_payouts(scores, targets, t_mins, t_maxs))
+        scalar_time = best_of(lambda: scalar_payouts(scores, targets, t_mins, t_maxs))
+
+        vector = calculate_payouts(scores, targets, t_mins, t_maxs)
+        scalar = np.array(scalar_payouts(scores, targets, t_mins, t_maxs), dtype=float)
+        if not np.allclose(vector, scalar):
+            self.stderr.write(self.style.ERROR("Результаты векторного и построчного расчета расходятся!"))
+            return
+
+        self.stdout.write(f"KPI в месяце:        {n}")
+        self.stdout.write(f"Векторный расчет:    {vector_time * 1000:.2f} мс")
+        self.stdout.write(f"Векторный (списки):  {lists_time * 1000:.2f} мс")
+        self.stdout.write(f"Построчный расчет:   {scalar_time * 1000:.2f} мс")
+        self.stdout.write(self.style.SUCCESS(f"Ускорение: x{scalar_time / vector_time:.1f}"))
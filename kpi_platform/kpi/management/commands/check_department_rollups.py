@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+from kpi.rollups import rollup_mismatches
+
+
+class Command(BaseCommand):
+    help = "Сверяет сводку по отделам с пересчетом с нуля (расхождения исправляет rebuild_department_rollups)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20, help="Сколько расхождений вывести")
+
+    def handle(self, *args, **options):
+        mismatches = rollup_mismatches()
+        for (department_id, name, month), stored, expected in mismatches[:options['limit']]:
+            self.stdout.write(f"отдел {department_id} / {name} / {month:%m.%Y}: в сводке {stored}, ожидается {expected}")
+
+        if mismatches:
+            raise CommandError(f"Расхождений: {len(mismatches)}")
+        self.stdout.write(self.style.SUCCESS("Сводка по отделам согласована"))
@@ -0,0 +1,35 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from kpi.services import close_month, MonthAlreadyClosed
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = "Закрывает месяц: фиксирует выплаты по всем KPI и отмечает MonthStatus"
+
+    def add_arguments(self, parser):
+        parser.add_argument('month', help="Месяц в формате YYYY-MM")
+        parser.add_argument('--user', help="Логин пользователя, от имени которого закрывается месяц")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        try:
+            selected_date = datetime.strptime(options['month'], '%Y-%m').date()
+        except ValueError:
+            raise CommandError("Неверный формат месяца, нужен YYYY-MM")
+
+        user = None
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError(f"Пользователь {options['user']} не найден")
+
+        try:
+            result = close_month(selected_date, user=user, batch_size=options['batch_size'])
+        except MonthAlreadyClosed as e:
+            raise CommandError(str(e))
+
+        for stage, seconds in result['timings'].items():
+            self.stdout.write(f"{stage:<10} {seconds * 1000:.1f} мс")
+        self.stdout.write(self.style.SUCCESS(f"Месяц закрыт. Зафиксировано выплат: {result['updated']}"))
@@ -1,22 +1,30 @@
-from django.core.management.base import BaseCommand
-from kpi.models import KPI, Indicator
-from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from kpi.services import generate_kpis_from_templates, month_sequence
+from datetime import date, datetime
 
 
 class Command(BaseCommand):
+    help = "Создает KPI из активных шаблонов за месяц или диапазон месяцев (повторный запуск ничего не дублирует)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='month_from', help="Первый месяц YYYY-MM (по умолчанию текущий)")
+        parser.add_argument('--to', dest='month_to', help="Последний месяц YYYY-MM (по умолчанию равен --from)")
+
     def handle(self, *args, **options):
-        templates = KPI.objects.filter(is_template=True, is_active=True)
-        for temp in templates:
-            # Создаем копию для текущего месяца
-            new_kpi = temp
-            new_kpi.pk = None
-            new_kpi.is_template = False
-            new_kpi.target_date = date.today().replace(day=1)
-            new_kpi.save()
+        try:
+            first = self._parse_month(options['month_from']) or date.today().replace(day=1)
+            last = self._parse_month(options['month_to']) or first
+        except ValueError:
+            raise CommandError("Неверный формат месяца, нужен YYYY-MM")
+        if last < first:
+            raise CommandError("--to не может быть раньше --from")
+
+        months = month_sequence(first, last)
+        created = generate_kpis_from_templates(months)
+        self.stdout.write(self.style.SUCCESS(
+            f"Создано KPI: {created} ({first:%m.%Y} - {last:%m.%Y})"
+        ))
 
-            # Копируем индикаторы
-            for ind in temp.indicators.all():
-                ind.pk = None
-                ind.kpi = new_kpi
-                ind.status = 'draft'
-                ind.save()
\ No newline at end of file
+    @staticmethod
+    def _parse_month(value):
+        return datetime.strptime(value, '%Y-%m').date() if value else None
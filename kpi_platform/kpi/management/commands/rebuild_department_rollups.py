@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from kpi.models import DepartmentIndicatorRollup
+from kpi.rollups import rebuild_rollups, sync_department_indicators
+
+
+class Command(BaseCommand):
+    help = "Пересобирает сводку одобренных фактов по отделам (DepartmentIndicatorRollup) с нуля"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sync', action='store_true',
+                            help="После пересборки обновить индикаторы KPI отделов")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            rows = rebuild_rollups()
+            if options['sync']:
+                keys = DepartmentIndicatorRollup.objects.values_list('department_id', 'indicator_name', 'month')
+                sync_department_indicators(list(keys))
+        self.stdout.write(self.style.SUCCESS(f"Строк сводки: {rows}"))
@@ -0,0 +1,27 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from kpi.snapshots import refresh_month_snapshots, snapshot_kpis
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает помесячные снимки сотрудников (EmployeeMonthSnapshot) за месяц или за всю историю"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', help="Месяц YYYY-MM (по умолчанию все месяцы с KPI)")
+
+    def handle(self, *args, **options):
+        if options['month']:
+            try:
+                months = [datetime.strptime(options['month'], '%Y-%m').date()]
+            except ValueError:
+                raise CommandError("Неверный формат месяца, нужен YYYY-MM")
+        else:
+            months = snapshot_kpis().values_list('for_month', flat=True).distinct().order_by('for_month')
+
+        total = 0
+        for month in months:
+            with transaction.atomic():
+                total += refresh_month_snapshots(month)
+        self.stdout.write(self.style.SUCCESS(f"Снимков записано: {total}"))
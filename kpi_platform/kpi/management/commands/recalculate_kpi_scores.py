@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from kpi.services import recalculate_all_scores
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает сохраненные баллы индикаторов (weighted_score) и KPI (total_score)"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            indicators, kpis = recalculate_all_scores()
+        self.stdout.write(self.style.SUCCESS(
+            f"Пересчитано индикаторов: {indicators}, KPI: {kpis}"
+        ))
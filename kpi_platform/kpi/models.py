@@ -1,5 +1,7 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.conf import settings
+from core.utils import exclude_db_maintained
 from users.models import Position, User
 
 
@@ -32,50 +34,76 @@ class KPI(models.Model):
     parent_template = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True)
     # Добавим дату, к которой относится экземпляр (например, 01.02.2026)
     for_month = models.DateField(null=True, blank=True, verbose_name="Период (месяц)")
+    # Сумма Indicator.weighted_score, обновляется сигналами при сохранении/удалении индикатора
+    total_score = models.FloatField(default=0, editable=False, verbose_name="Итоговый балл (%)")
+    # Цепочка версий: все версии одного KPI делят lineage_id (см. kpi.versioning) —
+    # id первой версии, выданный БД (open_lineages)
+    lineage_id = models.PositiveBigIntegerField(null=True, blank=True, editable=False, verbose_name="Цепочка версий")
 
 
     def create_new_version(self):
         """Метод для архивации текущего KPI и создания нового"""
-        # 1. Запоминаем ID текущего (старого) KPI
-        old_pk = self.pk
-
-        # 2. Архивируем старый
-        self.is_active = False
-        self.save()
-
-        # 3. Создаем новый объект на основе текущего
-        self.pk = None
-        self.version += 1
-        self.is_active = True
-        self.save()  # Теперь self — это новый объект с новым ID
-
-        # 4. Копируем индикаторы
-        old_indicators = Indicator.objects.filter(kpi_id=old_pk)
-        # Внутри цикла копирования индикаторов:
-        for ind in old_indicators:
-            ind.pk = None
-            ind.kpi = self
-            ind.status = 'draft'
-            ind.fact_quantitative = 0  # Обнуляем
-            ind.fact_qualitative = 0  # Обнуляем
-            ind.save()
-
-        return self
+        from .versioning import create_new_versions
+        new_versions = create_new_versions([self])
+        return new_versions[0] if new_versions else self
 
     def __str__(self):
         return f"{self.name} (v{self.version})"
 
     class Meta:
         ordering = ['-created_at']
+        constraints = [
+            # Один активный экземпляр шаблона на месяц: повторная генерация ничего не дублирует
+            models.UniqueConstraint(
+                fields=['parent_template', 'for_month'],
+                condition=models.Q(is_active=True, parent_template__isnull=False),
+                name='unique_active_kpi_per_template_month'
+            ),
+            # Номер версии в цепочке один: параллельное версионирование не создаст две v2
+            models.UniqueConstraint(fields=['lineage_id', 'version'], name='unique_kpi_lineage_version'),
+        ]
+        indexes = [
+            # KPI сотрудника за месяц (профиль, дашборд, снимки)
+            models.Index(fields=['employee', 'is_active', 'for_month'], name='kpi_employee_active_month_idx'),
+            # Все активные KPI месяца (закрытие месяца, отчет, график статусов)
+            models.Index(fields=['for_month', 'is_active'], name='kpi_month_active_idx'),
+            # Текущая версия и история версий KPI
+            models.Index(fields=['lineage_id', 'is_active', 'version'], name='kpi_lineage_idx'),
+        ]
+
+    # Поля, от которых зависит сводка по отделу (rollup_state)
+    ROLLUP_FIELDS = ('target_type', 'employee_id', 'for_month', 'is_active')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Состояние на момент загрузки — по нему сигналы считают дельты для DepartmentIndicatorRollup.
+        # При .only()/.defer() снимок не делается (чтение отложенного поля снова вызвало бы from_db):
+        # сигналы прочитают состояние из БД
+        if set(cls.ROLLUP_FIELDS).issubset(field_names):
+            instance._loaded_rollup_state = instance.rollup_state()
+        return instance
+
+    def rollup_state(self):
+        return tuple(getattr(self, field) for field in self.ROLLUP_FIELDS)
 
     def get_total_score(self):
-        return sum(ind.weighted_result for ind in self.indicators.all())  # Вместо self.indicator_set.all()
+        # Хранимое значение, пересчитывается в kpi.signals (см. services.refresh_kpi_scores)
+        return self.total_score
 
     def save(self, *args, **kwargs):
         if self.for_month:
             # Автоматически ставим 1-е число месяца
             self.for_month = self.for_month.replace(day=1)
-        super().save(*args, **kwargs)
+        # total_score ведут сигналы индикаторов одним UPDATE: устаревший объект не должен затирать его
+        exclude_db_maintained(self, kwargs, ['total_score'])
+        if not (self._state.adding and self.lineage_id is None):
+            super().save(*args, **kwargs)
+            return
+        # Первая версия открывает свою цепочку: id известен только после INSERT
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            open_lineages([self])
 
     def get_period_label(self):
         if not self.for_month:
@@ -93,6 +121,26 @@ class KPI(models.Model):
         return f"{self.for_month}"
 
 
+def open_lineages(kpis, batch_size=500):
+    """
+    Открывает цепочки версий только что созданных KPI без lineage_id: цепочка — id первой
+    версии, выданный БД (так же связаны и KPI, созданные до появления цепочек), поэтому
+    цепочки уникальны и упорядочены по времени создания. Один UPDATE на batch_size KPI;
+    вызывается в транзакции создания.
+    """
+    kpis = [kpi for kpi in kpis if kpi.lineage_id is None]
+    for start in range(0, len(kpis), batch_size):
+        KPI.objects.filter(
+            pk__in=[kpi.pk for kpi in kpis[start:start + batch_size]], lineage_id__isnull=True
+        ).update(lineage_id=F('pk'))
+    for kpi in kpis:
+        kpi.lineage_id = kpi.pk
+        # Аудит (core.audit) уже запомнил состояние после INSERT — цепочка не должна попасть в diff правки
+        original = getattr(kpi, '_audit_original', None)
+        if original is not None:
+            original['lineage_id'] = kpi.pk
+
+
 class Indicator(models.Model):
     TYPE_CHOICES = (
         ('numeric', 'Numeric'),
@@ -124,6 +172,8 @@ class Indicator(models.Model):
     fact_quantitative = models.FloatField(default=0, verbose_name="Факт Колич. (%)")
     fact_qualitative = models.FloatField(default=0, verbose_name="Факт Качеств. (%)")
     rejection_reason = models.TextField(null=True, blank=True, verbose_name="Причина отклонения")
+    # Сохраненный weighted_result, из него собирается KPI.total_score
+    weighted_score = models.FloatField(default=0, editable=False, verbose_name="Вклад в KPI (%)")
 
     @property
     def total_performance(self):
@@ -142,9 +192,35 @@ class Indicator(models.Model):
         """
         return (self.total_performance * self.weight) / 100
 
+    ROLLUP_FIELDS = ('kpi_id', 'name', 'status', 'fact_quantitative', 'fact_qualitative')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Как у KPI.from_db: снимок только для полностью загруженных полей сводки
+        if set(cls.ROLLUP_FIELDS).issubset(field_names):
+            instance._loaded_rollup_state = instance.rollup_state()
+        return instance
+
+    def rollup_state(self):
+        return tuple(getattr(self, field) for field in self.ROLLUP_FIELDS)
+
+    def save(self, *args, **kwargs):
+        self.weighted_score = self.weighted_result
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'weighted_score' not in update_fields:
+            kwargs['update_fields'] = [*update_fields, 'weighted_score']
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.name} ({self.weight}%)"
 
+    class Meta:
+        indexes = [
+            # Очередь проверки и выборки индикаторов по статусу в пределах KPI
+            models.Index(fields=['status', 'kpi'], name='indicator_status_kpi_idx'),
+        ]
+
 
 class KPIBonus(models.Model):
     kpi = models.OneToOneField(KPI, on_delete=models.CASCADE, related_name='bonus_setup')
@@ -166,4 +242,66 @@ class MonthStatus(models.Model):
     closed_at = models.DateTimeField(auto_now_add=True, null=True)
 
     def __str__(self):
-        return f"{self.month.strftime('%B %Y')} - {'Закрыт' if self.is_closed else 'Открыт'}"
\ No newline at end of file
+        return f"{self.month.strftime('%B %Y')} - {'Закрыт' if self.is_closed else 'Открыт'}"
+
+
+class DepartmentIndicatorRollup(models.Model):
+    """
+    Сумма одобренных фактов сотрудников отдела по индикатору за месяц.
+    Обновляется дельтами в kpi.signals, пересобирается командой rebuild_department_rollups.
+    """
+    department = models.ForeignKey('users.Department', on_delete=models.CASCADE, related_name='indicator_rollups')
+    indicator_name = models.CharField(max_length=255)
+    month = models.DateField(verbose_name="Месяц")
+    approved_count = models.IntegerField(default=0, verbose_name="Одобрено индикаторов")
+    fact_quantitative_sum = models.FloatField(default=0)
+    fact_qualitative_sum = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['department', 'indicator_name', 'month'],
+                                    name='unique_department_indicator_month'),
+        ]
+
+    @property
+    def fact_quantitative_avg(self):
+        return self.fact_quantitative_sum / self.approved_count if self.approved_count else 0
+
+    @property
+    def fact_qualitative_avg(self):
+        return self.fact_qualitative_sum / self.approved_count if self.approved_count else 0
+
+    def __str__(self):
+        return f"{self.department} / {self.indicator_name} / {self.month:%m.%Y}"
+
+
+class EmployeeMonthSnapshot(models.Model):
+    """
+    Итоги сотрудника за месяц для профиля: средний балл по активным KPI месяца,
+    выплата и счетчики индикаторов по статусам. Пересчитывается kpi.snapshots
+    при изменении индикаторов/KPI/бонусов и при закрытии месяца.
+    """
+    employee = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='month_snapshots')
+    month = models.DateField(verbose_name="Месяц")
+    score = models.FloatField(default=0, verbose_name="Средний балл (%)")
+    payout = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name="Выплата")
+    kpi_count = models.PositiveIntegerField(default=0)
+    indicators_draft = models.PositiveIntegerField(default=0)
+    indicators_on_review = models.PositiveIntegerField(default=0)
+    indicators_approved = models.PositiveIntegerField(default=0)
+    indicators_rejected = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['month']
+        constraints = [
+            # Индекс (employee, month) обслуживает выборку истории одним range-запросом
+            models.UniqueConstraint(fields=['employee', 'month'], name='unique_employee_month_snapshot'),
+        ]
+
+    @property
+    def indicators_total(self):
+        return self.indicators_draft + self.indicators_on_review + self.indicators_approved + self.indicators_rejected
+
+    def __str__(self):
+        return f"{self.employee} / {self.month:%m.%Y}: {self.score:.1f}%"
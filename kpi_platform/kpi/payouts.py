@@ -0,0 +1,64 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+import numpy as np
+
+
+# Значения по умолчанию, если у бонуса пороги не заданы
+DEFAULT_THRESHOLD_MIN = 80.0
+DEFAULT_THRESHOLD_MAX = 120.0
+
+
+def _column(values, default=0.0):
+    """Превращает колонку (возможно с None) в float-массив, пропуски заменяет default."""
+    arr = np.asarray(values, dtype=float)  # None -> nan
+    return np.where(np.isnan(arr), default, arr)
+
+
+def calculate_payouts(scores, target_amounts, threshold_min, threshold_max,
+                      final_payouts=None, is_calculated=None):
+    """
+    Векторный расчет выплат по всем KPI сразу.
+
+    Балл ниже нижнего порога -> 0, выше верхнего -> ограничивается верхним порогом,
+    иначе выплата = балл% от целевой суммы. Если передан is_calculated, для
+    зафиксированных бонусов возвращается уже сохраненная final_payout.
+    Все аргументы — последовательности одинаковой длины, результат — np.ndarray.
+    """
+    scores = _column(scores)
+    targets = _column(target_amounts)
+    t_min = _column(threshold_min, DEFAULT_THRESHOLD_MIN)
+    t_max = _column(threshold_max, DEFAULT_THRESHOLD_MAX)
+
+    payouts = np.where(scores >= t_min, np.minimum(scores, t_max) / 100 * targets, 0.0)
+
+    if is_calculated is not None:
+        fixed = np.array(is_calculated, dtype=bool)
+        payouts = np.where(fixed, _column(final_payouts), payouts)
+    return payouts
+
+
+def kpi_payouts(kpis, use_fixed=True):
+    """
+    Выплаты для списка KPI (с подгруженным bonus_setup): {kpi_id: float}.
+    KPI без бонуса в результат не попадают.
+    use_fixed=False пересчитывает даже зафиксированные бонусы (закрытие месяца, утверждение).
+    """
+    pairs = [(k, getattr(k, 'bonus_setup', None)) for k in kpis]
+    pairs = [(k, b) for k, b in pairs if b is not None]
+    if not pairs:
+        return {}
+
+    payouts = calculate_payouts(
+        scores=[k.total_score for k, _ in pairs],
+        target_amounts=[b.target_amount for _, b in pairs],
+        threshold_min=[b.threshold_min for _, b in pairs],
+        threshold_max=[b.threshold_max for _, b in pairs],
+        final_payouts=[b.final_payout for _, b in pairs] if use_fixed else None,
+        is_calculated=[b.is_calculated for _, b in pairs] if use_fixed else None,
+    )
+    return {k.id: float(p) for (k, _), p in zip(pairs, payouts)}
+
+
+def to_money(value):
+    """float -> Decimal с копейками для KPIBonus.final_payout"""
+    return Decimal(str(value)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
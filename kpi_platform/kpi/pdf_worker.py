@@ -0,0 +1,18 @@
+"""
+Рендер PDF в отдельном процессе пула.
+Модуль намеренно не импортирует Django: воркер получает готовый HTML
+и только превращает его в файл, поэтому запускается через spawn без настройки ORM.
+"""
+import os
+from pathlib import Path
+
+
+def render_pdf(html_string, base_url, target_path):
+    """Рендерит HTML в PDF и атомарно кладет файл по target_path."""
+    from weasyprint import HTML
+
+    target = Path(target_path)
+    tmp_path = target.with_suffix('.tmp')
+    HTML(string=html_string, base_url=base_url).write_pdf(str(tmp_path))
+    os.replace(tmp_path, target)
+    return str(target)
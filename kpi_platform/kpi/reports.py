@@ -0,0 +1,319 @@
+"""
+Фоновая генерация PDF-отчета по KPI и кэш готовых файлов.
+
+Данные отчета собираются в запросе (несколько запросов к БД), а рендер WeasyPrint
+уходит в локальный пул процессов. Готовые PDF лежат в KPI_REPORTS_DIR под именем
+KPI_Report_<YYYY-MM>_<ключ>.pdf, где ключ — хэш строк отчета (любая правка, которая видна
+в отчете, дает новый ключ), а для закрытого в MonthStatus месяца — постоянное "closed"
+(такой файл никогда не перерисовывается). Когда готов новый файл месяца, прежние удаляются.
+Статус задачи хранится файлами-маркерами рядом, чтобы его видел любой веб-воркер.
+Маркер .running хранит pid, хост и время старта: рендер, который идет дольше
+KPI_REPORT_TIMEOUT или чей процесс уже завершился, считается брошенным и может быть поставлен заново.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import socket
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.template.loader import render_to_string
+
+from users.models import Department, User
+from .charts import pie_chart_data_uri
+from .payouts import kpi_payouts
+from .pdf_worker import render_pdf
+from .services import is_month_closed, month_kpis
+
+
+MONTHS_RU = {1: 'Январь', 2: 'Февраль', 3: 'Март', 4: 'Апрель', 5: 'Май', 6: 'Июнь',
+             7: 'Июль', 8: 'Август', 9: 'Сентябрь', 10: 'Октябрь', 11: 'Ноябрь', 12: 'Декабрь'}
+
+CLOSED_KEY = 'closed'
+JOB_ID_RE = re.compile(r'^(?P<month>\d{4}-\d{2})_(?P<key>closed|[0-9a-f]{12})$')
+
+logger = logging.getLogger(__name__)
+_executor = None
+
+
+def build_report_context(selected_date):
+    """Данные для шаблона kpi/pdf_report.html за месяц."""
+    departments = Department.objects.all()
+    data = []
+    total_company_bonus = 0
+    company_perf_accumulator = 0
+
+    chart_labels = []
+    chart_values = []
+    summary_table_data = []
+
+    # Все KPI месяца одним запросом, выплаты — одним проходом движка выплат
+    month_kpi_list = list(month_kpis(selected_date).filter(
+        employee__isnull=False
+    ).select_related('bonus_setup'))
+    payouts = kpi_payouts(month_kpi_list)
+    kpis_by_employee = {}
+    for k in month_kpi_list:
+        kpis_by_employee.setdefault(k.employee_id, []).append(k)
+
+    users_by_dept = {}
+    for user in User.objects.filter(id__in=kpis_by_employee.keys()).order_by('id'):
+        users_by_dept.setdefault(user.department_id, []).append(user)
+
+    for dept in departments:
+        dept_data = {
+            'name': dept.name,
+            'employees': [],
+            'total_dept_money': 0,
+            'avg_dept_perf': 0
+        }
+        dept_perf_list = []
+
+        for user in users_by_dept.get(dept.id, []):
+            emp_kpi_list = []
+            emp_total_money = 0
+            for k in kpis_by_employee[user.id]:
+                money = payouts.get(k.id, 0)
+                emp_total_money += money
+                emp_kpi_list.append({'name': k.name, 'perf': k.total_score, 'money': money})
+
+            emp_avg_perf = sum([k['perf'] for k in emp_kpi_list]) / len(emp_kpi_list)
+            dept_perf_list.append(emp_avg_perf)
+
+            dept_data['employees'].append({
+                'full_name': user.get_full_name() or user.username,
+                'kpis': emp_kpi_list,
+                'subtotal_money': emp_total_money,
+                'avg_perf': emp_avg_perf
+            })
+            dept_data['total_dept_money'] += emp_total_money
+
+        if dept_data['employees']:
+            dept_data['avg_dept_perf'] = sum(dept_perf_list) / len(dept_perf_list)
+            data.append(dept_data)
+
+            total_company_bonus += dept_data['total_dept_money']
+            company_perf_accumulator += dept_data['avg_dept_perf']
+
+            chart_labels.append(dept_data['name'])
+            chart_values.append(float(dept_data['total_dept_money']))
+
+    company_avg_perf = company_perf_accumulator / len(data) if data else 0
+
+    for i in range(len(chart_labels)):
+        share = (chart_values[i] / total_company_bonus * 100) if total_company_bonus > 0 else 0
+        summary_table_data.append({
+            'name': chart_labels[i],
+            'amount': chart_values[i],
+            'share': share
+        })
+
+    # График рисуется локально (SVG data URI), WeasyPrint не ходит в сеть
+    chart_url = pie_chart_data_uri(chart_labels, chart_values)
+
+    return {
+        'data': data,
+        'period': MONTHS_RU.get(selected_date.month),
+        'year': selected_date.year,
+        'total_company_bonus': total_company_bonus,
+        'company_avg_perf': company_avg_perf,
+        'summary_table': summary_table_data,
+        'chart_url': chart_url,
+        'today': datetime.now(),
+    }
+
+
+def data_fingerprint(context):
+    """
+    Короткий хэш строк отчета (контекст build_report_context без даты формирования и картинки
+    графика, которая строится из тех же сумм): меняется при любой правке, которая видна в отчете,
+    — переименовании, переводе в другой отдел, взаимно компенсирующихся изменениях сумм.
+    """
+    rows = {key: value for key, value in context.items() if key not in ('today', 'chart_url')}
+    return hashlib.sha1(repr(rows).encode()).hexdigest()[:12]
+
+
+def reports_dir():
+    path = Path(settings.KPI_REPORTS_DIR)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def report_job(selected_date):
+    """
+    (job_id, контекст отчета или None). Для открытого месяца контекст собирается ради ключа —
+    его же отдают в submit_report, чтобы не собирать второй раз.
+    """
+    if is_month_closed(selected_date):
+        return f"{selected_date:%Y-%m}_{CLOSED_KEY}", None
+    context = build_report_context(selected_date)
+    return f"{selected_date:%Y-%m}_{data_fingerprint(context)}", context
+
+
+def report_job_id(selected_date):
+    return report_job(selected_date)[0]
+
+
+def report_path(job_id):
+    return reports_dir() / f"KPI_Report_{job_id}.pdf"
+
+
+def _marker(job_id, state):
+    return reports_dir() / f"KPI_Report_{job_id}.{state}"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, TypeError, OverflowError):
+        # Процесс есть, но чужой (или pid не записан) — судим только по времени
+        return True
+    return True
+
+
+def _running_info(path):
+    """Содержимое маркера .running ({pid, host, started}) или None, если маркера нет."""
+    try:
+        info = json.loads(path.read_text(encoding='utf-8'))
+        started = path.stat().st_mtime
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        info, started = {}, path.stat().st_mtime
+    info.setdefault('started', started)
+    return info
+
+
+def _running_is_stale(path):
+    """
+    Рендер брошен: идет дольше KPI_REPORT_TIMEOUT или процесс, поставивший его
+    (пул живет в нем), уже не работает на этой машине.
+    """
+    info = _running_info(path)
+    if info is None:
+        return False
+    if time.time() - info['started'] > settings.KPI_REPORT_TIMEOUT:
+        return True
+    return info.get('host') == socket.gethostname() and not _pid_alive(info.get('pid'))
+
+
+def _prune_superseded(job_id, started):
+    """
+    Удаляет файлы и маркеры ошибок того же месяца, появившиеся до старта задачи job_id:
+    ее данные новее. Файл рендера, поставленного позже, но закончившего раньше, остается.
+    """
+    month = JOB_ID_RE.match(job_id).group('month')
+    for path in reports_dir().glob(f"KPI_Report_{month}_*"):
+        if path.name.startswith(f"KPI_Report_{job_id}.") or path.suffix not in ('.pdf', '.failed'):
+            continue
+        try:
+            if path.stat().st_mtime < started:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _fail(job_id, message):
+    _marker(job_id, 'failed').write_text(message, encoding='utf-8')
+    _marker(job_id, 'running').unlink(missing_ok=True)
+
+
+def job_status(job_id):
+    """ready | running | failed | missing. Брошенный рендер переводится в failed."""
+    if report_path(job_id).exists():
+        return 'ready'
+    running = _marker(job_id, 'running')
+    if running.exists():
+        if not _running_is_stale(running):
+            return 'running'
+        _fail(job_id, "Генерация отчета прервана")
+    if _marker(job_id, 'failed').exists():
+        return 'failed'
+    return 'missing'
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn: воркеру не нужен форк процесса с открытыми соединениями к БД
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.KPI_REPORT_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _executor
+
+
+def _reset_executor():
+    """Сломанный пул (процесс воркера упал) закрывается, следующий рендер поднимет новый."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _on_done(job_id, future):
+    error = future.exception()
+    if error is None:
+        running = _marker(job_id, 'running')
+        info = _running_info(running)
+        _prune_superseded(job_id, info['started'] if info else time.time())
+        running.unlink(missing_ok=True)
+        return
+    if isinstance(error, BrokenProcessPool):
+        _reset_executor()
+    _fail(job_id, str(error) or error.__class__.__name__)
+
+
+def _run(job_id, html_string, base_url):
+    target = str(report_path(job_id))
+    if not settings.KPI_REPORT_WORKERS:
+        # Без пула (KPI_REPORT_WORKERS=0) — рендер прямо в запросе
+        future = Future()
+        try:
+            future.set_result(render_pdf(html_string, base_url, target))
+        except Exception as error:
+            future.set_exception(error)
+        _on_done(job_id, future)
+        return
+    try:
+        future = _get_executor().submit(render_pdf, html_string, base_url, target)
+    except BrokenProcessPool:
+        _reset_executor()
+        future = _get_executor().submit(render_pdf, html_string, base_url, target)
+    future.add_done_callback(lambda f: _on_done(job_id, f))
+
+
+def submit_report(selected_date, base_url, job_id=None, context=None):
+    """
+    Ставит рендер отчета в пул, если готового файла нет и задача еще не идет.
+    context — уже собранный report_job контекст. Возвращает job_id.
+    """
+    if job_id is None:
+        job_id, context = report_job(selected_date)
+    if job_status(job_id) in ('ready', 'running'):
+        return job_id
+
+    html_string = render_to_string('kpi/pdf_report.html', context or build_report_context(selected_date))
+    _marker(job_id, 'failed').unlink(missing_ok=True)
+    # Кто и когда поставил рендер — по этому job_status распознает брошенную задачу
+    _marker(job_id, 'running').write_text(json.dumps({
+        'pid': os.getpid(), 'host': socket.gethostname(), 'started': time.time(),
+    }), encoding='utf-8')
+    try:
+        _run(job_id, html_string, base_url)
+    except Exception as error:
+        # Страница ожидания покажет ошибку по маркеру failed
+        logger.exception("Не удалось поставить рендер отчета %s", job_id)
+        if isinstance(error, BrokenProcessPool):
+            _reset_executor()
+        _fail(job_id, str(error) or error.__class__.__name__)
+    return job_id
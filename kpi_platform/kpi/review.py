@@ -0,0 +1,127 @@
+"""
+Очередь проверки индикаторов для HR и массовое одобрение/отклонение.
+
+Очередь листается по ключу (id > курсор), поэтому страница стоит одинаково
+и в начале, и в конце длинного списка. Массовая операция проходит одной
+транзакцией: индикаторы обновляются bulk_update, а баллы KPI, бонусы,
+сводка по отделам, аудит и уведомления пересчитываются по одному разу
+на каждый затронутый KPI (сигналы post_save при bulk_update не вызываются).
+"""
+from django.db import transaction
+
+from core.audit import record
+from core.dispatch import deferred_side_effects, dispatch
+from .models import KPI, Indicator, KPIBonus
+from .payouts import kpi_payouts, to_money
+from .rollups import apply_rollup_deltas, indicator_deltas, sync_department_indicators
+from .services import closed_months, refresh_kpi_scores
+from .signals import send_indicator_notifications
+from .snapshots import refresh_snapshots_for_kpis
+
+
+REVIEW_PAGE_SIZE = 50
+REVIEW_MAX_PAGE_SIZE = 200
+REVIEW_MAX_BATCH = 1000
+# Курсор — id индикатора; больше не бывает (и не поместится в параметр запроса к БД)
+MAX_CURSOR = 2 ** 63 - 1
+
+
+def parse_cursor(value):
+    """Курсор из GET или None (первая страница) для пустого, битого или подделанного значения."""
+    if not value or not value.isdigit() or not value.isascii():
+        return None
+    cursor = int(value)
+    return cursor if 0 < cursor <= MAX_CURSOR else None
+
+
+def review_queue(department_id=None, month=None, after=None, limit=REVIEW_PAGE_SIZE):
+    """
+    Страница индикаторов на проверке (старые сверху).
+    Возвращает (индикаторы, курсор следующей страницы или None).
+    """
+    qs = Indicator.objects.filter(status='on_review').select_related('kpi__employee')
+    if department_id:
+        qs = qs.filter(kpi__employee__department_id=department_id)
+    if month:
+        qs = qs.filter(kpi__for_month=month.replace(day=1))
+    if after:
+        qs = qs.filter(id__gt=after)
+
+    # Берем на одну запись больше — так без COUNT понятно, есть ли следующая страница
+    page = list(qs.order_by('id')[:limit + 1])
+    next_cursor = page[limit - 1].id if len(page) > limit else None
+    return page[:limit], next_cursor
+
+
+def review_indicators(indicator_ids, approve, reviewer=None, reason=None):
+    """
+    Одобряет или отклоняет выбранные индикаторы (только находящиеся на проверке
+    и не из закрытого месяца).
+    Для KPI, у которых после одобрения все индикаторы подтверждены, фиксируется бонус.
+    Возвращает {'updated': число индикаторов, 'completed': [(kpi, выплата), ...]}.
+    """
+    new_status = 'approved' if approve else 'rejected'
+    completed = []
+
+    with transaction.atomic(), deferred_side_effects():
+        indicators = list(
+            Indicator.objects.select_for_update()
+            .filter(id__in=indicator_ids, status='on_review')
+            .exclude(kpi__for_month__in=closed_months())
+        )
+        if not indicators:
+            return {'updated': 0, 'completed': completed}
+
+        transitions = []
+        old_statuses = {}
+        for indicator in indicators:
+            old_statuses[indicator.pk] = (indicator.status, indicator.rejection_reason)
+            old_state = indicator.rollup_state()
+            indicator.status = new_status
+            if not approve and reason:
+                indicator.rejection_reason = reason
+            transitions.append((old_state, indicator.rollup_state()))
+        Indicator.objects.bulk_update(indicators, ['status', 'rejection_reason'], batch_size=500)
+
+        kpi_ids = {indicator.kpi_id for indicator in indicators}
+        changed_rollups = apply_rollup_deltas(indicator_deltas(transitions))
+        refresh_kpi_scores(kpi_ids)
+
+        if approve:
+            not_approved = [status for status, _ in Indicator.STATUS_CHOICES if status != 'approved']
+            kpis = list(
+                KPI.objects.filter(id__in=kpi_ids, bonus_setup__isnull=False)
+                .exclude(indicators__status__in=not_approved)
+                .select_related('bonus_setup')
+            )
+            payouts = kpi_payouts(kpis, use_fixed=False)
+            bonuses = []
+            for kpi in kpis:
+                bonus = kpi.bonus_setup
+                bonus.final_payout = to_money(payouts[kpi.id])
+                bonus.is_calculated = True
+                bonuses.append(bonus)
+                completed.append((kpi, bonus.final_payout))
+            KPIBonus.objects.bulk_update(bonuses, ['final_payout', 'is_calculated'], batch_size=500)
+
+        # Побочные эффекты — те же, что дают сигналы при save(), но одной пачкой блока после коммита
+        for indicator in indicators:
+            old_status, old_reason = old_statuses[indicator.pk]
+            diff = {'status': [old_status, indicator.status]}
+            if indicator.rejection_reason != old_reason:
+                diff['rejection_reason'] = [old_reason, indicator.rejection_reason]
+            record("Approved" if approve else "Rejected", 'Indicator', indicator.id,
+                   changes=f"{indicator}", diff=diff, user=reviewer)
+            dispatch(send_indicator_notifications, {
+                'kpi_id': indicator.kpi_id,
+                'name': indicator.name,
+                'status': indicator.status,
+                'status_display': indicator.get_status_display(),
+                'hr_comment': indicator.hr_comment,
+            })
+        for key in changed_rollups:
+            dispatch(sync_department_indicators, key)
+        for kpi_id in kpi_ids:
+            dispatch(refresh_snapshots_for_kpis, kpi_id)
+
+    return {'updated': len(indicators), 'completed': completed}
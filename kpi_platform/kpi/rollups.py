@@ -0,0 +1,237 @@
+"""
+Сводка одобренных фактов сотрудников по отделам (DepartmentIndicatorRollup).
+
+Строка сводки — (отдел, название индикатора, месяц): число одобренных индикаторов
+и суммы фактов. Сигналы меняют ее дельтами при одобрении, правке и снятии одобрения,
+поэтому индикаторы KPI отдела обновляются за O(1), без пересчета всего отдела.
+Перевод сотрудника в другой отдел переносит его одобренные факты между строками сводки.
+"""
+from collections import defaultdict
+
+from django.db.models import Count, F, Sum
+
+from core.dispatch import deferred_side_effects
+from users.models import User
+from .models import KPI, Indicator, DepartmentIndicatorRollup
+
+
+def approved_indicators():
+    """Индикаторы, которые входят в сводку (полная выборка — для пересборки и проверки)."""
+    return Indicator.objects.filter(
+        status='approved',
+        kpi__target_type='employee',
+        kpi__is_active=True,
+        kpi__for_month__isnull=False,
+        kpi__employee__department__isnull=False,
+    )
+
+
+def expected_rollups():
+    """{(department_id, indicator_name, month): (count, quantitative_sum, qualitative_sum)} по текущим данным."""
+    rows = approved_indicators().values(
+        'kpi__employee__department_id', 'name', 'kpi__for_month'
+    ).annotate(
+        count=Count('id'), quantitative=Sum('fact_quantitative'), qualitative=Sum('fact_qualitative')
+    )
+    return {
+        (r['kpi__employee__department_id'], r['name'], r['kpi__for_month']):
+            (r['count'], r['quantitative'] or 0, r['qualitative'] or 0)
+        for r in rows
+    }
+
+
+def kpi_rollup_scope(kpi_state, departments):
+    """
+    (department_id, month) KPI с состоянием KPI.rollup_state() или None, если его индикаторы
+    в сводку не попадают. departments — {employee_id: department_id}.
+    """
+    target_type, employee_id, for_month, is_active = kpi_state
+    if target_type != 'employee' or not is_active or for_month is None:
+        return None
+    department_id = departments.get(employee_id)
+    if department_id is None:
+        return None
+    return department_id, for_month
+
+
+def employee_departments(employee_ids):
+    return dict(User.objects.filter(
+        id__in=[e for e in employee_ids if e is not None]
+    ).values_list('id', 'department_id'))
+
+
+def kpi_scopes(kpi_ids):
+    """{kpi_id: (department_id, month) или None} одним запросом."""
+    rows = KPI.objects.filter(id__in=kpi_ids).values_list(
+        'id', 'target_type', 'employee_id', 'for_month', 'is_active', 'employee__department_id'
+    )
+    return {
+        kpi_id: kpi_rollup_scope((target_type, employee_id, for_month, is_active), {employee_id: department_id})
+        for kpi_id, target_type, employee_id, for_month, is_active, department_id in rows
+    }
+
+
+def indicator_deltas(transitions):
+    """
+    Дельты сводки по переходам индикаторов [(old_state, new_state), ...]
+    (Indicator.rollup_state() или None). KPI всех переходов подгружаются одним запросом.
+    """
+    deltas = {}
+    states = [
+        (state, sign)
+        for old_state, new_state in transitions if old_state != new_state
+        for state, sign in ((old_state, -1), (new_state, 1)) if state and state[2] == 'approved'
+    ]
+    if not states:
+        return deltas
+    scopes = kpi_scopes({s[0] for s, _ in states})
+    for (kpi_id, name, _, fact_quantitative, fact_qualitative), sign in states:
+        scope = scopes.get(kpi_id)
+        if scope:
+            add_contribution(deltas, (scope[0], name, scope[1]), sign, fact_quantitative, fact_qualitative)
+    return deltas
+
+
+def kpi_deltas(kpi_id, old_state, new_state):
+    """Дельты сводки, когда у KPI меняется сотрудник, месяц, тип или активность."""
+    deltas = {}
+    if old_state == new_state:
+        return deltas
+    departments = employee_departments({s[1] for s in (old_state, new_state) if s})
+    old_scope = kpi_rollup_scope(old_state, departments) if old_state else None
+    new_scope = kpi_rollup_scope(new_state, departments) if new_state else None
+    if old_scope == new_scope:
+        return deltas
+    facts = Indicator.objects.filter(kpi_id=kpi_id, status='approved').values_list(
+        'name', 'fact_quantitative', 'fact_qualitative'
+    )
+    for name, fact_quantitative, fact_qualitative in facts:
+        for scope, sign in ((old_scope, -1), (new_scope, 1)):
+            if scope:
+                add_contribution(deltas, (scope[0], name, scope[1]), sign, fact_quantitative, fact_qualitative)
+    return deltas
+
+
+def employee_deltas(employee_id, old_department_id, new_department_id):
+    """Дельты сводки, когда сотрудник переходит в другой отдел: его одобренные факты переезжают вместе с ним."""
+    deltas = {}
+    if old_department_id == new_department_id:
+        return deltas
+    facts = Indicator.objects.filter(
+        status='approved',
+        kpi__employee_id=employee_id,
+        kpi__target_type='employee',
+        kpi__is_active=True,
+        kpi__for_month__isnull=False,
+    ).values_list('name', 'kpi__for_month', 'fact_quantitative', 'fact_qualitative')
+    for name, month, fact_quantitative, fact_qualitative in facts:
+        for department_id, sign in ((old_department_id, -1), (new_department_id, 1)):
+            if department_id:
+                add_contribution(deltas, (department_id, name, month), sign, fact_quantitative, fact_qualitative)
+    return deltas
+
+
+def apply_rollup_deltas(deltas):
+    """
+    deltas — {(department_id, indicator_name, month): [count, quantitative, qualitative]}.
+    Каждая строка сводки меняется одним UPDATE с F(); недостающие строки создаются.
+    Возвращает множество затронутых ключей.
+    """
+    changed = set()
+    for key, (count, quantitative, qualitative) in deltas.items():
+        if not (count or quantitative or qualitative):
+            continue
+        department_id, indicator_name, month = key
+        lookup = dict(department_id=department_id, indicator_name=indicator_name, month=month)
+        changes = dict(
+            approved_count=F('approved_count') + count,
+            fact_quantitative_sum=F('fact_quantitative_sum') + quantitative,
+            fact_qualitative_sum=F('fact_qualitative_sum') + qualitative,
+        )
+        if not DepartmentIndicatorRollup.objects.filter(**lookup).update(**changes):
+            DepartmentIndicatorRollup.objects.get_or_create(**lookup)
+            DepartmentIndicatorRollup.objects.filter(**lookup).update(**changes)
+        changed.add(key)
+    return changed
+
+
+def add_contribution(deltas, key, sign, fact_quantitative, fact_qualitative):
+    delta = deltas.setdefault(key, [0, 0.0, 0.0])
+    delta[0] += sign
+    delta[1] += sign * fact_quantitative
+    delta[2] += sign * fact_qualitative
+
+
+def sync_department_indicators(keys):
+    """
+    Переносит средние одобренные факты из сводки в индикаторы активных KPI отделов
+    за тот же месяц (индикатор сопоставляется по названию).
+    Аудит и снимки от построчных save() уходят одной пачкой в конце.
+    """
+    by_scope = defaultdict(set)
+    for department_id, indicator_name, month in set(keys):
+        by_scope[(department_id, month)].add(indicator_name)
+
+    with deferred_side_effects():
+        _sync_scopes(by_scope)
+
+
+def _sync_scopes(by_scope):
+    for (department_id, month), names in by_scope.items():
+        rollups = {
+            r.indicator_name: r for r in DepartmentIndicatorRollup.objects.filter(
+                department_id=department_id, month=month, indicator_name__in=names
+            )
+        }
+        dept_indicators = Indicator.objects.filter(
+            kpi__department_id=department_id,
+            kpi__target_type='department',
+            kpi__is_active=True,
+            kpi__for_month=month,
+            name__in=names,
+        )
+        for indicator in dept_indicators:
+            rollup = rollups.get(indicator.name)
+            quantitative = rollup.fact_quantitative_avg if rollup else 0
+            qualitative = rollup.fact_qualitative_avg if rollup else 0
+            if (indicator.fact_quantitative, indicator.fact_qualitative) == (quantitative, qualitative):
+                continue
+            indicator.fact_quantitative = quantitative
+            indicator.fact_qualitative = qualitative
+            indicator.save(update_fields=['fact_quantitative', 'fact_qualitative'])
+
+
+def rebuild_rollups():
+    """Полная пересборка сводки по текущим индикаторам. Возвращает число строк."""
+    expected = expected_rollups()
+    DepartmentIndicatorRollup.objects.all().delete()
+    DepartmentIndicatorRollup.objects.bulk_create([
+        DepartmentIndicatorRollup(
+            department_id=department_id, indicator_name=name, month=month,
+            approved_count=count, fact_quantitative_sum=quantitative, fact_qualitative_sum=qualitative,
+        )
+        for (department_id, name, month), (count, quantitative, qualitative) in expected.items()
+    ], batch_size=500)
+    return len(expected)
+
+
+def rollup_mismatches(tolerance=1e-6):
+    """
+    Сравнивает сводку с пересчетом с нуля.
+    Возвращает список (key, stored, expected); stored/expected — (count, q_sum, ql_sum) или None.
+    """
+    expected = expected_rollups()
+    stored = {
+        (r.department_id, r.indicator_name, r.month):
+            (r.approved_count, r.fact_quantitative_sum, r.fact_qualitative_sum)
+        for r in DepartmentIndicatorRollup.objects.all()
+    }
+    # Пустые строки (count=0 после снятия одобрений) эквивалентны отсутствующим
+    empty = (0, 0.0, 0.0)
+    mismatches = []
+    for key in sorted(expected.keys() | stored.keys(), key=str):
+        have = stored.get(key, empty)
+        want = expected.get(key, empty)
+        if have[0] != want[0] or any(abs(a - b) > tolerance for a, b in zip(have[1:], want[1:])):
+            mismatches.append((key, stored.get(key), expected.get(key)))
+    return mismatches
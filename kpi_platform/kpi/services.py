@@ -0,0 +1,303 @@
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import ExpressionWrapper, F, FloatField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from core.dispatch import deferred_side_effects
+from core.utils import month_bounds
+from users.models import User
+from .models import KPI, Indicator, KPIBonus, MonthStatus, open_lineages
+from .payouts import kpi_payouts, to_money
+from .snapshots import refresh_month_snapshots
+
+
+# Вклад индикатора в KPI на стороне БД: ((колич + качеств) / 2) * вес / 100
+# То же самое, что Indicator.weighted_result, но для UPDATE по всей таблице
+WEIGHTED_RESULT_SQL = ExpressionWrapper(
+    (F('fact_quantitative') + F('fact_qualitative')) / 2 * F('weight') / 100,
+    output_field=FloatField()
+)
+
+
+def _total_score_subquery():
+    return Coalesce(
+        Subquery(
+            Indicator.objects.filter(kpi=OuterRef('pk'))
+            .values('kpi')
+            .annotate(total=Sum('weighted_score'))
+            .values('total')
+        ),
+        Value(0.0)
+    )
+
+
+def refresh_kpi_scores(kpi_ids):
+    """Пересчитывает KPI.total_score для переданных KPI одним UPDATE."""
+    return KPI.objects.filter(pk__in=kpi_ids).update(total_score=_total_score_subquery())
+
+
+def recalculate_all_scores():
+    """
+    Полный пересчет хранимых баллов: сначала weighted_score всех индикаторов,
+    затем total_score всех KPI. Два UPDATE независимо от объема данных.
+    """
+    indicators = Indicator.objects.update(weighted_score=WEIGHTED_RESULT_SQL)
+    kpis = KPI.objects.update(total_score=_total_score_subquery())
+    return indicators, kpis
+
+
+def month_kpis(selected_date):
+    """Активные KPI за месяц (фильтр как в представлениях)."""
+    start, end = month_bounds(selected_date)
+    return KPI.objects.filter(is_active=True, for_month__gte=start, for_month__lt=end)
+
+
+class MonthAlreadyClosed(Exception):
+    pass
+
+
+def closed_months():
+    """
+    Закрытые месяцы (подзапрос для фильтра по for_month). Единственное определение закрытия:
+    на нем стоят и is_month_closed (правка и проверка по одному индикатору), и массовая проверка.
+    Месяц закрыт, только если он отмечен в MonthStatus; зафиксированная выплата отдельного KPI
+    (последний индикатор одобрен) месяц не закрывает. Месяцы, закрытые до появления MonthStatus,
+    отмечаются командой close_month: уже зафиксированные выплаты она не пересчитывает.
+    """
+    return MonthStatus.objects.filter(is_closed=True).values('month')
+
+
+def is_month_closed(selected_date):
+    return closed_months().filter(month=selected_date.replace(day=1)).exists()
+
+
+def close_month(selected_date, user=None, batch_size=500):
+    """
+    Закрытие месяца одной транзакцией:
+    пересчет баллов, расчет всех выплат одним проходом, bulk_update бонусов пачками,
+    запись MonthStatus и помесячных снимков сотрудников. Повторное или параллельное закрытие -> MonthAlreadyClosed.
+    Побочные эффекты сохранений внутри (deferred_side_effects) уходят одной пачкой после коммита.
+    Возвращает количество зафиксированных бонусов и время по этапам (сек).
+    """
+    month = selected_date.replace(day=1)
+    timings = {}
+
+    with transaction.atomic(), deferred_side_effects():
+        # Строка MonthStatus служит блокировкой: второй закрывающий ждет коммита первого
+        # (или ловит уникальность month) и затем видит is_closed=True
+        status, _ = MonthStatus.objects.select_for_update().get_or_create(month=month)
+        if status.is_closed:
+            raise MonthAlreadyClosed(f"Месяц {month:%m.%Y} уже закрыт")
+
+        start = time.perf_counter()
+        refresh_kpi_scores(month_kpis(month).values('pk'))
+        timings['scores'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        kpis = list(month_kpis(month).filter(
+            bonus_setup__isnull=False,
+            bonus_setup__is_calculated=False
+        ).select_related('bonus_setup'))
+        payouts = kpi_payouts(kpis, use_fixed=False)
+        bonuses = []
+        for kpi in kpis:
+            bonus = kpi.bonus_setup
+            bonus.final_payout = to_money(payouts[kpi.id])
+            bonus.is_calculated = True
+            bonuses.append(bonus)
+        timings['payouts'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        KPIBonus.objects.bulk_update(bonuses, ['final_payout', 'is_calculated'], batch_size=batch_size)
+        status.is_closed = True
+        status.closed_by = user
+        status.closed_at = timezone.now()
+        status.save()
+        timings['write'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        refresh_month_snapshots(month)
+        timings['snapshots'] = time.perf_counter() - start
+
+    return {'updated': len(bonuses), 'timings': timings}
+
+
+def month_sequence(first_month, last_month):
+    """Список первых чисел месяцев от first_month до last_month включительно."""
+    months = []
+    current = first_month.replace(day=1)
+    last_month = last_month.replace(day=1)
+    while current <= last_month:
+        months.append(current)
+        current = (current.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return months
+
+
+def generate_kpis_from_templates(months, templates=None, batch_size=500):
+    """
+    Создает экземпляры KPI (с индикаторами) из шаблонов на каждый месяц из months.
+    Уже существующие пары (шаблон, месяц) выбираются одним запросом и пропускаются,
+    поэтому повторный запуск и бэкфилл диапазона безопасны. KPI и индикаторы
+    создаются через bulk_create, побочные эффекты — одной пачкой после коммита.
+    Возвращает количество созданных KPI.
+    """
+    months = sorted({m.replace(day=1) for m in months})
+    if templates is None:
+        templates = KPI.objects.filter(is_template=True, is_active=True)
+    templates = list(templates)
+    if not months or not templates:
+        return 0
+
+    template_ids = [t.id for t in templates]
+    existing = set(KPI.objects.filter(
+        parent_template_id__in=template_ids,
+        for_month__in=months
+    ).values_list('parent_template_id', 'for_month'))
+
+    indicators_by_template = defaultdict(list)
+    for ind in Indicator.objects.filter(kpi_id__in=template_ids).order_by('id'):
+        indicators_by_template[ind.kpi_id].append(ind)
+
+    pending = [(temp, month) for month in months for temp in templates if (temp.id, month) not in existing]
+    if not pending:
+        return 0
+
+    with transaction.atomic(), deferred_side_effects():
+        new_kpis = KPI.objects.bulk_create([
+            KPI(
+                name=temp.name,
+                period=temp.period,
+                target_type=temp.target_type,
+                department_id=temp.department_id,
+                employee_id=temp.employee_id,
+                position_id=temp.position_id,
+                version=temp.version,
+                is_template=False,
+                parent_template=temp,
+                for_month=month,
+            )
+            for temp, month in pending
+        ], batch_size=batch_size)
+        # Каждый экземпляр — начало своей цепочки версий
+        open_lineages(new_kpis, batch_size=batch_size)
+
+        new_indicators = []
+        for kpi, (temp, _) in zip(new_kpis, pending):
+            for ind in indicators_by_template[temp.id]:
+                new_indicators.append(Indicator(
+                    kpi=kpi,
+                    name=ind.name,
+                    indicator_type=ind.indicator_type,
+                    plan_value=ind.plan_value,
+                    status='draft',
+                    hr_comment=ind.hr_comment,
+                    weight=ind.weight,
+                    desc_quantitative=ind.desc_quantitative,
+                    desc_qualitative=ind.desc_qualitative,
+                    threshold_min=ind.threshold_min,
+                    threshold_max=ind.threshold_max,
+                    fact_quantitative=0,
+                    fact_qualitative=0,
+                    weighted_score=0,
+                ))
+        Indicator.objects.bulk_create(new_indicators, batch_size=batch_size)
+
+        # bulk_create не шлет сигналы — снимки профилей за эти месяцы обновляем сами
+        for month in {month for _, month in pending}:
+            refresh_month_snapshots(month)
+
+    return len(new_kpis)
+
+
+def build_dashboard_data(departments, selected_date):
+    """
+    Собирает дерево отделы -> сотрудники -> KPI -> бонусы для DashboardView.
+    Количество запросов не зависит от размера компании:
+    сотрудники, KPI сотрудников (с бонусами) и KPI отделов.
+    """
+    departments = list(departments)
+    dept_ids = [d.id for d in departments]
+
+    employees_by_dept = defaultdict(list)
+    employees = User.objects.filter(department_id__in=dept_ids).select_related('position').order_by('id')
+    for emp in employees:
+        employees_by_dept[emp.department_id].append(emp)
+
+    # Все KPI сотрудников выбранных отделов за месяц, балл уже хранится в total_score
+    kpis_by_employee = defaultdict(list)
+    emp_kpis = month_kpis(selected_date).filter(
+        employee__department_id__in=dept_ids
+    ).select_related('bonus_setup')
+    for k in emp_kpis:
+        kpis_by_employee[k.employee_id].append(k)
+    # Выплаты по всем KPI месяца одним векторным проходом
+    payouts = kpi_payouts(k for kpis in kpis_by_employee.values() for k in kpis)
+
+    # KPI отделов для сводки справа
+    kpis_by_dept = defaultdict(list)
+    dept_kpis = month_kpis(selected_date).filter(
+        department_id__in=dept_ids
+    ).select_related('employee')
+    for k in dept_kpis:
+        kpis_by_dept[k.department_id].append(k)
+
+    departments_data = []
+    total_perf_sum = 0
+    total_emp_count = 0
+    grand_total_money = 0.0
+
+    for dept in departments:
+        dept_employees = employees_by_dept[dept.id]
+        emp_list = []
+        dept_sum_score = 0
+        dept_total_money = 0.0
+
+        for emp in dept_employees:
+            emp_kpis = kpis_by_employee[emp.id]
+            emp_avg_score = 0
+            emp_money = 0.0
+            emp_target_money = 0.0
+
+            if emp_kpis:
+                emp_avg_score = sum(k.total_score for k in emp_kpis) / len(emp_kpis)
+
+                for k in emp_kpis:
+                    bonus = getattr(k, 'bonus_setup', None)
+                    if bonus:
+                        emp_target_money += float(bonus.target_amount or 0)
+                        emp_money += payouts[k.id]
+
+            emp_list.append({
+                'id': emp.id,
+                'full_name': emp.get_full_name() or emp.username,
+                'position': emp.position.name if emp.position else "-",
+                'current_score': emp_avg_score,
+                'target_money': emp_target_money,
+                'money': emp_money
+            })
+            dept_sum_score += emp_avg_score
+            dept_total_money += emp_money
+
+        # Расчет средних по отделу
+        dept_avg = dept_sum_score / len(dept_employees) if dept_employees else 0
+        total_perf_sum += dept_sum_score
+        total_emp_count += len(dept_employees)
+        grand_total_money += dept_total_money
+
+        departments_data.append({
+            'info': dept,
+            'employees': emp_list,
+            'kpis': kpis_by_dept[dept.id],
+            'avg': dept_avg,
+            'total_money': dept_total_money
+        })
+
+    return {
+        'departments_data': departments_data,
+        'grand_total_money': grand_total_money,
+        'dept_avg': total_perf_sum / total_emp_count if total_emp_count > 0 else 0,
+    }
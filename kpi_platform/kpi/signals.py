@@ -1,58 +1,154 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, pre_delete, post_save, post_delete
 from django.dispatch import receiver
-from .models import Indicator, KPI  # Точка важна
+from users.models import User
+from .models import Indicator, KPI, KPIBonus  # Точка важна
+from .services import refresh_kpi_scores
+from .rollups import apply_rollup_deltas, employee_deltas, indicator_deltas, kpi_deltas, sync_department_indicators
+from .snapshots import refresh_employee_snapshots, refresh_snapshots_for_kpis
+from core.dispatch import dispatch
 from notifications.models import Notification
-from django.db import models
+from notifications.services import notify
 
 
 @receiver(post_save, sender=Indicator)
-def handle_indicator_status_change(sender, instance, created, **kwargs):
-    """Отправка уведомлений при изменении статуса индикатора"""
-    if not created:
+@receiver(post_delete, sender=Indicator)
+def update_kpi_total_score(sender, instance, **kwargs):
+    """Поддерживает KPI.total_score в актуальном состоянии"""
+    refresh_kpi_scores([instance.kpi_id])
+
+
+def send_indicator_notifications(events):
+    """
+    Создает уведомления по накопленным изменениям статусов одним INSERT.
+    Сотрудники и их руководители подгружаются одним запросом на всю пачку.
+    """
+    kpis = KPI.objects.filter(
+        id__in={e['kpi_id'] for e in events}
+    ).select_related('employee__superior').in_bulk()
+
+    notifications = []
+    for event in events:
+        employee = kpis[event['kpi_id']].employee if event['kpi_id'] in kpis else None
+        if not employee:
+            continue
+
         # Если статус изменился на "on_review", уведомляем HR или руководителя
-        if instance.status == 'on_review':
-            recipient = instance.kpi.employee.superior if instance.kpi.employee else None
-            if recipient:
-                Notification.objects.create(
-                    recipient=recipient,
-                    sender=instance.kpi.employee,
-                    message=f"Сотрудник {instance.kpi.employee} внес данные по KPI: {instance.name}. Требуется проверка."
-                )
+        if event['status'] == 'on_review':
+            if employee.superior:
+                notifications.append(Notification(
+                    recipient=employee.superior,
+                    sender=employee,
+                    message=f"Сотрудник {employee} внес данные по KPI: {event['name']}. Требуется проверка."
+                ))
 
         # Если статус изменился на "approved" или "rejected", уведомляем сотрудника
-        elif instance.status in ['approved', 'rejected']:
-            if instance.kpi.employee:
-                Notification.objects.create(
-                    recipient=instance.kpi.employee,
-                    message=f"Статус вашего индикатора {instance.name} изменен на: {instance.get_status_display()}. Комментарий: {instance.hr_comment}"
-                )
+        else:
+            notifications.append(Notification(
+                recipient=employee,
+                message=f"Статус вашего индикатора {event['name']} изменен на: {event['status_display']}. Комментарий: {event['hr_comment']}"
+            ))
+
+    notify(notifications)
 
 
 @receiver(post_save, sender=Indicator)
-def update_department_kpi(sender, instance, **kwargs):
-    # Нас интересует только когда статус стал 'approved'
-    if instance.status == 'approved' and instance.kpi.target_type == 'employee':
-        dept = instance.kpi.employee.department
-        if dept:
-            # Ищем KPI департамента с таким же названием (или по логике связи)
-            dept_kpi = KPI.objects.filter(
-                department=dept,
-                target_type='department',
-                name=instance.kpi.name,
-                is_active=True
-            ).first()
-
-            if dept_kpi:
-                # Находим соответствующий индикатор в KPI департамента
-                dept_indicator = dept_kpi.indicators.filter(name=instance.name).first()
-                if dept_indicator:
-                    # Считаем сумму всех одобренных фактов сотрудников этого департамента
-                    total_fact = Indicator.objects.filter(
-                        kpi__department=dept,
-                        kpi__target_type='employee',
-                        name=instance.name,
-                        status='approved'
-                    ).aggregate(models.Sum('fact_value'))['fact_value__sum'] or 0
-
-                    dept_indicator.fact_value = total_fact
-                    dept_indicator.save()
\ No newline at end of file
+def handle_indicator_status_change(sender, instance, created, **kwargs):
+    """Отправка уведомлений при изменении статуса индикатора (после коммита, пачкой)"""
+    if not created and instance.status in ['on_review', 'approved', 'rejected']:
+        dispatch(send_indicator_notifications, {
+            'kpi_id': instance.kpi_id,
+            'name': instance.name,
+            'status': instance.status,
+            'status_display': instance.get_status_display(),
+            'hr_comment': instance.hr_comment,
+        })
+
+
+@receiver(pre_save, sender=Indicator)
+@receiver(pre_save, sender=KPI)
+@receiver(pre_delete, sender=Indicator)
+@receiver(pre_delete, sender=KPI)
+def load_rollup_state(sender, instance, **kwargs):
+    """
+    Объект собран не из БД или с отложенными полями (нет снимка from_db) или уже сохранялся —
+    берем старое состояние из базы: прошлое сохранение могло откатиться вместе с точкой
+    сохранения, и снимок в памяти ему не верен.
+    """
+    if instance.pk and not hasattr(instance, '_loaded_rollup_state'):
+        old = sender.objects.filter(pk=instance.pk).first()
+        instance._loaded_rollup_state = old.rollup_state() if old else None
+
+
+def _apply_rollup(instance, deltas):
+    changed = apply_rollup_deltas(deltas)
+    # Снимок после сохранения не запоминаем (см. load_rollup_state): следующее сохранение прочитает БД
+    instance.__dict__.pop('_loaded_rollup_state', None)
+    for key in changed:
+        dispatch(sync_department_indicators, key)
+
+
+@receiver(post_save, sender=Indicator)
+def update_department_rollup(sender, instance, created, **kwargs):
+    """Сводка по отделу меняется дельтой в той же транзакции, индикаторы отдела — после коммита"""
+    old_state = None if created else instance._loaded_rollup_state
+    _apply_rollup(instance, indicator_deltas([(old_state, instance.rollup_state())]))
+
+
+@receiver(pre_delete, sender=Indicator)
+def collect_department_rollup_removal(sender, instance, **kwargs):
+    """
+    Дельта считается до удаления: при каскаде (удаление сотрудника или KPI) строки KPI
+    и сотрудника могут исчезнуть раньше индикатора, и отдел уже не найти.
+    """
+    instance._rollup_removal = indicator_deltas([(instance._loaded_rollup_state, None)])
+
+
+@receiver(post_delete, sender=Indicator)
+def remove_from_department_rollup(sender, instance, **kwargs):
+    _apply_rollup(instance, instance.__dict__.pop('_rollup_removal', {}))
+
+
+@receiver(post_save, sender=Indicator)
+@receiver(post_delete, sender=Indicator)
+@receiver(post_save, sender=KPIBonus)
+def refresh_snapshot_for_kpi(sender, instance, **kwargs):
+    """Помесячный снимок сотрудника пересчитывается после коммита, один раз на пачку"""
+    dispatch(refresh_snapshots_for_kpis, instance.kpi_id)
+
+
+# Объявлен до move_kpi_rollup: тот обновляет _loaded_rollup_state, а здесь нужен старый месяц/сотрудник
+@receiver(post_save, sender=KPI)
+@receiver(post_delete, sender=KPI)
+def refresh_snapshot_for_kpi_months(sender, instance, **kwargs):
+    old_state = getattr(instance, '_loaded_rollup_state', None)
+    if old_state:
+        dispatch(refresh_employee_snapshots, (old_state[1], old_state[2]))
+    if 'created' in kwargs:
+        # После удаления нужен только прежний месяц (состояние прочитано в pre_delete)
+        dispatch(refresh_employee_snapshots, (instance.employee_id, instance.for_month))
+
+
+@receiver(post_save, sender=KPI)
+def move_kpi_rollup(sender, instance, created, **kwargs):
+    """Смена сотрудника, месяца или архивирование KPI переносит его одобренные факты в сводке"""
+    old_state = None if created else instance._loaded_rollup_state
+    _apply_rollup(instance, kpi_deltas(instance.pk, old_state, instance.rollup_state()))
+
+
+@receiver(pre_save, sender=User)
+def load_employee_department(sender, instance, update_fields=None, **kwargs):
+    """Отдел сотрудника до сохранения — для переноса его фактов в сводке"""
+    if instance.pk and (update_fields is None or 'department' in update_fields):
+        instance._loaded_department_id = sender.objects.filter(pk=instance.pk).values_list(
+            'department_id', flat=True
+        ).first()
+
+
+@receiver(post_save, sender=User)
+def move_employee_rollup(sender, instance, created, **kwargs):
+    """Перевод сотрудника в другой отдел переносит его одобренные факты в сводке"""
+    if created or not hasattr(instance, '_loaded_department_id'):
+        return
+    old_department_id = instance.__dict__.pop('_loaded_department_id')
+    for key in apply_rollup_deltas(employee_deltas(instance.pk, old_department_id, instance.department_id)):
+        dispatch(sync_department_indicators, key)
@@ -0,0 +1,123 @@
+"""
+Помесячные итоги сотрудников (EmployeeMonthSnapshot) для профиля.
+
+Профиль читает историю одним запросом по индексу (employee, month) вместо
+загрузки всех KPI сотрудника. Снимки пересчитываются пачкой по парам
+(сотрудник, месяц): сигналы ставят пары в очередь core.dispatch, закрытие
+месяца и генерация KPI пересчитывают свой месяц сразу.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Count
+
+from .models import KPI, Indicator, EmployeeMonthSnapshot
+from .payouts import kpi_payouts, to_money
+
+
+STATUS_FIELDS = {
+    'draft': 'indicators_draft',
+    'on_review': 'indicators_on_review',
+    'approved': 'indicators_approved',
+    'rejected': 'indicators_rejected',
+}
+
+
+def snapshot_kpis():
+    """KPI, которые попадают в снимки: как и в профиле — активные экземпляры с месяцем."""
+    return KPI.objects.filter(
+        employee__isnull=False,
+        for_month__isnull=False,
+        is_active=True,
+        is_template=False,
+    )
+
+
+def _write_snapshots(kpis_qs, pairs=None):
+    """
+    Пересчитывает снимки по KPI из kpis_qs (фильтр по месяцу/сотрудникам делает вызывающий).
+    pairs — пары, которые надо обновить; у пар без KPI снимок удаляется.
+    """
+    kpis = list(kpis_qs.select_related('bonus_setup'))
+    if pairs is not None:
+        kpis = [k for k in kpis if (k.employee_id, k.for_month) in pairs]
+    payouts = kpi_payouts(kpis)
+
+    rows = {}
+    for kpi in kpis:
+        key = (kpi.employee_id, kpi.for_month)
+        row = rows.setdefault(key, {'scores': [], 'payout': Decimal('0'), 'statuses': defaultdict(int)})
+        row['scores'].append(kpi.total_score)
+        if kpi.id in payouts:
+            row['payout'] += to_money(payouts[kpi.id])
+
+    status_counts = Indicator.objects.filter(
+        kpi_id__in=[k.id for k in kpis]
+    ).values('kpi__employee_id', 'kpi__for_month', 'status').annotate(n=Count('id'))
+    for r in status_counts:
+        key = (r['kpi__employee_id'], r['kpi__for_month'])
+        if key in rows:
+            rows[key]['statuses'][r['status']] += r['n']
+
+    snapshots = []
+    for (employee_id, month), row in rows.items():
+        snapshot = EmployeeMonthSnapshot(
+            employee_id=employee_id,
+            month=month,
+            score=sum(row['scores']) / len(row['scores']),
+            payout=row['payout'],
+            kpi_count=len(row['scores']),
+        )
+        for status, field in STATUS_FIELDS.items():
+            setattr(snapshot, field, row['statuses'][status])
+        snapshots.append(snapshot)
+
+    EmployeeMonthSnapshot.objects.bulk_create(
+        snapshots,
+        batch_size=500,
+        update_conflicts=True,
+        unique_fields=['employee', 'month'],
+        update_fields=['score', 'payout', 'kpi_count', *STATUS_FIELDS.values(), 'updated_at'],
+    )
+    return rows.keys()
+
+
+def refresh_employee_snapshots(pairs):
+    """Пересчитывает снимки для пар (employee_id, month)."""
+    pairs = {(employee_id, month) for employee_id, month in pairs if employee_id and month}
+    if not pairs:
+        return 0
+    written = _write_snapshots(
+        snapshot_kpis().filter(
+            employee_id__in={e for e, _ in pairs},
+            for_month__in={m for _, m in pairs},
+        ),
+        pairs,
+    )
+    for employee_id, month in pairs - set(written):
+        EmployeeMonthSnapshot.objects.filter(employee_id=employee_id, month=month).delete()
+    return len(written)
+
+
+def refresh_snapshots_for_kpis(kpi_ids):
+    """Обработчик очереди core.dispatch: пересчет снимков по id измененных KPI."""
+    pairs = KPI.objects.filter(id__in=set(kpi_ids)).values_list('employee_id', 'for_month')
+    return refresh_employee_snapshots(pairs)
+
+
+def refresh_month_snapshots(month):
+    """Пересчитывает снимки всех сотрудников за месяц (закрытие месяца, генерация KPI)."""
+    month = month.replace(day=1)
+    written = _write_snapshots(snapshot_kpis().filter(for_month=month))
+    EmployeeMonthSnapshot.objects.filter(month=month).exclude(
+        employee_id__in=[employee_id for employee_id, _ in written]
+    ).delete()
+    return len(written)
+
+
+def lifetime_average(snapshots):
+    """Средний балл по всем KPI сотрудника (взвешен числом KPI месяца, как прежний расчет по KPI)."""
+    kpi_count = sum(s.kpi_count for s in snapshots)
+    if not kpi_count:
+        return 0
+    return sum(s.score * s.kpi_count for s in snapshots) / kpi_count
@@ -1,3 +1,1078 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.messages import get_messages
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from core.audit import write_audit_logs
+from core.testing import assert_uses_index, full_scans
+from core.models import AuditLog
+from notifications.models import Notification
+from core.utils import month_bounds
+from users.models import Department, Position, User
+from . import reports
+from .models import KPI, Indicator, KPIBonus, DepartmentIndicatorRollup, EmployeeMonthSnapshot, MonthStatus
+from .payouts import kpi_payouts, to_money
+from .review import REVIEW_MAX_PAGE_SIZE, REVIEW_PAGE_SIZE, parse_cursor, review_indicators
+from .rollups import rollup_mismatches, sync_department_indicators
+from .services import (
+    MonthAlreadyClosed, build_dashboard_data, close_month, generate_kpis_from_templates, is_month_closed, month_kpis,
+    month_sequence,
+)
+from .versioning import backfill_lineage, create_new_versions, latest_version, versions_of
+
+
+MONTH = date(2026, 1, 1)
+
+
+def make_org(departments, employees_per_dept, kpis_per_employee=2, prefix='u'):
+    """Создает отделы, сотрудников, KPI с индикаторами и бонусами за MONTH."""
+    for d in range(departments):
+        dept = Department.objects.create(name=f"{prefix}-dept-{d}")
+        position = Position.objects.create(name=f"{prefix}-pos-{d}", department=dept)
+        KPI.objects.create(name=f"{prefix}-dept-kpi-{d}", period='monthly', target_type='department',
+                           department=dept, for_month=MONTH)
+        for e in range(employees_per_dept):
+            emp = User.objects.create(username=f"{prefix}-{d}-{e}", department=dept, position=position)
+            for k in range(kpis_per_employee):
+                kpi = KPI.objects.create(name=f"KPI {k}", period='monthly', target_type='employee',
+                                         employee=emp, for_month=MONTH)
+                Indicator.objects.create(kpi=kpi, name="A", indicator_type='percent', plan_value=100,
+                                         weight=60, fact_quantitative=100, fact_qualitative=90)
+                Indicator.objects.create(kpi=kpi, name="B", indicator_type='percent', plan_value=100,
+                                         weight=40, fact_quantitative=80, fact_qualitative=70)
+                KPIBonus.objects.create(kpi=kpi, target_amount=1000)
+
+
+class DashboardDataTests(TestCase):
+
+    def test_values_match_per_kpi_calculation(self):
+        make_org(departments=1, employees_per_dept=2)
+        data = build_dashboard_data(Department.objects.all(), MONTH)
+
+        # (100+90)/2*0.6 + (80+70)/2*0.4 = 57 + 30 = 87
+        dept = data['departments_data'][0]
+        self.assertEqual(len(dept['employees']), 2)
+        self.assertAlmostEqual(dept['employees'][0]['current_score'], 87.0)
+        self.assertAlmostEqual(dept['employees'][0]['target_money'], 2000.0)
+        self.assertAlmostEqual(dept['employees'][0]['money'], 1740.0)
+        self.assertAlmostEqual(dept['avg'], 87.0)
+        self.assertAlmostEqual(data['grand_total_money'], 3480.0)
+        self.assertAlmostEqual(data['dept_avg'], 87.0)
+        self.assertEqual(len(dept['kpis']), 1)
+
+    def test_query_count_does_not_grow_with_headcount(self):
+        make_org(departments=1, employees_per_dept=1, prefix='small')
+        with CaptureQueriesContext(connection) as small:
+            build_dashboard_data(Department.objects.all(), MONTH)
+
+        make_org(departments=5, employees_per_dept=8, prefix='big')
+        with CaptureQueriesContext(connection) as big:
+            data = build_dashboard_data(Department.objects.all(), MONTH)
+
+        self.assertEqual(len(data['departments_data']), 6)
+        self.assertEqual(len(small.captured_queries), len(big.captured_queries))
+        self.assertLessEqual(len(big.captured_queries), 5)
+
+
+class KPIScoreTests(TestCase):
+    """KPI.total_score и Indicator.weighted_score хранятся в БД и ведутся сигналами."""
+
+    def setUp(self):
+        self.kpi = KPI.objects.create(name="Продажи", period='monthly', target_type='employee', for_month=MONTH)
+        self.first = Indicator.objects.create(kpi=self.kpi, name="A", indicator_type='percent', plan_value=100,
+                                              weight=60, fact_quantitative=100, fact_qualitative=90)
+        Indicator.objects.create(kpi=self.kpi, name="B", indicator_type='percent', plan_value=100,
+                                 weight=40, fact_quantitative=80, fact_qualitative=70)
+
+    def stored_score(self):
+        return KPI.objects.values_list('total_score', flat=True).get(pk=self.kpi.pk)
+
+    def test_score_follows_indicator_save_and_delete(self):
+        # (100+90)/2*0.6 + (80+70)/2*0.4 = 57 + 30
+        self.assertAlmostEqual(self.stored_score(), 87.0)
+        self.first.fact_qualitative = 100
+        self.first.save()
+        self.assertAlmostEqual(self.first.weighted_score, 60.0)
+        self.assertAlmostEqual(self.stored_score(), 90.0)
+        self.first.delete()
+        self.assertAlmostEqual(self.stored_score(), 30.0)
+
+    def test_stale_instance_save_keeps_score(self):
+        stale = KPI.objects.get(pk=self.kpi.pk)
+        self.first.fact_qualitative = 100
+        self.first.save()
+
+        stale.name = "Продажи (новое)"
+        stale.save()
+        stale.refresh_from_db()
+        self.assertEqual(stale.name, "Продажи (новое)")
+        self.assertAlmostEqual(stale.total_score, 90.0)
+
+    def test_approving_last_indicator_fixes_bonus(self):
+        KPIBonus.objects.create(kpi=self.kpi, target_amount=1000)
+        Indicator.objects.filter(kpi=self.kpi).update(status='on_review')
+        self.client.force_login(User.objects.create(username='hr', role='hr'))
+        for indicator in self.kpi.indicators.order_by('id'):
+            response = self.client.post(reverse('approve_indicator', args=[indicator.pk]))
+            self.assertRedirects(response, reverse('hr_review_list'), fetch_redirect_response=False)
+
+        bonus = KPIBonus.objects.get(kpi=self.kpi)
+        self.kpi.total_score = 87.0
+        self.assertTrue(bonus.is_calculated)
+        self.assertEqual(bonus.final_payout, to_money(kpi_payouts([self.kpi], use_fixed=False)[self.kpi.id]))
+
+    def test_recalculate_command_repairs_stored_scores(self):
+        Indicator.objects.update(weighted_score=0)
+        KPI.objects.update(total_score=0)
+        call_command('recalculate_kpi_scores', stdout=io.StringIO())
+        self.assertAlmostEqual(self.stored_score(), 87.0)
+        self.assertEqual(sorted(Indicator.objects.values_list('weighted_score', flat=True)), [30.0, 57.0])
+
+
+class KPIGenerationTests(TestCase):
+
+    def setUp(self):
+        dept = Department.objects.create(name="Продажи")
+        self.templates = [
+            KPI.objects.create(name=f"Шаблон {i}", period='monthly', target_type='department',
+                               department=dept, is_template=True)
+            for i in range(2)
+        ]
+        for template in self.templates:
+            Indicator.objects.create(kpi=template, name="Выручка", indicator_type='percent',
+                                     plan_value=100, weight=100)
+
+    def test_rerun_creates_nothing(self):
+        months = [MONTH, date(2026, 2, 1)]
+        self.assertEqual(generate_kpis_from_templates(months), 4)
+        self.assertEqual(generate_kpis_from_templates(months), 0)
+        # Диапазон с уже созданным месяцем дополняет только новые
+        self.assertEqual(generate_kpis_from_templates([date(2026, 2, 1), date(2026, 3, 1)]), 2)
+
+        instances = KPI.objects.filter(is_template=False)
+        self.assertEqual(instances.count(), 6)
+        self.assertEqual(Indicator.objects.filter(kpi__in=instances, status='draft').count(), 6)
+        self.assertEqual(
+            set(instances.values_list('parent_template_id', 'for_month').annotate(n=Count('id')).values_list('n', flat=True)),
+            {1}
+        )
+
+        out = io.StringIO()
+        call_command('generate_monthly_kpis', '--from', '2026-01', '--to', '2026-03', stdout=out)
+        self.assertIn("Создано KPI: 0", out.getvalue())
+
+    def test_constraint_rejects_second_active_instance(self):
+        generate_kpis_from_templates([MONTH])
+        template = self.templates[0]
+        duplicate = dict(name=template.name, period='monthly', target_type='department',
+                         department=template.department, parent_template=template, for_month=MONTH)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            KPI.objects.create(**duplicate)
+        # Неактивные версии того же экземпляра ограничение не затрагивает
+        KPI.objects.create(is_active=False, **duplicate)
+        self.assertEqual(KPI.objects.filter(parent_template=template, for_month=MONTH).count(), 2)
+
+
+class CloseMonthTests(TestCase):
+
+    def setUp(self):
+        make_org(1, 2)
+        self.hr = User.objects.create(username='hr', role='hr')
+        self.employee_kpi = KPI.objects.filter(target_type='employee').first()
+        self.indicator = self.employee_kpi.indicators.first()
+
+    def bonus_state(self):
+        return sorted(KPIBonus.objects.values_list('kpi_id', 'final_payout', 'is_calculated'))
+
+    def test_close_refreshes_scores_and_fixes_bonuses(self):
+        KPI.objects.update(total_score=0)
+        kpis = list(KPI.objects.filter(target_type='employee'))
+        for kpi in kpis:
+            kpi.total_score = 87.0
+        expected = {kpi_id: to_money(payout) for kpi_id, payout in kpi_payouts(kpis, use_fixed=False).items()}
+
+        result = close_month(MONTH, user=self.hr)
+
+        self.assertEqual(result['updated'], 4)
+        self.assertEqual(set(result['timings']), {'scores', 'payouts', 'write', 'snapshots'})
+        self.assertEqual(set(KPI.objects.filter(target_type='employee').values_list('total_score', flat=True)), {87.0})
+        self.assertEqual({kpi_id: payout for kpi_id, payout, _ in self.bonus_state()}, expected)
+        self.assertTrue(all(calculated for _, _, calculated in self.bonus_state()))
+        self.assertEqual(EmployeeMonthSnapshot.objects.filter(month=MONTH).count(), 2)
+        status = MonthStatus.objects.get(month=MONTH)
+        self.assertEqual((status.is_closed, status.closed_by), (True, self.hr))
+        self.assertTrue(is_month_closed(MONTH))
+
+    def test_second_close_raises_and_changes_nothing(self):
+        close_month(MONTH)
+        bonuses = self.bonus_state()
+        closed_at = MonthStatus.objects.get(month=MONTH).closed_at
+        Indicator.objects.filter(pk=self.indicator.pk).update(fact_quantitative=10)
+
+        with self.assertRaises(MonthAlreadyClosed):
+            close_month(MONTH, user=self.hr)
+        self.assertEqual(self.bonus_state(), bonuses)
+        self.assertEqual(MonthStatus.objects.get(month=MONTH).closed_at, closed_at)
+        self.assertIsNone(MonthStatus.objects.get(month=MONTH).closed_by)
+
+        with self.assertRaises(CommandError):
+            call_command('close_month', '2026-01', stdout=io.StringIO())
+
+    def test_close_month_command(self):
+        out = io.StringIO()
+        call_command('close_month', '2026-01', '--user', 'hr', stdout=out)
+        self.assertIn("Зафиксировано выплат: 4", out.getvalue())
+        self.assertEqual(MonthStatus.objects.get(month=MONTH).closed_by, self.hr)
+
+    def test_closed_month_blocks_edits(self):
+        close_month(MONTH)
+        self.client.force_login(User.objects.create(username='admin', role='admin'))
+        closed_redirect = f"{reverse('dashboard')}?month=2026-01"
+        blocked = [
+            reverse('kpi_update', args=[self.employee_kpi.pk]),
+            reverse('kpi_delete', args=[self.employee_kpi.pk]),
+            reverse('indicator_add', args=[self.employee_kpi.pk]),
+            reverse('indicator_edit', args=[self.indicator.pk]),
+            reverse('indicator_update_fact', args=[self.indicator.pk]),
+            reverse('reject_indicator', args=[self.indicator.pk]),
+            reverse('approve_indicator', args=[self.indicator.pk]),
+        ]
+        for url in blocked:
+            with self.subTest(url=url):
+                response = self.client.post(url, {'fact_quantitative': 1, 'rejection_reason': 'x'})
+                self.assertRedirects(response, closed_redirect, fetch_redirect_response=False)
+
+        self.assertTrue(KPI.objects.filter(pk=self.employee_kpi.pk).exists())
+        self.indicator.refresh_from_db()
+        self.assertEqual((self.indicator.status, self.indicator.fact_quantitative), ('draft', 100))
+
+        # Массовая проверка пропускает индикаторы закрытого месяца
+        Indicator.objects.filter(pk=self.indicator.pk).update(status='on_review')
+        self.assertEqual(review_indicators([self.indicator.pk], approve=True)['updated'], 0)
+
+    def test_open_month_stays_editable(self):
+        self.client.force_login(self.hr)
+        response = self.client.get(reverse('indicator_edit', args=[self.indicator.pk]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_fully_approved_kpi_does_not_close_month(self):
+        # Все индикаторы одного KPI одобрены — его выплата зафиксирована, месяц остается открытым
+        self.client.force_login(self.hr)
+        for indicator in self.employee_kpi.indicators.all():
+            self.client.post(reverse('approve_indicator', args=[indicator.pk]))
+        self.assertTrue(KPIBonus.objects.get(kpi=self.employee_kpi).is_calculated)
+        self.assertFalse(is_month_closed(MONTH))
+
+        other = Indicator.objects.filter(kpi__target_type='employee').exclude(kpi=self.employee_kpi).first()
+        self.client.force_login(other.kpi.employee)
+        response = self.client.post(reverse('indicator_update_fact', args=[other.pk]),
+                                    {'fact_quantitative': 55, 'fact_qualitative': 65})
+        self.assertNotEqual(response.get('Location'), f"{reverse('dashboard')}?month=2026-01")
+        other.refresh_from_db()
+        self.assertEqual(other.fact_quantitative, 55)
+
+        self.client.force_login(self.hr)
+        self.client.post(reverse('approve_indicator', args=[other.pk]))
+        self.assertEqual(Indicator.objects.get(pk=other.pk).status, 'approved')
+
+
+class HRReviewQueueTests(TestCase):
+
+    def setUp(self):
+        make_org(2, 2)
+        self.kpi = KPI.objects.filter(target_type='employee').order_by('id').first()
+        # Одинаковые на вид строки: страница не должна ни терять, ни повторять их
+        for _ in range(3):
+            Indicator.objects.create(kpi=self.kpi, name="A", indicator_type='percent', plan_value=100, weight=10)
+        Indicator.objects.update(status='on_review')
+        self.client.force_login(User.objects.create(username='hr', role='hr'))
+
+    def page(self, **params):
+        response = self.client.get(reverse('hr_review_list'), params)
+        self.assertEqual(response.status_code, 200)
+        return [i.pk for i in response.context['pending_indicators']], response.context['next_cursor'], response
+
+    def walk(self, **params):
+        pages, cursor = [], None
+        while True:
+            ids, cursor, _ = self.page(**params, **({'after': cursor} if cursor else {}))
+            pages.append(ids)
+            if cursor is None:
+                return pages
+
+    def queued_ids(self):
+        return list(Indicator.objects.filter(status='on_review').order_by('id').values_list('id', flat=True))
+
+    def test_pages_cover_queue_once(self):
+        expected = self.queued_ids()
+        self.assertEqual(len(expected), 19)
+        for per_page in (1, 5, 19, 50):
+            with self.subTest(per_page=per_page):
+                pages = self.walk(per_page=per_page)
+                self.assertEqual([pk for page in pages for pk in page], expected)
+                self.assertTrue(all(len(page) == per_page for page in pages[:-1]))
+
+    def test_last_page(self):
+        # Ровно заполненная последняя страница не дает пустой страницы после себя
+        pages = self.walk(per_page=19)
+        self.assertEqual(len(pages), 1)
+        ids, cursor, response = self.page(per_page=10, after=self.queued_ids()[8])
+        self.assertEqual((len(ids), cursor), (10, None))
+        self.assertNotContains(response, "Дальше")
+        self.assertContains(response, "В начало очереди")
+
+        ids, cursor, _ = self.page(after=self.queued_ids()[-1])
+        self.assertEqual((ids, cursor), ([], None))
+
+    def test_cursor_is_stable_while_queue_changes(self):
+        first, cursor, _ = self.page(per_page=5)
+        # Между страницами: одобрили строку уже просмотренной и строку следующей страницы, добавили новую
+        Indicator.objects.filter(pk__in=[first[0], first[-1] + 1]).update(status='approved')
+        added = Indicator.objects.create(kpi=self.kpi, name="new", indicator_type='percent', plan_value=1,
+                                         weight=1, status='on_review')
+
+        rest = []
+        while cursor:
+            ids, cursor, _ = self.page(per_page=5, after=cursor)
+            rest += ids
+        self.assertEqual(rest, [pk for pk in self.queued_ids() if pk > first[-1]])
+        self.assertEqual(rest[-1], added.pk)
+        self.assertFalse(set(first) & set(rest))
+
+    def test_invalid_or_tampered_cursor_starts_from_beginning(self):
+        first_page, _, _ = self.page()
+        for cursor in ('abc', '-5', '0', '1.5', '²', '9' * 30, str(2 ** 63)):
+            with self.subTest(cursor=cursor):
+                ids, _, response = self.page(after=cursor)
+                self.assertEqual(ids, first_page)
+                self.assertTrue(response.context['is_first_page'])
+        self.assertIsNone(parse_cursor(str(2 ** 63)))
+        self.assertEqual(parse_cursor(str(2 ** 63 - 1)), 2 ** 63 - 1)
+
+    def test_page_size_is_clamped(self):
+        for value, expected in (('x', REVIEW_PAGE_SIZE), ('0', 1), ('100000', REVIEW_MAX_PAGE_SIZE)):
+            with self.subTest(per_page=value):
+                self.assertEqual(self.page(per_page=value)[2].context['per_page'], expected)
+
+    def test_filters_are_kept_in_cursor_links(self):
+        department = self.kpi.employee.department
+        ids, cursor, response = self.page(department=department.pk, month='2026-01', per_page=2)
+        self.assertEqual(set(Indicator.objects.filter(pk__in=ids).values_list('kpi__employee__department', flat=True)),
+                         {department.pk})
+        self.assertContains(response, f"?department={department.pk}&amp;month=2026-01&amp;per_page=2&after={cursor}")
+        pages = self.walk(department=department.pk, month='2026-01', per_page=2)
+        self.assertEqual(sum(len(page) for page in pages),
+                         Indicator.objects.filter(kpi__employee__department=department, status='on_review').count())
+
+
+class BulkReviewTests(TestCase):
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            make_org(1, 1)
+            self.employee = User.objects.get(username='u-0-0')
+            self.kpi, self.other_kpi = KPI.objects.filter(employee=self.employee).order_by('id')
+            Indicator.objects.filter(kpi__employee=self.employee).update(status='on_review')
+        self.hr = User.objects.create(username='hr', role='hr')
+        self.client.force_login(self.hr)
+
+    def post(self, ids, action='approve', **extra):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('bulk_review_indicators'),
+                                    {'indicator_ids': [str(pk) for pk in ids], 'action': action, **extra})
+
+    def statuses(self, kpi):
+        return sorted(kpi.indicators.values_list('status', flat=True))
+
+    def test_permissions(self):
+        ids = list(self.kpi.indicators.values_list('pk', flat=True))
+        self.client.logout()
+        self.assertRedirects(self.post(ids), f"{reverse('login')}?next={reverse('bulk_review_indicators')}",
+                             fetch_redirect_response=False)
+        self.client.force_login(self.employee)
+        self.assertEqual(self.post(ids).status_code, 403)
+        self.assertEqual(self.statuses(self.kpi), ['on_review', 'on_review'])
+
+        for role in ('dept_head', 'admin'):
+            self.client.force_login(User.objects.create(username=role, role=role))
+            self.assertEqual(self.post(ids[:1]).status_code, 302)
+            ids = ids[1:]
+        self.assertEqual(self.statuses(self.kpi), ['approved', 'approved'])
+
+    def test_partially_invalid_ids(self):
+        first, second = self.kpi.indicators.order_by('id')
+        draft = self.other_kpi.indicators.first()
+        Indicator.objects.filter(pk=draft.pk).update(status='draft')
+        response = self.post([first.pk, draft.pk, 999999, 'abc', '1e3', '', f"-{second.pk}"])
+
+        self.assertRedirects(response, reverse('hr_review_list'), fetch_redirect_response=False)
+        self.assertEqual([str(m) for m in get_messages(response.wsgi_request)], ["Подтверждено показателей: 1."])
+        self.assertEqual(self.statuses(self.kpi), ['approved', 'on_review'])
+        self.assertEqual(Indicator.objects.get(pk=draft.pk).status, 'draft')
+
+        # Только мусор или неизвестное действие — ничего не меняется
+        for ids, action in ((['abc', 999999], 'approve'), ([second.pk], 'delete'), ([], 'approve')):
+            response = self.post(ids, action)
+            self.assertEqual(self.statuses(self.kpi), ['approved', 'on_review'])
+        self.assertEqual(AuditLog.objects.filter(model_name='Indicator', action='Approved').count(), 1)
+
+    def test_batch_is_capped(self):
+        ids = list(Indicator.objects.filter(status='on_review').order_by('id').values_list('pk', flat=True))
+        with mock.patch('kpi.views.REVIEW_MAX_BATCH', 2):
+            self.post(ids)
+        self.assertEqual(Indicator.objects.filter(pk__in=ids, status='approved').count(), 2)
+
+    def test_approve_updates_score_bonus_and_notifies(self):
+        KPI.objects.filter(pk=self.kpi.pk).update(total_score=0)
+        ids = list(self.kpi.indicators.values_list('pk', flat=True))
+
+        response = self.post(ids)
+
+        self.kpi.refresh_from_db()
+        bonus = KPIBonus.objects.get(kpi=self.kpi)
+        self.assertAlmostEqual(self.kpi.total_score, 87.0)
+        self.assertTrue(bonus.is_calculated)
+        self.assertEqual(bonus.final_payout, to_money(kpi_payouts([self.kpi], use_fixed=False)[self.kpi.id]))
+        self.assertIn(f"KPI '{self.kpi.name}' полностью утвержден. Сумма: {bonus.final_payout}",
+                      [str(m) for m in get_messages(response.wsgi_request)])
+        # Второй KPI не трогали — его бонус не зафиксирован
+        self.assertFalse(KPIBonus.objects.get(kpi=self.other_kpi).is_calculated)
+
+        self.assertEqual(
+            sorted(Notification.objects.filter(recipient=self.employee).values_list('message', flat=True)),
+            [f"Статус вашего индикатора {name} изменен на: Approved. Комментарий: None" for name in ('A', 'B')]
+        )
+        self.assertEqual(User.objects.get(pk=self.employee.pk).unread_notifications, 2)
+        self.assertEqual(
+            sorted(AuditLog.objects.filter(model_name='Indicator', action='Approved').values_list('object_id', 'user')),
+            sorted((pk, self.hr.pk) for pk in ids)
+        )
+        self.assertEqual(EmployeeMonthSnapshot.objects.get(employee=self.employee, month=MONTH).indicators_approved, 2)
+        self.assertEqual(rollup_mismatches(), [])
+
+    def test_reject_keeps_bonus_open_and_stores_reason(self):
+        ids = list(self.kpi.indicators.values_list('pk', flat=True))
+        self.post(ids, 'reject', rejection_reason="  Нет подтверждающих документов ")
+
+        self.assertEqual(set(self.kpi.indicators.values_list('status', 'rejection_reason')),
+                         {('rejected', "Нет подтверждающих документов")})
+        self.assertFalse(KPIBonus.objects.get(kpi=self.kpi).is_calculated)
+        self.assertEqual(Notification.objects.filter(recipient=self.employee).count(), 2)
+        self.assertEqual(AuditLog.objects.filter(model_name='Indicator', action='Rejected').count(), 2)
+
+
+    def test_bulk_and_single_review_agree_on_closed_months(self):
+        first, second = self.kpi.indicators.order_by('id')
+        # Зафиксированная выплата другого KPI месяц не закрывает — ни для одного пути
+        KPIBonus.objects.filter(kpi=self.other_kpi).update(is_calculated=True)
+        self.post([first.pk])
+        self.client.post(reverse('approve_indicator', args=[second.pk]))
+        self.assertEqual(self.statuses(self.kpi), ['approved', 'approved'])
+
+        MonthStatus.objects.create(month=MONTH, is_closed=True)
+        third, fourth = self.other_kpi.indicators.order_by('id')
+        self.post([third.pk])
+        response = self.client.post(reverse('approve_indicator', args=[fourth.pk]))
+        self.assertRedirects(response, f"{reverse('dashboard')}?month=2026-01", fetch_redirect_response=False)
+        self.assertEqual(self.statuses(self.other_kpi), ['on_review', 'on_review'])
+
+
+class PDFReportJobTests(TestCase):
+    def setUp(self):
+        self.reports_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.reports_dir, ignore_errors=True)
+        settings_override = override_settings(KPI_REPORTS_DIR=self.reports_dir, KPI_REPORT_WORKERS=0,
+                                              KPI_REPORT_TIMEOUT=600)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client.force_login(User.objects.create(username='reader'))
+        self.job_id = reports.report_job_id(MONTH)
+
+    def write_running(self, **info):
+        marker = reports._marker(self.job_id, 'running')
+        marker.write_text(json.dumps(info), encoding='utf-8')
+        return marker
+
+    def test_ready_report_is_served_by_export_status_and_download(self):
+        reports.report_path(self.job_id).write_bytes(b'%PDF-1.4 test')
+
+        response = self.client.get(reverse('export_kpi_pdf'), {'month': '2026-01'})
+        self.assertEqual(b''.join(response.streaming_content), b'%PDF-1.4 test')
+        status = self.client.get(reverse('export_kpi_pdf_status', args=[self.job_id])).json()
+        self.assertEqual(status['status'], 'ready')
+        self.assertEqual(status['download_url'], reverse('export_kpi_pdf_download', args=[self.job_id]))
+        response = self.client.get(status['download_url'])
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+
+    def test_download_missing_or_invalid_job_is_404(self):
+        self.assertEqual(self.client.get(reverse('export_kpi_pdf_download', args=[self.job_id])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('export_kpi_pdf_download', args=['2026-01_report'])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('export_kpi_pdf_status', args=['bad'])).status_code, 404)
+
+    def test_submit_finishes_job(self):
+        # Рендер в запросе (KPI_REPORT_WORKERS=0): без WeasyPrint задача падает, но не зависает
+        response = self.client.get(reverse('export_kpi_pdf'), {'month': '2026-01'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(reports.job_status(self.job_id), ('ready', 'failed'))
+        self.assertFalse(reports._marker(self.job_id, 'running').exists())
+
+    def test_fresh_running_marker_blocks_resubmit(self):
+        self.write_running(pid=os.getpid(), host=reports.socket.gethostname(), started=time.time())
+        with mock.patch.object(reports, '_run') as run:
+            reports.submit_report(MONTH, 'http://testserver/', job_id=self.job_id)
+        run.assert_not_called()
+        self.assertEqual(reports.job_status(self.job_id), 'running')
+
+    def test_expired_running_marker_becomes_failed(self):
+        marker = self.write_running(pid=os.getpid(), host=reports.socket.gethostname(), started=time.time() - 601)
+        self.assertEqual(reports.job_status(self.job_id), 'failed')
+        self.assertFalse(marker.exists())
+
+    def test_running_marker_of_dead_process_becomes_failed(self):
+        with mock.patch.object(reports.os, 'kill', side_effect=ProcessLookupError):
+            self.write_running(pid=12345, host=reports.socket.gethostname(), started=time.time())
+            self.assertEqual(reports.job_status(self.job_id), 'failed')
+
+        # Без содержимого маркер стареет по времени изменения файла
+        marker = reports._marker(self.job_id, 'running')
+        marker.write_text('', encoding='utf-8')
+        self.assertEqual(reports.job_status(self.job_id), 'running')
+        os.utime(marker, (time.time() - 601, time.time() - 601))
+        self.assertEqual(reports.job_status(self.job_id), 'failed')
+
+    def test_failed_render_writes_failed_marker(self):
+        self.write_running(started=time.time())
+        future = Future()
+        future.set_exception(ValueError('boom'))
+        reports._on_done(self.job_id, future)
+
+        self.assertEqual(reports.job_status(self.job_id), 'failed')
+        self.assertEqual(reports._marker(self.job_id, 'failed').read_text(encoding='utf-8'), 'boom')
+        self.assertFalse(reports._marker(self.job_id, 'running').exists())
+
+    def test_job_id_follows_report_content(self):
+        make_org(2, 1)
+        employee = User.objects.get(username='u-0-0')
+        first, second = KPI.objects.filter(employee=employee).order_by('id')
+        seen = {reports.report_job_id(MONTH)}
+
+        def changed(update):
+            update()
+            job_id = reports.report_job_id(MONTH)
+            self.assertNotIn(job_id, seen)
+            seen.add(job_id)
+
+        changed(lambda: User.objects.filter(pk=employee.pk).update(first_name="Новое", last_name="Имя"))
+        changed(lambda: KPI.objects.filter(pk=first.pk).update(name="Переименован"))
+        changed(lambda: User.objects.filter(pk=employee.pk).update(
+            department=Department.objects.exclude(pk=employee.department_id).get()))
+        # Суммы взаимно компенсируются: итог тот же, строки отчета — нет
+        changed(lambda: (KPI.objects.filter(pk=first.pk).update(total_score=90),
+                         KPI.objects.filter(pk=second.pk).update(total_score=84)))
+        self.assertEqual(reports.report_job_id(MONTH), reports.report_job_id(MONTH))
+
+        # Выплата, зафиксированная одобрением одного KPI, месяц не закрывает
+        KPIBonus.objects.filter(kpi=first).update(is_calculated=True, final_payout=500)
+        self.assertNotIn(reports.CLOSED_KEY, reports.report_job_id(MONTH))
+        MonthStatus.objects.create(month=MONTH, is_closed=True)
+        self.assertEqual(reports.report_job_id(MONTH), f"2026-01_{reports.CLOSED_KEY}")
+
+    def test_stored_report_prunes_superseded_files(self):
+        old_time = time.time() - 60
+        superseded = [reports.report_path('2026-01_aaaaaaaaaaaa'), reports._marker('2026-01_bbbbbbbbbbbb', 'failed')]
+        kept = [reports.report_path('2026-02_aaaaaaaaaaaa')]
+        for path in superseded + kept:
+            path.write_bytes(b'old')
+            os.utime(path, (old_time, old_time))
+        # Рендер, поставленный позже и уже готовый, не трогаем
+        newer = reports.report_path('2026-01_cccccccccccc')
+        newer.write_bytes(b'newer')
+
+        self.write_running(started=time.time() - 30)
+        reports.report_path(self.job_id).write_bytes(b'%PDF-1.4 test')
+        future = Future()
+        future.set_result(None)
+        reports._on_done(self.job_id, future)
+
+        self.assertEqual([path.exists() for path in superseded], [False, False])
+        self.assertTrue(all(path.exists() for path in kept + [newer, reports.report_path(self.job_id)]))
+        self.assertEqual(reports.job_status(self.job_id), 'ready')
+
+    @override_settings(KPI_REPORT_WORKERS=1)
+    def test_broken_pool_is_replaced_and_job_marked_failed(self):
+        broken = mock.Mock()
+        broken.submit.side_effect = BrokenProcessPool('worker died')
+        with mock.patch.object(reports, '_executor', broken), \
+                mock.patch.object(reports, 'ProcessPoolExecutor', return_value=broken):
+            with self.assertLogs('kpi.reports', 'ERROR'):
+                reports.submit_report(MONTH, 'http://testserver/', job_id=self.job_id)
+            # Сломанный пул закрыт без ожидания, следующий запрос получит новый
+            broken.shutdown.assert_called_with(wait=False, cancel_futures=True)
+            self.assertIsNone(reports._executor)
+
+        self.assertEqual(reports.job_status(self.job_id), 'failed')
+        self.assertFalse(reports._marker(self.job_id, 'running').exists())
+
+
+class DepartmentRollupTests(TestCase):
+    """После каждой операции сводка совпадает с пересчетом с нуля (rollup_mismatches / check_department_rollups)."""
+
+    def setUp(self):
+        # Все эффекты подготовки сбрасываются здесь: иначе пачка make_org поглотит эффекты теста
+        with self.captureOnCommitCallbacks(execute=True):
+            make_org(2, 2)
+            self.dept, self.other_dept = Department.objects.order_by('id')
+            self.employee = User.objects.filter(department=self.dept).order_by('id').first()
+            self.kpi = KPI.objects.filter(employee=self.employee).order_by('id').first()
+            # Индикатор KPI отдела, в который переносится средний одобренный факт
+            self.dept_indicator = Indicator.objects.create(
+                kpi=KPI.objects.get(department=self.dept, target_type='department'),
+                name="A", indicator_type='percent', plan_value=100, weight=100,
+            )
+            for indicator in Indicator.objects.filter(name='A', kpi__target_type='employee'):
+                indicator.status = 'approved'
+                indicator.save()
+
+    def assertMatchesRecompute(self):
+        self.assertEqual(rollup_mismatches(), [])
+        call_command('check_department_rollups', stdout=io.StringIO())
+
+    def rollup(self, department=None, month=MONTH):
+        return DepartmentIndicatorRollup.objects.get(
+            department=department or self.dept, indicator_name='A', month=month
+        )
+
+    def test_create_and_sync_department_indicator(self):
+        self.assertMatchesRecompute()
+        self.assertEqual(self.rollup().approved_count, 4)
+        with self.captureOnCommitCallbacks(execute=True):
+            Indicator.objects.create(kpi=self.kpi, name="A", indicator_type='percent', plan_value=100,
+                                     weight=10, status='approved', fact_quantitative=50, fact_qualitative=40)
+        self.assertMatchesRecompute()
+        rollup = self.rollup()
+        self.assertEqual(rollup.approved_count, 5)
+        self.dept_indicator.refresh_from_db()
+        self.assertAlmostEqual(self.dept_indicator.fact_quantitative, rollup.fact_quantitative_avg)
+        self.assertAlmostEqual(self.dept_indicator.fact_quantitative, 90.0)
+
+    def test_update_fact_status_and_name(self):
+        indicator = self.kpi.indicators.get(name='A')
+        indicator.fact_quantitative = 40
+        indicator.save()
+        self.assertMatchesRecompute()
+        indicator.name = "A2"
+        indicator.save()
+        self.assertMatchesRecompute()
+        indicator.status = 'rejected'
+        indicator.save()
+        self.assertMatchesRecompute()
+
+        # Объект, собранный не из БД, сравнивается с сохраненным состоянием
+        Indicator(**{f.attname: getattr(indicator, f.attname) for f in Indicator._meta.concrete_fields}
+                  | {'status': 'approved'}).save()
+        self.assertMatchesRecompute()
+
+    def test_kpi_changes_move_facts(self):
+        other_employee = User.objects.filter(department=self.other_dept).first()
+        self.kpi.employee = other_employee
+        self.kpi.save()
+        self.assertMatchesRecompute()
+        self.assertEqual(self.rollup(self.other_dept).approved_count, 5)
+
+        self.kpi.for_month = date(2026, 2, 1)
+        self.kpi.save()
+        self.assertMatchesRecompute()
+        self.kpi.is_active = False
+        self.kpi.save()
+        self.assertMatchesRecompute()
+
+    def test_department_reassignment(self):
+        self.employee.department = self.other_dept
+        self.employee.save()
+        self.assertMatchesRecompute()
+        self.assertEqual((self.rollup().approved_count, self.rollup(self.other_dept).approved_count), (2, 6))
+
+        # Без отдела факты сотрудника в сводку не входят
+        employee = User.objects.get(pk=self.employee.pk)
+        employee.department = None
+        employee.save(update_fields=['department'])
+        self.assertMatchesRecompute()
+        self.assertEqual(self.rollup(self.other_dept).approved_count, 4)
+
+        # Сохранения без отдела сводку не трогают
+        employee.first_name = "Имя"
+        employee.save(update_fields=['first_name'])
+        self.assertMatchesRecompute()
+
+    def test_delete_indicator_kpi_and_employee(self):
+        self.kpi.indicators.get(name='A').delete()
+        self.assertMatchesRecompute()
+        KPI.objects.filter(employee=self.employee).delete()
+        self.assertMatchesRecompute()
+        # Без уведомлений каскад удаляет сотрудника раньше индикаторов его KPI
+        employee = User.objects.filter(department=self.other_dept).first()
+        Notification.objects.filter(recipient=employee).delete()
+        employee.delete()
+        self.assertMatchesRecompute()
+        self.assertEqual((self.rollup().approved_count, self.rollup(self.other_dept).approved_count), (2, 2))
+
+    def test_rolled_back_savepoint(self):
+        indicator = self.kpi.indicators.get(name='B')
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    indicator.status = 'approved'
+                    indicator.save()
+                    self.employee.department = self.other_dept
+                    self.employee.save()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertMatchesRecompute()
+
+        # Повтор того же сохранения после отката учитывается заново
+        indicator.save()
+        self.employee.save()
+        self.assertMatchesRecompute()
+        self.assertEqual(DepartmentIndicatorRollup.objects.get(indicator_name='B', department=self.other_dept)
+                         .approved_count, 1)
+
+    def test_deferred_fields(self):
+        # Чтение отложенного поля загружает объект заново через from_db — без рекурсии
+        self.assertEqual([kpi.name for kpi in KPI.objects.filter(pk=self.kpi.pk).only('id')], [self.kpi.name])
+        self.kpi.refresh_from_db(fields=['total_score'])
+
+        indicator = Indicator.objects.defer('status').get(kpi=self.kpi, name='B')
+        indicator.status = 'approved'
+        indicator.save()
+        self.assertMatchesRecompute()
+
+        kpi = KPI.objects.only('id', 'name').get(pk=self.kpi.pk)
+        kpi.for_month = date(2026, 2, 1)
+        kpi.save()
+        self.assertMatchesRecompute()
+        with self.captureOnCommitCallbacks(execute=True):
+            KPI.objects.only('id').get(pk=self.kpi.pk).delete()
+        self.assertMatchesRecompute()
+        # Отложенные поля дочитаны до удаления: аудит видит удаленный KPI целиком
+        log = AuditLog.objects.filter(model_name='KPI', object_id=self.kpi.pk, action="Deleted").get()
+        self.assertEqual(log.diff['name'], [self.kpi.name, None])
+        self.assertFalse(EmployeeMonthSnapshot.objects.filter(employee=self.employee, month=date(2026, 2, 1),
+                                                             kpi_count__gt=0).exists())
+
+    def test_checker_reports_drift_and_rebuild_fixes_it(self):
+        DepartmentIndicatorRollup.objects.filter(department=self.dept).update(approved_count=99)
+        with self.assertRaises(CommandError):
+            call_command('check_department_rollups', stdout=io.StringIO())
+        call_command('rebuild_department_rollups', '--sync', stdout=io.StringIO())
+        self.assertMatchesRecompute()
+
+
+class DepartmentSyncBatchTests(TransactionTestCase):
+    """Синхронизация индикаторов отделов вне транзакции (как из on_commit) не пишет аудит построчно."""
+
+    def test_sync_writes_audit_in_one_batch(self):
+        make_org(2, 1, kpis_per_employee=1)
+        keys = []
+        for dept in Department.objects.order_by('id'):
+            Indicator.objects.create(kpi=KPI.objects.get(department=dept, target_type='department'),
+                                     name="A", indicator_type='percent', plan_value=100, weight=100,
+                                     fact_quantitative=5, fact_qualitative=5)
+            keys.append((dept.id, "A", MONTH))
+
+        with mock.patch('core.audit.write_audit_logs', wraps=write_audit_logs) as writer:
+            sync_department_indicators(keys)
+        # Одобренных фактов нет — оба индикатора обнулены, аудит одной пачкой
+        self.assertFalse(Indicator.objects.filter(kpi__target_type='department', fact_quantitative=5).exists())
+        self.assertEqual(writer.call_count, 1)
+        self.assertEqual(len(writer.call_args.args[0]), 2)
+
+
+class EmployeeSnapshotTests(TestCase):
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            make_org(1, 2)
+        self.employee = User.objects.filter(department__isnull=False).order_by('id').first()
+        self.kpi = KPI.objects.filter(employee=self.employee).order_by('id').first()
+
+    def live_snapshots(self):
+        """Итоги сотрудников по месяцам, посчитанные заново по KPI и индикаторам."""
+        kpis = list(KPI.objects.filter(employee__isnull=False, is_active=True, is_template=False,
+                                       for_month__isnull=False).select_related('bonus_setup'))
+        payouts = kpi_payouts(kpis)
+        rows = {}
+        for kpi in kpis:
+            row = rows.setdefault((kpi.employee_id, kpi.for_month), {
+                'scores': [], 'payout': 0, 'draft': 0, 'on_review': 0, 'approved': 0, 'rejected': 0,
+            })
+            row['scores'].append(kpi.total_score)
+            row['payout'] += to_money(payouts.get(kpi.id, 0))
+            for status in kpi.indicators.values_list('status', flat=True):
+                row[status] += 1
+        return {
+            key: (round(sum(row['scores']) / len(row['scores']), 6), row['payout'], len(row['scores']),
+                  row['draft'], row['on_review'], row['approved'], row['rejected'])
+            for key, row in rows.items()
+        }
+
+    def stored_snapshots(self):
+        return {
+            (s.employee_id, s.month): (round(s.score, 6), s.payout, s.kpi_count, s.indicators_draft,
+                                       s.indicators_on_review, s.indicators_approved, s.indicators_rejected)
+            for s in EmployeeMonthSnapshot.objects.all()
+        }
+
+    @staticmethod
+    def save(obj, **changes):
+        for field, value in changes.items():
+            setattr(obj, field, value)
+        obj.save()
+
+    def assertSnapshotsLive(self):
+        self.assertEqual(self.stored_snapshots(), self.live_snapshots())
+
+    def test_snapshots_follow_indicator_changes(self):
+        self.assertSnapshotsLive()
+        indicator = self.kpi.indicators.get(name='A')
+        steps = [
+            lambda: self.save(indicator, fact_quantitative=40),
+            lambda: self.save(indicator, status='on_review'),
+            lambda: self.save(indicator, status='approved'),
+            lambda: Indicator.objects.create(kpi=self.kpi, name="C", indicator_type='percent', plan_value=50,
+                                             weight=10, fact_quantitative=50, fact_qualitative=50),
+            lambda: self.kpi.indicators.get(name='B').delete(),
+        ]
+        for step in steps:
+            with self.captureOnCommitCallbacks(execute=True):
+                step()
+            self.assertSnapshotsLive()
+
+    def test_snapshots_follow_kpi_and_bonus_changes(self):
+        other = User.objects.exclude(pk=self.employee.pk).filter(department__isnull=False).first()
+        steps = [
+            lambda: self.save(KPIBonus.objects.get(kpi=self.kpi), target_amount=5000),
+            lambda: self.save(self.kpi, for_month=date(2026, 2, 1)),
+            lambda: self.save(self.kpi, employee=other),
+            lambda: self.save(self.kpi, is_active=False),
+            lambda: KPI.objects.filter(employee=self.employee).delete(),
+            lambda: close_month(MONTH),
+        ]
+        for step in steps:
+            with self.captureOnCommitCallbacks(execute=True):
+                step()
+            self.assertSnapshotsLive()
+        self.assertFalse(EmployeeMonthSnapshot.objects.filter(employee=self.employee).exists())
+
+    def test_rebuild_command_restores_snapshots(self):
+        EmployeeMonthSnapshot.objects.all().delete()
+        call_command('rebuild_employee_snapshots', stdout=io.StringIO())
+        self.assertSnapshotsLive()
+
+    def test_profile_query_count_does_not_grow_with_history(self):
+        self.client.force_login(User.objects.create(username='viewer'))
+        url = reverse('employee_detail', args=[self.employee.pk])
+        with CaptureQueriesContext(connection) as short_history:
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+        # Еще 11 месяцев истории по 2 KPI с индикаторами
+        with self.captureOnCommitCallbacks(execute=True):
+            for month in month_sequence(date(2025, 2, 1), date(2025, 12, 1)):
+                for k in range(2):
+                    kpi = KPI.objects.create(name=f"KPI {k}", period='monthly', target_type='employee',
+                                             employee=self.employee, for_month=month)
+                    Indicator.objects.create(kpi=kpi, name="A", indicator_type='percent', plan_value=100,
+                                             weight=100, fact_quantitative=90, fact_qualitative=90)
+        self.assertEqual(EmployeeMonthSnapshot.objects.filter(employee=self.employee).count(), 12)
+
+        with CaptureQueriesContext(connection) as long_history:
+            response = self.client.get(url)
+        self.assertEqual(len(response.context['snapshots']), 12)
+        self.assertEqual(len(long_history), len(short_history))
+        # Сессия и пользователь, профиль, снимки, KPI последнего месяца
+        self.assertLessEqual(len(long_history), 5)
+
+        # Карточки KPI — за месяц, выбранный в истории, тем же числом запросов
+        self.assertEqual(response.context['selected_month'], date(2026, 1, 1))
+        with CaptureQueriesContext(connection) as selected:
+            response = self.client.get(url, {'month': '2025-03'})
+        self.assertEqual(len(selected), len(long_history))
+        self.assertEqual(response.context['selected_month'], date(2025, 3, 1))
+        self.assertEqual({k.for_month for k in response.context['employee_kpis']}, {date(2025, 3, 1)})
+        self.assertEqual(len(response.context['employee_kpis']), 2)
+        self.assertContains(response, '<option value="2025-03" selected>', html=False)
+        # Месяц без истории или битое значение — последний месяц
+        for month in ('2024-01', 'март'):
+            self.assertEqual(self.client.get(url, {'month': month}).context['selected_month'], date(2026, 1, 1))
+
+
+class KPIVersioningTests(TestCase):
+
+    def test_new_versions_share_lineage_and_reset_indicators(self):
+        make_org(departments=1, employees_per_dept=2)
+        kpis = list(KPI.objects.filter(target_type='employee').order_by('pk'))
+        approved = kpis[0].indicators.get(name='A')
+        approved.status = 'approved'
+        approved.save()
+        self.assertEqual(DepartmentIndicatorRollup.objects.get(indicator_name='A').approved_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            new_kpis = create_new_versions(kpis)
+
+        self.assertEqual(len(new_kpis), 4)
+        self.assertEqual(KPI.objects.filter(pk__in=[k.pk for k in kpis], is_active=True).count(), 0)
+        for old, new in zip(kpis, new_kpis):
+            self.assertEqual((new.version, new.lineage_id, new.employee_id), (2, old.lineage_id, old.employee_id))
+        self.assertEqual(latest_version(kpis[0]), new_kpis[0])
+        self.assertEqual(list(versions_of(new_kpis[0])), [kpis[0], new_kpis[0]])
+
+        copied = Indicator.objects.filter(kpi__in=new_kpis)
+        self.assertEqual(copied.count(), 8)
+        self.assertFalse(copied.exclude(status='draft', fact_quantitative=0, fact_qualitative=0).exists())
+        # Одобренный факт архивной версии ушел из сводки по отделу
+        self.assertEqual(DepartmentIndicatorRollup.objects.get(indicator_name='A').approved_count, 0)
+
+        # Повторный вызов по архивным версиям ничего не создает
+        self.assertEqual(create_new_versions(kpis), [])
+
+    def test_lineage_is_first_version_id(self):
+        kpi = KPI.objects.create(name="Новый", period='monthly', target_type='employee', for_month=MONTH)
+        self.assertEqual(kpi.lineage_id, kpi.pk)
+        self.assertEqual(KPI.objects.get(pk=kpi.pk).lineage_id, kpi.pk)
+        # Цепочка, проставленная после INSERT, не попадает в аудит следующей правки
+        with self.captureOnCommitCallbacks(execute=True):
+            kpi.name = "Новый 2"
+            kpi.save()
+        self.assertEqual(AuditLog.objects.filter(action="Updated", model_name='KPI').latest('id').diff,
+                         {'name': ["Новый", "Новый 2"]})
+
+        template = KPI.objects.create(name="Шаблон", period='monthly', target_type='employee', is_template=True)
+        with CaptureQueriesContext(connection) as ctx:
+            generate_kpis_from_templates([MONTH, date(2026, 2, 1)], [template], batch_size=1)
+        # Цепочки пачки открываются одним UPDATE на batch_size KPI
+        self.assertEqual(len([q for q in ctx.captured_queries
+                              if q['sql'].startswith('UPDATE') and 'lineage_id' in q['sql']]), 2)
+        generated = KPI.objects.filter(parent_template=template)
+        self.assertEqual(sorted(generated.values_list('lineage_id', flat=True)), sorted(k.pk for k in generated))
+
+        # Явно переданная цепочка сохраняется, номер версии в ней уникален
+        copy = KPI.objects.create(name="Новый", period='monthly', target_type='employee', for_month=MONTH,
+                                  version=2, lineage_id=kpi.lineage_id)
+        self.assertEqual(list(versions_of(kpi)), [kpi, copy])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            KPI.objects.create(name="Дубль", period='monthly', target_type='employee', for_month=MONTH,
+                               version=2, lineage_id=kpi.lineage_id)
+
+    def test_backfill_links_legacy_versions(self):
+        legacy = [
+            KPI.objects.create(name=name, period='monthly', target_type='employee', for_month=MONTH,
+                               version=version, is_active=active)
+            for name, version, active in (("Продажи", 1, False), ("Продажи", 2, False), ("Продажи", 3, True),
+                                          ("Звонки", 1, True))
+        ]
+        # KPI, созданные до появления цепочек
+        KPI.objects.filter(pk__in=[k.pk for k in legacy]).update(lineage_id=None)
+        v1, v2, v3, other = legacy
+        # Уже связанная версия: v3 получила цепочку от v2 при версионировании
+        KPI.objects.filter(pk=v3.pk).update(lineage_id=v1.pk)
+
+        out = io.StringIO()
+        call_command('backfill_kpi_lineage', stdout=out)
+        self.assertIn("KPI привязано к цепочкам: 3", out.getvalue())
+        self.assertEqual(dict(KPI.objects.filter(pk__in=[k.pk for k in legacy]).values_list('pk', 'lineage_id')),
+                         {v1.pk: v1.pk, v2.pk: v1.pk, v3.pk: v1.pk, other.pk: other.pk})
+        for kpi in legacy:
+            kpi.refresh_from_db()
+        self.assertEqual(list(versions_of(v2)), [v1, v2, v3])
+        self.assertEqual(latest_version(v1), v3)
+        self.assertEqual(backfill_lineage(), 0)
+
+        # Версионирование после бэкфилла продолжает старую цепочку
+        new = create_new_versions([v3])[0]
+        self.assertEqual((new.lineage_id, new.version), (v1.pk, 4))
+
+    def test_backfill_keeps_versions_unique_in_lineage(self):
+        twins = [
+            KPI.objects.create(name="Продажи", period='monthly', target_type='employee', for_month=MONTH)
+            for _ in range(2)
+        ]
+        KPI.objects.filter(pk__in=[k.pk for k in twins]).update(lineage_id=None)
+        # Два разных KPI с одинаковыми полями и версией не сливаются в одну цепочку
+        self.assertEqual(backfill_lineage(), 2)
+        self.assertEqual(dict(KPI.objects.filter(pk__in=[k.pk for k in twins]).values_list('pk', 'lineage_id')),
+                         {k.pk: k.pk for k in twins})
+
+    def test_versioning_legacy_kpi_without_lineage(self):
+        kpi = KPI.objects.create(name="Старый", period='monthly', target_type='employee', for_month=MONTH)
+        KPI.objects.filter(pk=kpi.pk).update(lineage_id=None)
+        kpi.refresh_from_db()
+
+        new = create_new_versions([kpi])[0]
+        self.assertEqual(new.lineage_id, kpi.pk)
+        self.assertEqual(KPI.objects.get(pk=kpi.pk).lineage_id, kpi.pk)
+        self.assertEqual(list(versions_of(kpi)), [kpi, new])
+
+    def test_query_count_does_not_grow_with_batch(self):
+        make_org(departments=1, employees_per_dept=1, kpis_per_employee=1, prefix='one')
+        make_org(departments=2, employees_per_dept=5, prefix='many')
+
+        with CaptureQueriesContext(connection) as one:
+            create_new_versions(KPI.objects.filter(employee__username__startswith='one-'))
+        with CaptureQueriesContext(connection) as many:
+            created = create_new_versions(KPI.objects.filter(employee__username__startswith='many-'))
+
+        self.assertEqual(len(created), 20)
+        self.assertEqual(len(one.captured_queries), len(many.captured_queries))
+
+
+class QueryPlanTests(TestCase):
+    """Горячие выборки KPI и индикаторов идут по индексам, без полного прохода по таблице."""
+
+    def setUp(self):
+        make_org(departments=1, employees_per_dept=2)
+        self.employee = User.objects.get(username='u-0-0')
+
+    def test_function_on_column_is_detected_as_full_scan(self):
+        # Проверка самой проверки: for_month__month оборачивает колонку в функцию
+        scanned, _ = full_scans(KPI.objects.filter(for_month__month=MONTH.month), tables=['kpi_kpi'])
+        self.assertEqual(scanned, ['kpi_kpi'])
+
+    def test_month_kpis(self):
+        assert_uses_index(self, month_kpis(MONTH))
+        assert_uses_index(self, month_kpis(MONTH).filter(employee=self.employee))
+
+    def test_status_chart(self):
+        start, end = month_bounds(MONTH)
+        qs = Indicator.objects.filter(
+            kpi__for_month__gte=start, kpi__for_month__lt=end, kpi__is_active=True
+        ).values('status').annotate(total=Count('id'))
+        assert_uses_index(self, qs)
+
+    def test_month_closed_lookup(self):
+        # Запрос is_month_closed(): уникальный индекс MonthStatus.month
+        assert_uses_index(self, MonthStatus.objects.filter(month=MONTH, is_closed=True))
+
+    def test_review_queue(self):
+        qs = Indicator.objects.filter(status='on_review').select_related('kpi__employee').order_by('id')
+        assert_uses_index(self, qs, tables=[Indicator])
+
+    def test_my_kpis_and_versions(self):
+        assert_uses_index(self, KPI.objects.filter(employee=self.employee, is_active=True).order_by('-for_month'))
+        kpi = KPI.objects.filter(employee=self.employee).first()
+        assert_uses_index(self, versions_of(kpi))
+        assert_uses_index(self, KPI.objects.filter(lineage_id=kpi.lineage_id, is_active=True).order_by('-version'))
@@ -4,7 +4,7 @@ from .views import (
     MyKPIListView, IndicatorUpdateView, HRReviewListView, ApproveIndicatorView, DashboardView,
     AdminKPIListView, ArchiveKPIRedirectView, KPICreateView, IndicatorAddView, KPIDeleteView, KPIIndicatorListView,
     IndicatorUpdateFactView, IndicatorDeleteView, GenerateNextMonthKPIView, RejectIndicatorView, EmployeeDetailView,
-    KPIUpdateView, CloseMonthView, export_kpi_pdf
+    KPIUpdateView, CloseMonthView, BulkReviewIndicatorsView, export_kpi_pdf, export_kpi_pdf_status, export_kpi_pdf_download
 )
 
 urlpatterns = [
@@ -33,10 +33,13 @@ urlpatterns = [
 
     # Проверка и Аналитика
     path('review/', HRReviewListView.as_view(), name='hr_review_list'),
+    path('review/bulk/', BulkReviewIndicatorsView.as_view(), name='bulk_review_indicators'),
     path('review/action/<int:pk>/', ApproveIndicatorView.as_view(), name='approve_indicator'),
     path('dashboard/', DashboardView.as_view(), name='dashboard'),
     path('indicator/<int:pk>/reject/', RejectIndicatorView.as_view(), name='reject_indicator'),
     path('employee/<int:pk>/', EmployeeDetailView.as_view(), name='employee_detail'),
     path('close-month/', CloseMonthView.as_view(), name='close_month'),
     path('export-pdf/', export_kpi_pdf, name='export_kpi_pdf'),
+    path('export-pdf/<str:job_id>/status/', export_kpi_pdf_status, name='export_kpi_pdf_status'),
+    path('export-pdf/<str:job_id>/download/', export_kpi_pdf_download, name='export_kpi_pdf_download'),
 ]
\ No newline at end of file
@@ -0,0 +1,163 @@
+"""
+Версии KPI.
+
+Новая версия архивирует текущую (is_active=False) и создает ее копию с version + 1
+и обнуленными фактами индикаторов. Все версии одного KPI связаны KPI.lineage_id
+(id первой версии, см. models.open_lineages; уникальность номера версии в цепочке держит БД),
+поэтому текущая версия и история версий читаются одним запросом
+по индексу (lineage_id, is_active, version), без поиска по названию.
+
+create_new_versions() версионирует сразу пачку KPI: архивирование — один UPDATE,
+новые KPI и индикаторы — bulk_create. Сигналы при этом не вызываются, поэтому сводка
+по отделам, аудит и снимки профилей обновляются здесь же, как в kpi.review.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce
+
+from core.audit import field_diff, record
+from core.dispatch import dispatch
+from .models import KPI, Indicator
+from .rollups import apply_rollup_deltas, indicator_deltas, sync_department_indicators
+from .snapshots import refresh_employee_snapshots
+
+
+def lineage_of(kpi):
+    # У KPI, созданных до появления lineage_id и еще не перенесенных командой backfill_kpi_lineage, цепочка — он сам
+    return kpi.lineage_id or kpi.pk
+
+
+def latest_version(kpi):
+    """Активная версия KPI (или None, если вся цепочка в архиве)."""
+    return KPI.objects.filter(lineage_id=lineage_of(kpi), is_active=True).order_by('-version').first()
+
+
+def versions_of(kpi):
+    """Все версии KPI от первой к последней."""
+    return KPI.objects.filter(lineage_id=lineage_of(kpi)).order_by('version')
+
+
+def _copy_kpi(kpi):
+    return KPI(
+        name=kpi.name,
+        period=kpi.period,
+        target_type=kpi.target_type,
+        department_id=kpi.department_id,
+        employee_id=kpi.employee_id,
+        position_id=kpi.position_id,
+        is_template=kpi.is_template,
+        parent_template_id=kpi.parent_template_id,
+        for_month=kpi.for_month,
+        version=kpi.version + 1,
+        lineage_id=lineage_of(kpi),
+        is_active=True,
+    )
+
+
+def _copy_indicator(indicator, kpi):
+    # Условия индикатора переносятся, факты и статус — с нуля
+    return Indicator(
+        kpi=kpi,
+        name=indicator.name,
+        indicator_type=indicator.indicator_type,
+        plan_value=indicator.plan_value,
+        status='draft',
+        hr_comment=indicator.hr_comment,
+        weight=indicator.weight,
+        desc_quantitative=indicator.desc_quantitative,
+        desc_qualitative=indicator.desc_qualitative,
+        threshold_min=indicator.threshold_min,
+        threshold_max=indicator.threshold_max,
+        fact_quantitative=0,
+        fact_qualitative=0,
+        weighted_score=0,
+    )
+
+
+def create_new_versions(kpis, user=None, batch_size=500):
+    """
+    Архивирует переданные KPI и создает их новые версии с копиями индикаторов.
+    Уже архивные KPI пропускаются. Возвращает список новых KPI в порядке id старых.
+    """
+    kpi_ids = [kpi.pk for kpi in kpis]
+
+    with transaction.atomic():
+        # Блокировка строк: повторное версионирование того же KPI дождется коммита и увидит его в архиве
+        old_kpis = list(KPI.objects.select_for_update().filter(pk__in=kpi_ids, is_active=True).order_by('pk'))
+        if not old_kpis:
+            return []
+        old_ids = [kpi.pk for kpi in old_kpis]
+
+        indicators_by_kpi = {kpi_id: [] for kpi_id in old_ids}
+        for indicator in Indicator.objects.filter(kpi_id__in=old_ids).order_by('id'):
+            indicators_by_kpi[indicator.kpi_id].append(indicator)
+
+        # Одобренные факты архивируемых KPI уходят из сводки по отделам.
+        # Дельты считаются до UPDATE: пока KPI активны, они попадают в свои отделы
+        deltas = indicator_deltas([
+            (indicator.rollup_state(), None)
+            for indicators in indicators_by_kpi.values() for indicator in indicators
+            if indicator.status == 'approved'
+        ])
+
+        KPI.objects.filter(pk__in=old_ids).update(is_active=False, lineage_id=Coalesce('lineage_id', F('pk')))
+        changed_rollups = apply_rollup_deltas(deltas)
+
+        new_kpis = KPI.objects.bulk_create([_copy_kpi(kpi) for kpi in old_kpis], batch_size=batch_size)
+        new_indicators = Indicator.objects.bulk_create([
+            _copy_indicator(indicator, new_kpi)
+            for old_kpi, new_kpi in zip(old_kpis, new_kpis)
+            for indicator in indicators_by_kpi[old_kpi.pk]
+        ], batch_size=batch_size)
+
+        for old_kpi, new_kpi in zip(old_kpis, new_kpis):
+            old_kpi.is_active = False
+            old_kpi.lineage_id = new_kpi.lineage_id
+            record("Updated", 'KPI', old_kpi.pk, changes=str(old_kpi), diff={'is_active': [True, False]}, user=user)
+            record("Created", 'KPI', new_kpi.pk, changes=str(new_kpi), diff=field_diff(new_kpi, created=True), user=user)
+            dispatch(refresh_employee_snapshots, (old_kpi.employee_id, old_kpi.for_month))
+        for indicator in new_indicators:
+            record("Created", 'Indicator', indicator.pk, changes=str(indicator),
+                   diff=field_diff(indicator, created=True), user=user)
+        for key in changed_rollups:
+            dispatch(sync_department_indicators, key)
+
+    return new_kpis
+
+
+# По этим полям версии одного KPI совпадают (create_new_version их копирует)
+LINEAGE_KEY_FIELDS = (
+    'name', 'target_type', 'department_id', 'employee_id', 'position_id',
+    'for_month', 'is_template', 'parent_template_id',
+)
+
+
+def backfill_lineage():
+    """
+    Проставляет lineage_id KPI, созданным до его появления. Версии сопоставляются
+    по совпадению LINEAGE_KEY_FIELDS, корень цепочки — самая ранняя версия.
+    KPI, переименованные между версиями, окажутся в разных цепочках. Если номер версии
+    в цепочке уже занят (два разных KPI с одинаковыми полями), KPI открывает свою цепочку.
+    Возвращает число обновленных KPI.
+    """
+    roots = {}
+    # (цепочка, версия), уже занятые связанными KPI
+    taken = set(KPI.objects.filter(lineage_id__isnull=False).values_list('lineage_id', 'version'))
+    pending = defaultdict(list)  # root -> id KPI без цепочки
+    rows = KPI.objects.order_by('version', 'pk').values_list('pk', 'lineage_id', 'version', *LINEAGE_KEY_FIELDS)
+    for pk, lineage_id, version, *key in rows.iterator(chunk_size=2000):
+        if lineage_id is not None:
+            roots.setdefault(tuple(key), lineage_id)
+            continue
+        root = roots.setdefault(tuple(key), pk)
+        if (root, version) in taken:
+            root = roots[tuple(key)] = pk
+        taken.add((root, version))
+        pending[root].append(pk)
+
+    with transaction.atomic():
+        for root, ids in pending.items():
+            KPI.objects.filter(pk__in=ids).update(lineage_id=root)
+    return sum(len(ids) for ids in pending.values())
@@ -1,12 +1,11 @@
 from django.views.generic import ListView, UpdateView, DetailView
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.urls import reverse_lazy, reverse
-from .models import KPI, Indicator, KPIBonus
+from .models import KPI, Indicator, KPIBonus, EmployeeMonthSnapshot
 from users.models import Department, User
 from django.views import View
-from core.utils import log_action
+from core.utils import log_action, month_bounds
 import os
-import urllib.parse
 from django.db.models import Sum, Avg
 from dateutil.relativedelta import relativedelta
 from django.contrib.auth import get_user_model
@@ -14,6 +13,13 @@ from django.shortcuts import get_object_or_404
 User = get_user_model()
 from django.views.generic.edit import CreateView
 from .forms import KPICreateForm, IndicatorCreateForm, IndicatorUpdateFactForm, IndicatorRejectForm
+from .services import build_dashboard_data, generate_kpis_from_templates, close_month, is_month_closed, MonthAlreadyClosed
+from .payouts import kpi_payouts, to_money
+from .snapshots import lifetime_average, snapshot_kpis
+from .review import REVIEW_MAX_BATCH, REVIEW_MAX_PAGE_SIZE, REVIEW_PAGE_SIZE, parse_cursor, review_queue, review_indicators
+from .charts import sparkline_points
+from .versioning import create_new_versions, latest_version
+from .reports import JOB_ID_RE, job_status, report_job, report_path, submit_report
 import csv
 from django.http import HttpResponse
 from django.views.generic import DeleteView
@@ -25,12 +31,11 @@ from users.models import User  # Импортируем вашу модель п
 from django.db.models import Count, Q
 from django.utils import timezone
 from datetime import datetime
-from django.shortcuts import redirect
+from django.shortcuts import redirect, render
+from django.http import FileResponse, Http404, JsonResponse, QueryDict
+from urllib.parse import urlencode
 from django.http import HttpResponse
-from django.template.loader import get_template
-from django.template.loader import render_to_string
 from django.contrib.auth.decorators import login_required
-from weasyprint import HTML
 
 
 class AdminRequiredMixin(UserPassesTestMixin):
@@ -39,6 +44,27 @@ class AdminRequiredMixin(UserPassesTestMixin):
         return self.request.user.is_authenticated and self.request.user.role == 'admin'
 
 
+class OpenMonthRequiredMixin:
+    """
+    Не дает менять KPI и индикаторы закрытого месяца: выплаты по нему зафиксированы.
+    Ставится после проверок входа и прав.
+    """
+
+    def get_month_kpi(self):
+        if 'kpi_id' in self.kwargs:
+            return KPI.objects.filter(pk=self.kwargs['kpi_id']).first()
+        if getattr(self, 'model', None) is KPI:
+            return KPI.objects.filter(pk=self.kwargs['pk']).first()
+        return KPI.objects.filter(indicators__pk=self.kwargs['pk']).first()
+
+    def dispatch(self, request, *args, **kwargs):
+        kpi = self.get_month_kpi()
+        if kpi is not None and kpi.for_month and is_month_closed(kpi.for_month):
+            messages.error(request, f"Месяц {kpi.for_month:%m.%Y} закрыт: изменения недоступны.")
+            return redirect(f"{reverse('dashboard')}?month={kpi.for_month:%Y-%m}")
+        return super().dispatch(request, *args, **kwargs)
+
+
 class MyKPIListView(LoginRequiredMixin, ListView):
     model = KPI
     template_name = 'kpi/my_kpi_list.html'
@@ -52,7 +78,7 @@ class MyKPIListView(LoginRequiredMixin, ListView):
         ).prefetch_related('indicators').order_by('-for_month')
 
 
-class IndicatorUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
+class IndicatorUpdateView(LoginRequiredMixin, UserPassesTestMixin, OpenMonthRequiredMixin, UpdateView):
     model = Indicator
     form_class = IndicatorCreateForm  # Используем полную форму
     template_name = 'kpi/indicator_add_form.html'
@@ -73,12 +99,84 @@ class HRReviewListView(LoginRequiredMixin, UserPassesTestMixin, ListView):
         # Доступ только для HR, Admin и Глав департаментов
         return self.request.user.role in ['hr', 'admin', 'dept_head']
 
+    def get_filters(self):
+        """Фильтры очереди из GET: отдел, месяц (YYYY-MM), курсор и размер страницы"""
+        params = self.request.GET
+        department_id = params.get('department')
+        month_str = params.get('month')
+        try:
+            month = datetime.strptime(month_str, '%Y-%m').date() if month_str else None
+        except ValueError:
+            month = None
+        try:
+            per_page = min(max(int(params.get('per_page', REVIEW_PAGE_SIZE)), 1), REVIEW_MAX_PAGE_SIZE)
+        except ValueError:
+            per_page = REVIEW_PAGE_SIZE
+        return {
+            'department_id': int(department_id) if department_id and department_id.isdigit() else None,
+            'month': month,
+            'after': parse_cursor(params.get('after')),
+            'limit': per_page,
+        }
+
     def get_queryset(self):
-        # Показываем только те, что ждут проверки
-        return Indicator.objects.filter(status='on_review')
+        # Показываем только те, что ждут проверки — постранично по ключу id
+        self.filters = self.get_filters()
+        page, self.next_cursor = review_queue(**self.filters)
+        return page
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        filters = self.filters
+        context['departments'] = Department.objects.order_by('name')
+        context['selected_department'] = filters['department_id']
+        context['selected_month'] = filters['month']
+        context['per_page'] = filters['limit']
+        context['is_first_page'] = filters['after'] is None
+        context['filter_query'] = urlencode({
+            key: value for key, value in (
+                ('department', filters['department_id']),
+                ('month', filters['month'].strftime('%Y-%m') if filters['month'] else None),
+                ('per_page', filters['limit'] if filters['limit'] != REVIEW_PAGE_SIZE else None),
+            ) if value
+        })
+        context['next_cursor'] = self.next_cursor
+        return context
+
+
+class BulkReviewIndicatorsView(LoginRequiredMixin, UserPassesTestMixin, View):
+    """Одобрение/отклонение выбранных в очереди индикаторов одной транзакцией"""
+
+    def test_func(self):
+        return self.request.user.role in ['hr', 'admin', 'dept_head']
+
+    def post(self, request):
+        ids = [int(pk) for pk in request.POST.getlist('indicator_ids') if pk.isdigit()][:REVIEW_MAX_BATCH]
+        action = request.POST.get('action')
+        back = reverse('hr_review_list')
+        if request.POST.get('filter_query'):
+            back = f"{back}?{QueryDict(request.POST['filter_query']).urlencode()}"
+
+        if not ids or action not in ('approve', 'reject'):
+            messages.warning(request, "Выберите показатели и действие.")
+            return redirect(back)
+
+        result = review_indicators(
+            ids,
+            approve=action == 'approve',
+            reviewer=request.user,
+            reason=request.POST.get('rejection_reason', '').strip() or None,
+        )
+        if action == 'approve':
+            messages.success(request, f"Подтверждено показателей: {result['updated']}.")
+            for kpi, payout in result['completed']:
+                messages.info(request, f"KPI '{kpi.name}' полностью утвержден. Сумма: {payout}")
+        else:
+            messages.error(request, f"Отклонено показателей: {result['updated']}.")
+        return redirect(back)
 
 
-class ApproveIndicatorView(LoginRequiredMixin, UserPassesTestMixin, View):
+class ApproveIndicatorView(LoginRequiredMixin, UserPassesTestMixin, OpenMonthRequiredMixin, View):
     def test_func(self):
         return self.request.user.role in ['hr', 'admin', 'dept_head']
 
@@ -95,17 +193,9 @@ class ApproveIndicatorView(LoginRequiredMixin, UserPassesTestMixin, View):
             if kpi.indicators.exclude(status='approved').count() == 0:
                 if hasattr(kpi, 'bonus_setup'):
                     bonus = kpi.bonus_setup
-                    total_score = kpi.get_total_score()
-
-                    # Логика трешхолдов из модели
-                    if total_score < bonus.threshold_min:
-                        bonus.final_payout = 0
-                    elif total_score > bonus.threshold_max:
-                        # Ограничиваем выплату максимумом (например, не более 120%)
-                        bonus.final_payout = (bonus.threshold_max / 100) * float(bonus.target_amount)
-                    else:
-                        bonus.final_payout = (total_score / 100) * float(bonus.target_amount)
-
+                    # total_score обновлен сигналом при сохранении индикатора
+                    kpi.total_score = KPI.objects.filter(pk=kpi.pk).values_list('total_score', flat=True).get()
+                    bonus.final_payout = to_money(kpi_payouts([kpi], use_fixed=False)[kpi.id])
                     bonus.is_calculated = True
                     bonus.save()
                     messages.info(request, f"KPI '{kpi.name}' полностью утвержден. Сумма: {bonus.final_payout}")
@@ -142,96 +232,15 @@ class DashboardView(LoginRequiredMixin, ListView):
         else:
             target_departments = Department.objects.filter(id=user.department.id) if user.department else []
 
-        departments_data = []
-        total_perf_sum = 0
-        total_emp_count = 0
-        grand_total_money = 0.0
-
-        for dept in target_departments:
-            dept_employees = User.objects.filter(department=dept)
-            emp_list = []
-            dept_sum_score = 0
-            dept_total_money = 0.0
-
-            # Все KPI отдела для сводки справа
-            all_dept_kpis = KPI.objects.filter(
-                department=dept, is_active=True,
-                for_month__month=selected_date.month,
-                for_month__year=selected_date.year
-            ).select_related('employee')
-
-            for emp in dept_employees:
-                emp_kpis = KPI.objects.filter(
-                    employee=emp, is_active=True,
-                    for_month__month=selected_date.month,
-                    for_month__year=selected_date.year
-                ).select_related('bonus_setup')
-
-                emp_avg_score = 0
-                emp_money = 0.0
-                emp_target_money = 0.0
-
-                if emp_kpis.exists():
-                    scores = [k.get_total_score() for k in emp_kpis]
-                    emp_avg_score = sum(scores) / len(scores)
-
-                    for k in emp_kpis:
-                        bonus = getattr(k, 'bonus_setup', None)
-                        if bonus:
-                            emp_target_money += float(bonus.target_amount or 0)
-                            score = float(k.get_total_score())
-
-                            if bonus.is_calculated:
-                                emp_money += float(bonus.final_payout or 0)
-                            else:
-                                t_min = float(bonus.threshold_min or 80)
-                                if score >= t_min:
-                                    t_max = float(bonus.threshold_max or 120)
-                                    s_clamped = min(score, t_max)
-                                    emp_money += (s_clamped / 100) * float(bonus.target_amount or 0)
-
-                emp_list.append({
-                    'id': emp.id,
-                    'full_name': emp.get_full_name() or emp.username,
-                    'position': emp.position.name if emp.position else "-",
-                    'current_score': emp_avg_score,
-                    'target_money': emp_target_money,
-                    'money': emp_money
-                })
-                dept_sum_score += emp_avg_score
-                dept_total_money += emp_money
-
-            # Расчет средних по отделу
-            dept_avg = dept_sum_score / dept_employees.count() if dept_employees.exists() else 0
-            total_perf_sum += dept_sum_score
-            total_emp_count += dept_employees.count()
-            grand_total_money += dept_total_money
-
-            departments_data.append({
-                'info': dept,
-                'employees': emp_list,
-                'kpis': all_dept_kpis,
-                'avg': dept_avg,
-                'total_money': dept_total_money
-            })
-
-        context['departments_data'] = departments_data
-        context['grand_total_money'] = grand_total_money
-        context['dept_avg'] = total_perf_sum / total_emp_count if total_emp_count > 0 else 0
-
-        # ИСПРАВЛЕННАЯ ПРОВЕРКА: Закрыт ли месяц?
-        # Мы проверяем только АКТИВНЫЕ KPI. Если за этот месяц есть хоть один активный KPI,
-        # который уже зафиксирован (is_calculated=True), то считаем период закрытым.
-        context['is_month_closed'] = KPIBonus.objects.filter(
-            kpi__for_month__month=selected_date.month,
-            kpi__for_month__year=selected_date.year,
-            kpi__is_active=True,
-            is_calculated=True
-        ).exists()
+        # 4. Дерево отделы/сотрудники/KPI/бонусы собирается фиксированным числом запросов
+        context.update(build_dashboard_data(target_departments, selected_date))
+
+        # Закрыт ли месяц (MonthStatus)
+        context['is_month_closed'] = is_month_closed(selected_date)
 
         # Данные для графика статусов
-        status_filter = Q(kpi__for_month__month=selected_date.month, kpi__for_month__year=selected_date.year,
-                          kpi__is_active=True)
+        month_start, month_end = month_bounds(selected_date)
+        status_filter = Q(kpi__for_month__gte=month_start, kpi__for_month__lt=month_end, kpi__is_active=True)
         status_counts = Indicator.objects.filter(status_filter).values('status').annotate(total=Count('id'))
         status_map = {'draft': 0, 'on_review': 1, 'approved': 2, 'rejected': 3}
         chart_values = [0, 0, 0, 0]
@@ -265,119 +274,44 @@ def export_kpi_pdf(request):
     except ValueError:
         return HttpResponse("Неверный формат даты", status=400)
 
-    departments = Department.objects.all()
-    data = []
-    total_company_bonus = 0
-    company_perf_accumulator = 0
-
-    chart_labels = []
-    chart_values = []
-    summary_table_data = []
-
-    for dept in departments:
-        dept_data = {
-            'name': dept.name,
-            'employees': [],
-            'total_dept_money': 0,
-            'avg_dept_perf': 0
-        }
+    # Готовый файл отдаем сразу, иначе ставим рендер в фон и показываем страницу ожидания
+    job_id, context = report_job(selected_date)
+    if job_status(job_id) == 'ready':
+        return _report_file_response(job_id)
 
-        users = User.objects.filter(department=dept)
-        dept_perf_list = []
-
-        for user in users:
-            kpis = KPI.objects.filter(
-                employee=user,
-                for_month__month=selected_date.month,
-                for_month__year=selected_date.year,
-                is_active=True
-            ).select_related('bonus_setup')
-
-            if kpis.exists():
-                emp_kpi_list = []
-                emp_total_money = 0
-                for k in kpis:
-                    bonus = getattr(k, 'bonus_setup', None)
-                    money = 0
-                    if bonus:
-                        if bonus.is_calculated:
-                            money = float(bonus.final_payout or 0)
-                        else:
-                            score = float(k.get_total_score())
-                            t_min = float(bonus.threshold_min or 80)
-                            if score >= t_min:
-                                t_max = float(bonus.threshold_max or 120)
-                                s_clamped = min(score, t_max)
-                                money = (s_clamped / 100) * float(bonus.target_amount or 0)
-
-                    emp_total_money += money
-                    emp_kpi_list.append({'name': k.name, 'perf': k.get_total_score(), 'money': money})
-
-                emp_avg_perf = sum([k['perf'] for k in emp_kpi_list]) / len(emp_kpi_list)
-                dept_perf_list.append(emp_avg_perf)
-
-                dept_data['employees'].append({
-                    'full_name': user.get_full_name() or user.username,
-                    'kpis': emp_kpi_list,
-                    'subtotal_money': emp_total_money,
-                    'avg_perf': emp_avg_perf
-                })
-                dept_data['total_dept_money'] += emp_total_money
-
-        if dept_data['employees']:
-            dept_data['avg_dept_perf'] = sum(dept_perf_list) / len(dept_perf_list)
-            data.append(dept_data)
-
-            total_company_bonus += dept_data['total_dept_money']
-            company_perf_accumulator += dept_data['avg_dept_perf']
-
-            chart_labels.append(dept_data['name'])
-            chart_values.append(float(dept_data['total_dept_money']))
-
-    company_avg_perf = company_perf_accumulator / len(data) if data else 0
-
-    for i in range(len(chart_labels)):
-        share = (chart_values[i] / total_company_bonus * 100) if total_company_bonus > 0 else 0
-        summary_table_data.append({
-            'name': chart_labels[i],
-            'amount': chart_values[i],
-            'share': share
-        })
+    submit_report(selected_date, request.build_absolute_uri('/'), job_id=job_id, context=context)
+    return render(request, 'kpi/pdf_report_status.html', {
+        'job_id': job_id,
+        'selected_month': selected_date,
+    })
 
 
-    chart_config = {
-        'type': 'pie',
-        'data': {
-            'labels': chart_labels,
-            'datasets': [{
-                'data': chart_values,
-                'backgroundColor': ['#0d6efd', '#198754', '#ffc107', '#dc3545', '#6610f2', '#fd7e14', '#20c997']
-            }]
-        }
-    }
-    chart_url = f"https://quickchart.io/chart?c={urllib.parse.quote(str(chart_config))}"
+@login_required
+def export_kpi_pdf_status(request, job_id):
+    if not JOB_ID_RE.match(job_id):
+        raise Http404
+    status = job_status(job_id)
+    return JsonResponse({
+        'status': status,
+        'download_url': reverse('export_kpi_pdf_download', args=[job_id]) if status == 'ready' else None,
+    })
 
-    months_ru = {1: 'Январь', 2: 'Февраль', 3: 'Март', 4: 'Апрель', 5: 'Май', 6: 'Июнь',
-                 7: 'Июль', 8: 'Август', 9: 'Сентябрь', 10: 'Октябрь', 11: 'Ноябрь', 12: 'Декабрь'}
 
-    context = {
-        'data': data,
-        'period': months_ru.get(selected_date.month),
-        'year': selected_date.year,
-        'total_company_bonus': total_company_bonus,  # Проверьте это имя в шаблоне!
-        'company_avg_perf': company_avg_perf,  # Проверьте это имя в шаблоне!
-        'summary_table': summary_table_data,
-        'chart_url': chart_url,
-        'today': datetime.now(),
-    }
+@login_required
+def export_kpi_pdf_download(request, job_id):
+    if not JOB_ID_RE.match(job_id) or job_status(job_id) != 'ready':
+        raise Http404
+    return _report_file_response(job_id)
 
-    html_string = render_to_string('kpi/pdf_report.html', context)
-    html = HTML(string=html_string, base_url=request.build_absolute_uri('/'))
-    pdf = html.write_pdf()
 
-    response = HttpResponse(pdf, content_type='application/pdf')
-    response['Content-Disposition'] = f'attachment; filename="KPI_Report_{month_str}.pdf"'
-    return response
+def _report_file_response(job_id):
+    month_str = JOB_ID_RE.match(job_id).group('month')
+    return FileResponse(
+        open(report_path(job_id), 'rb'),
+        as_attachment=True,
+        filename=f"KPI_Report_{month_str}.pdf",
+        content_type='application/pdf'
+    )
 
 
 class AdminKPIListView(LoginRequiredMixin, UserPassesTestMixin, ListView):
@@ -389,10 +323,23 @@ class AdminKPIListView(LoginRequiredMixin, UserPassesTestMixin, ListView):
     def test_func(self):
         return self.request.user.role == 'admin'
 
+    def get_lineage(self):
+        lineage = self.request.GET.get('lineage', '')
+        return int(lineage) if lineage.isdigit() else None
+
     def get_queryset(self):
+        lineage = self.get_lineage()
+        if lineage:
+            # История версий одного KPI — выборка по индексу цепочки
+            return KPI.objects.filter(lineage_id=lineage).order_by('-version')
         # Сортируем: сначала новые месяцы, потом активные, потом по версии
         return KPI.objects.all().order_by('-for_month', '-is_active', '-version', '-id')
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['lineage'] = self.get_lineage()
+        return context
+
 
 # Метод для кнопки "Архивировать/Новая версия" прямо из списка
 class ArchiveKPIRedirectView(LoginRequiredMixin, UserPassesTestMixin, View):
@@ -400,12 +347,18 @@ class ArchiveKPIRedirectView(LoginRequiredMixin, UserPassesTestMixin, View):
         return self.request.user.role == 'admin'
 
     def get(self, request, pk):
-        kpi = KPI.objects.get(pk=pk)
-        kpi.create_new_version()
+        kpi = get_object_or_404(KPI, pk=pk)
+        if not create_new_versions([kpi], user=request.user):
+            # Ссылка со старой страницы: KPI уже в архиве, повторно не версионируем
+            current = latest_version(kpi)
+            messages.warning(
+                request,
+                f"Версия v{kpi.version} уже в архиве" + (f", текущая — v{current.version}" if current else "")
+            )
         return redirect('admin_manage')
 
 
-class KPIUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
+class KPIUpdateView(LoginRequiredMixin, UserPassesTestMixin, OpenMonthRequiredMixin, UpdateView):
     model = KPI
     form_class = KPICreateForm  # Та же форма, что и для создания
     template_name = 'kpi/kpi_form.html'  # Тот же шаблон
@@ -421,7 +374,7 @@ class KPIUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
         return context
 
 
-class KPIDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
+class KPIDeleteView(LoginRequiredMixin, UserPassesTestMixin, OpenMonthRequiredMixin, DeleteView):
     model = KPI
     template_name = 'kpi/kpi_confirm_delete.html'
     success_url = reverse_lazy('admin_manage')
@@ -430,7 +383,7 @@ class KPIDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
         return self.request.user.role == 'admin'
 
 
-class IndicatorAddView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
+class IndicatorAddView(LoginRequiredMixin, UserPassesTestMixin, OpenMonthRequiredMixin, CreateView):
     model = Indicator
     form_class = IndicatorCreateForm
     template_name = 'kpi/indicator_add_form.html'
@@ -461,7 +414,7 @@ class KPIIndicatorListView(LoginRequiredMixin, ListView):
         return context
 
 
-class IndicatorUpdateFactView(LoginRequiredMixin, UpdateView):
+class IndicatorUpdateFactView(LoginRequiredMixin, OpenMonthRequiredMixin, UpdateView):
     model = Indicator
     form_class = IndicatorUpdateFactForm
     template_name = 'kpi/indicator_update_fact.html'
@@ -480,7 +433,7 @@ class IndicatorUpdateFactView(LoginRequiredMixin, UpdateView):
         return reverse_lazy('kpi_indicators_detail', kwargs={'kpi_id': self.object.kpi.id})
 
 
-class IndicatorDeleteView(LoginRequiredMixin, AdminRequiredMixin, DeleteView):
+class IndicatorDeleteView(LoginRequiredMixin, AdminRequiredMixin, OpenMonthRequiredMixin, DeleteView):
     model = Indicator
     template_name = 'kpi/kpi_confirm_delete.html'  # Можно переиспользовать или создать новый
 
@@ -501,41 +454,14 @@ class GenerateNextMonthKPIView(LoginRequiredMixin, AdminRequiredMixin, View):
             messages.warning(request, "Нет активных шаблонов для генерации.")
             return redirect('admin_manage')
 
-        created_count = 0
-        with transaction.atomic():  # Чтобы если один упал, не создались остальные
-            for temp in templates:
-                # Проверяем, не созданы ли уже KPI для этого сотрудника на этот месяц
-                exists = KPI.objects.filter(
-                    employee=temp.employee,
-                    for_month=next_month_date,
-                    parent_template=temp  # Чтобы отличать от других версий
-                ).exists()
-
-                if not exists:
-                    # Копируем KPI
-                    new_kpi = KPI.objects.get(pk=temp.pk)
-                    new_kpi.pk = None
-                    new_kpi.is_template = False
-                    new_kpi.for_month = next_month_date
-                    new_kpi.parent_template = temp
-                    new_kpi.save()
-
-                    # Копируем индикаторы шаблона в новый KPI
-                    for ind in temp.indicators.all():
-                        ind.pk = None
-                        ind.kpi = new_kpi
-                        ind.fact_quantitative = 0
-                        ind.fact_qualitative = 0
-                        ind.status = 'draft'
-                        ind.save()
-
-                    created_count += 1
+        # Уже созданные на этот месяц KPI пропускаются, остальные создаются пачкой
+        created_count = generate_kpis_from_templates([next_month_date], templates)
 
         messages.success(request, f"Успешно создано {created_count} KPI на {next_month_date.strftime('%B %Y')}")
         return redirect('admin_manage')
 
 
-class RejectIndicatorView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
+class RejectIndicatorView(LoginRequiredMixin, UserPassesTestMixin, OpenMonthRequiredMixin, UpdateView):
     model = Indicator
     form_class = IndicatorRejectForm
     template_name = 'kpi/indicator_reject_form.html'
@@ -552,27 +478,33 @@ class RejectIndicatorView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
         return reverse_lazy('hr_review_list')
 
 
+SPARKLINE_MONTHS = 24
+
+
 class EmployeeDetailView(LoginRequiredMixin, DetailView):
     model = User
     template_name = 'kpi/employee_detail.html'
     context_object_name = 'target_user'
+    # Шапка профиля показывает должность, отдел и руководителя
+    queryset = User.objects.select_related('position', 'department', 'superior')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        # Получаем все активные KPI этого сотрудника
-        context['employee_kpis'] = KPI.objects.filter(
+        # История по месяцам — один запрос по индексу (employee, month)
+        snapshots = list(EmployeeMonthSnapshot.objects.filter(employee=self.object).order_by('month'))
+        context['snapshots'] = snapshots[::-1]
+        context['total_avg'] = lifetime_average(snapshots)
+        context['sparkline_points'] = sparkline_points([s.score for s in snapshots[-SPARKLINE_MONTHS:]])
+
+        # Карточки KPI — за месяц, выбранный в истории (?month=ГГГГ-ММ), по умолчанию за последний.
+        # Месяц берется из снимков, KPI — тем же фильтром, по которому снимки считаются
+        months = {s.month.strftime('%Y-%m'): s.month for s in snapshots}
+        selected_month = months.get(self.request.GET.get('month')) or (snapshots[-1].month if snapshots else None)
+        context['selected_month'] = selected_month
+        context['employee_kpis'] = snapshot_kpis().filter(
             employee=self.object,
-            is_active=True,
-            is_template=False
-        ).order_by('-for_month')
-
-        # Можно добавить расчет общего среднего балла сотрудника для профиля
-        kpis = context['employee_kpis']
-        if kpis:
-            scores = [k.get_total_score() for k in kpis]
-            context['total_avg'] = sum(scores) / len(scores)
-        else:
-            context['total_avg'] = 0
+            for_month=selected_month
+        ) if selected_month else KPI.objects.none()
 
         return context
 
@@ -591,33 +523,15 @@ class CloseMonthView(LoginRequiredMixin, View):
         # Определяем дату
         selected_date = datetime.strptime(month_str, '%Y-%m').date()
 
-        # Находим все KPI за этот месяц, у которых еще не зафиксирован бонус
-        kpis = KPI.objects.filter(
-            for_month__month=selected_date.month,
-            for_month__year=selected_date.year,
-            is_active=True
-        ).select_related('bonus_setup')
-
-        updated_count = 0
-        for kpi in kpis:
-            bonus = getattr(kpi, 'bonus_setup', None)
-            if bonus and not bonus.is_calculated:
-                # Проводим финальный расчет
-                score = float(kpi.get_total_score())
-                t_min = float(bonus.threshold_min or 80)
-                t_max = float(bonus.threshold_max or 120)
-                t_target = float(bonus.target_amount or 0)
-
-                if score >= t_min:
-                    calc_percent = min(score, t_max)
-                    bonus.final_payout = (calc_percent / 100) * t_target
-                else:
-                    bonus.final_payout = 0
-
-                bonus.is_calculated = True
-                bonus.save()
-                updated_count += 1
-
-        messages.success(request, f"Месяц закрыт! Зафиксировано выплат: {updated_count}")
+        try:
+            result = close_month(selected_date, user=request.user)
+        except MonthAlreadyClosed as e:
+            messages.warning(request, str(e))
+            return redirect(f"{reverse('dashboard')}?month={month_str}")
+
+        # Сразу готовим финальный PDF: для закрытого месяца он больше не перерисовывается
+        submit_report(selected_date, request.build_absolute_uri('/'))
+
+        messages.success(request, f"Месяц закрыт! Зафиксировано выплат: {result['updated']}")
         return redirect(f"{reverse('dashboard')}?month={month_str}")
 
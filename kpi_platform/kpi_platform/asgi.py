@@ -5,6 +5,22 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
+
+Развертывание с потоком уведомлений (SSE, notifications.views.notification_stream):
+
+    python manage.py collectstatic --noinput
+    uvicorn kpi_platform.asgi:application --host 0.0.0.0 --port 8000 --workers 1
+
+Под ASGI открытое соединение вкладки — корутина, а не занятый поток, поэтому поток
+включается только здесь (KPI_ASGI=1 -> NOTIFICATIONS_STREAM_ENABLED). InProcessBroker
+доставляет события в пределах одного процесса: при нескольких воркерах нужен общий
+брокер (NOTIFICATIONS_BROKER). Прокси перед uvicorn не должен буферизовать ответ
+(в nginx: proxy_buffering off; view и так шлет X-Accel-Buffering: no) и должен держать
+соединение дольше SSE_KEEPALIVE_SECONDS (proxy_read_timeout).
+
+Под WSGI (kpi_platform.wsgi, gunicorn/uWSGI) поток выключен: счетчик в меню
+опрашивает notifications/unread/ раз в NOTIFICATIONS_POLL_SECONDS.
+Выключить поток и под ASGI — KPI_ASGI=0.
 """
 
 import os
@@ -12,5 +28,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "kpi_platform.settings")
+os.environ.setdefault("KPI_ASGI", "1")
 
 application = get_asgi_application()
@@ -47,11 +47,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Первым, чтобы в замер попала вся цепочка; при PROFILING_ENABLED=False отключается сам
+    "core.middleware.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "core.middleware.AuditUserMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -69,6 +72,7 @@ TEMPLATES = [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
+                "notifications.context_processors.notification_updates",
             ],
         },
     },
@@ -135,6 +139,50 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
 TEMPLATES[0]['DIRS'] = [BASE_DIR / 'templates']
 
+# Файлы, которые создает само приложение (отчеты и т.п.)
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Готовые PDF-отчеты по KPI, пул процессов для их рендера (0 — рендер в самом запросе)
+# и время (секунды), после которого незавершенный рендер считается брошенным
+KPI_REPORTS_DIR = MEDIA_ROOT / 'kpi_reports'
+KPI_REPORT_WORKERS = 2
+KPI_REPORT_TIMEOUT = 600
+# Брокер потока уведомлений (SSE). InProcessBroker — в пределах одного ASGI-процесса
+NOTIFICATIONS_BROKER = 'notifications.broker.InProcessBroker'
+# Поток держит открытое соединение на каждую вкладку, поэтому включается только под ASGI-сервером
+# (kpi_platform.asgi выставляет KPI_ASGI=1, см. там же запуск). Под WSGI страницы вместо потока
+# опрашивают счетчик непрочитанных раз в NOTIFICATIONS_POLL_SECONDS
+NOTIFICATIONS_STREAM_ENABLED = os.environ.get('KPI_ASGI') == '1'
+NOTIFICATIONS_POLL_SECONDS = 60
+# Записи аудита копятся до коммита; при таком размере пачка пишется досрочно
+AUDIT_BUFFER_SIZE = 200
+# Архив старых записей аудита (команда archive_audit_log)
+AUDIT_ARCHIVE_DIR = BASE_DIR / 'archive' / 'audit'
+AUDIT_RETENTION_MONTHS = 12
+# Базовые замеры нагрузочного стенда (команда run_benchmarks --save-baseline)
+BENCHMARK_BASELINES = BASE_DIR / 'benchmarks' / 'baselines.json'
+# Профилирование запросов (core.middleware.ProfilingMiddleware): заголовок Server-Timing,
+# лог медленных запросов и выборочный cProfile. Выключено — накладных расходов нет
+PROFILING_ENABLED = os.environ.get('KPI_PROFILING') == '1'
+PROFILING_SLOW_REQUEST_MS = 500
+PROFILING_SLOW_LOG = BASE_DIR / 'logs' / 'slow_requests.log'
+PROFILING_SLOW_LOG_MAX_BYTES = 10 * 1024 * 1024
+PROFILING_SLOW_LOG_BACKUPS = 5
+# Один и тот же SQL столько раз за запрос и больше — кандидат в N+1
+PROFILING_DUPLICATE_THRESHOLD = 5
+# Доля запросов под cProfile (0.01 = каждый сотый)
+PROFILING_SAMPLE_RATE = 0.0
+PROFILING_PROFILE_DIR = BASE_DIR / 'logs' / 'profiles'
+# Фоновая загрузка файлов ОПУ/ОСВ (analytics.ingestion): копии файлов до обработки,
+# пул потоков (0 — обрабатывать сразу в запросе), ожидание занятого периода и срок, после
+# которого блокировка и задача в работе считаются брошенными (секунды)
+INGESTION_SPOOL_DIR = BASE_DIR / 'spool' / 'uploads'
+INGESTION_WORKERS = 2
+INGESTION_LOCK_WAIT = 600
+INGESTION_LOCK_TTL = 3600
+# Пакетная загрузка архивом (analytics.bulk): процессов для разбора файлов (0 — в самом запросе)
+BULK_IMPORT_WORKERS = 4
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
@@ -36,4 +36,7 @@ urlpatterns = [
     path('users/', include('users.urls')),
 
     path('analytics/', include('analytics.urls')),
+
+    # Журнал аудита
+    path('audit/', include('core.urls')),
 ]
@@ -0,0 +1,114 @@
+"""
+Pub/sub для потока уведомлений (SSE, notifications.views.notification_stream).
+
+Брокер выбирается настройкой NOTIFICATIONS_BROKER (путь к классу). По умолчанию —
+InProcessBroker: подписчики живут в памяти процесса, поэтому он подходит для
+одного ASGI-воркера. Для нескольких воркеров достаточно реализовать BaseBroker
+поверх внешней шины (Redis pub/sub, PostgreSQL LISTEN/NOTIFY) и указать его в настройках.
+"""
+import asyncio
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class Subscription:
+    """Очередь событий одного подключения, читается асинхронно через get()."""
+
+    def __init__(self, broker, user_id, maxsize):
+        self.broker = broker
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def put(self, event):
+        # Медленный клиент не копит бесконечный хвост: старое событие вытесняется новым
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class BaseBroker:
+    """
+    Интерфейс брокера. publish() вызывается из синхронного кода (после коммита),
+    subscribe()/unsubscribe() — из асинхронного обработчика потока.
+    """
+
+    def subscribe(self, user_id):
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError
+
+    def publish(self, user_id, event):
+        raise NotImplementedError
+
+    def has_subscribers(self, user_ids):
+        """Можно ли пропустить подготовку событий. По умолчанию брокер не знает — считаем, что да."""
+        return True
+
+
+class InProcessBroker(BaseBroker):
+    # События на одно подключение сверх этого лимита вытесняют самые старые
+    queue_size = 32
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # user_id -> set(Subscription)
+
+    def subscribe(self, user_id):
+        subscription = Subscription(self, user_id, self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+    def publish(self, user_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for subscription in subscribers:
+            # Очередь принадлежит циклу событий подключения — кладем через него (потокобезопасно)
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                # Цикл уже закрыт (воркер завершается) — подписка больше не нужна
+                self.unsubscribe(subscription)
+        return len(subscribers)
+
+    def has_subscribers(self, user_ids):
+        with self._lock:
+            return any(user_id in self._subscribers for user_id in user_ids)
+
+    def subscriber_count(self, user_id=None):
+        with self._lock:
+            if user_id is not None:
+                return len(self._subscribers.get(user_id, ()))
+            return sum(len(s) for s in self._subscribers.values())
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                path = getattr(settings, 'NOTIFICATIONS_BROKER', 'notifications.broker.InProcessBroker')
+                _broker = import_string(path)()
+    return _broker
@@ -0,0 +1,9 @@
+from django.conf import settings
+
+
+def notification_updates(request):
+    """Как base.html обновляет счетчик уведомлений: потоком (SSE под ASGI) или опросом."""
+    return {
+        'notifications_stream': settings.NOTIFICATIONS_STREAM_ENABLED,
+        'notifications_poll_ms': settings.NOTIFICATIONS_POLL_SECONDS * 1000,
+    }
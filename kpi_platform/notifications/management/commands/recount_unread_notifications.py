@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from notifications.services import recount_unread
+
+
+class Command(BaseCommand):
+    help = (
+        "Пересчитывает счетчики непрочитанных уведомлений пользователей (User.unread_notifications) "
+        "по Notification(is_read=False). Запускается один раз после выкладки счетчика и при расхождениях"
+    )
+
+    def handle(self, *args, **options):
+        fixed = recount_unread()
+        self.stdout.write(self.style.SUCCESS(f"Исправлено счетчиков: {fixed}"))
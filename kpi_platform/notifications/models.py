@@ -9,4 +9,16 @@ class Notification(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
-        ordering = ['-created_at']
\ No newline at end of file
+        ordering = ['-created_at']
+        indexes = [
+            # Входящие с фильтром прочитанности и без него, по ключу (created_at, id)
+            models.Index(fields=['recipient', 'is_read', '-created_at', '-id'], name='notif_inbox_read_idx'),
+            models.Index(fields=['recipient', '-created_at', '-id'], name='notif_inbox_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Исходный is_read — по нему сигналы понимают, изменился ли счетчик получателя
+        instance._loaded_is_read = instance.is_read
+        return instance
\ No newline at end of file
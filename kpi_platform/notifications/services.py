@@ -0,0 +1,152 @@
+"""
+Создание и прочтение уведомлений с поддержкой счетчика User.unread_notifications.
+
+Одиночные save()/delete() обрабатываются сигналами (notifications.signals),
+массовые операции идут через функции ниже: счетчики меняются F()-обновлениями
+в той же транзакции, по одному UPDATE на группу получателей с одинаковой дельтой.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import Greatest
+
+from users.models import User
+from .broker import get_broker
+from .models import Notification
+
+
+def adjust_unread(deltas):
+    """
+    deltas — {recipient_id: изменение счетчика}.
+    Уменьшение ограничено нулем: отстающий счетчик (уведомления, созданные до его появления
+    или в обход сервисов) не нарушает PositiveIntegerField. Такие счетчики выравнивает
+    команда recount_unread_notifications (один раз после выкладки и при расхождениях).
+    """
+    by_delta = defaultdict(list)
+    for recipient_id, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(recipient_id)
+    for delta, recipient_ids in by_delta.items():
+        value = F('unread_notifications') + delta
+        if delta < 0:
+            value = Greatest(value, 0)
+        User.objects.filter(pk__in=recipient_ids).update(unread_notifications=value)
+
+
+def notify(notifications):
+    """Создает уведомления одним INSERT, увеличивает счетчики получателей и после коммита рассылает их в поток."""
+    with transaction.atomic():
+        created = Notification.objects.bulk_create(notifications)
+        adjust_unread(Counter(n.recipient_id for n in created if not n.is_read))
+        transaction.on_commit(lambda: publish_notifications(created))
+    return created
+
+
+def _sender_name(notification):
+    # Только если отправитель уже загружен: публикация не должна делать запрос на каждое уведомление
+    if not notification.sender_id or not Notification.sender.is_cached(notification):
+        return None
+    return notification.sender.get_full_name() or notification.sender.username
+
+
+def publish_notifications(notifications):
+    """Отправляет новые уведомления и актуальные счетчики подключенным получателям."""
+    broker = get_broker()
+    recipient_ids = {n.recipient_id for n in notifications}
+    if not recipient_ids or not broker.has_subscribers(recipient_ids):
+        return
+    unread = dict(User.objects.filter(pk__in=recipient_ids).values_list('pk', 'unread_notifications'))
+    for n in notifications:
+        broker.publish(n.recipient_id, {
+            'type': 'notification',
+            'id': n.pk,
+            'message': n.message,
+            'sender': _sender_name(n),
+            'created_at': n.created_at.isoformat() if n.created_at else None,
+            'unread': unread.get(n.recipient_id, 0),
+        })
+
+
+def publish_unread(recipient_id, unread):
+    broker = get_broker()
+    if broker.has_subscribers([recipient_id]):
+        broker.publish(recipient_id, {'type': 'unread', 'unread': unread})
+
+
+def mark_read(recipient, notifications=None):
+    """
+    Помечает прочитанными непрочитанные уведомления получателя
+    (все или из переданного queryset/списка id). Возвращает количество.
+    """
+    qs = Notification.objects.filter(recipient=recipient, is_read=False)
+    if notifications is not None:
+        qs = qs.filter(pk__in=notifications)
+    with transaction.atomic():
+        # Число реально обновленных строк: параллельный запрос не уменьшит счетчик дважды
+        updated = qs.update(is_read=True)
+        adjust_unread({recipient.pk: -updated})
+    if updated and hasattr(recipient, 'unread_notifications'):
+        recipient.unread_notifications = max(recipient.unread_notifications - updated, 0)
+        # Другие вкладки пользователя обновят счетчик без перезагрузки
+        publish_unread(recipient.pk, recipient.unread_notifications)
+    return updated
+
+
+INBOX_PAGE_SIZES = (5, 10, 20, 50)
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def encode_cursor(notification):
+    """Курсор страницы: микросекунды created_at от эпохи и id (однозначен и без float)."""
+    micros = (notification.created_at - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}-{notification.pk}"
+
+
+def decode_cursor(value):
+    """(created_at, id) или None для пустого/битого курсора."""
+    try:
+        micros, pk = value.split('-')
+        return EPOCH + timedelta(microseconds=int(micros)), int(pk)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def inbox_queryset(recipient, status_filter='all', before=None):
+    """Входящие (новые сверху) после курсора before, упорядоченные по ключу (created_at, id)."""
+    qs = Notification.objects.filter(recipient=recipient).select_related('sender')
+    if status_filter == 'unread':
+        qs = qs.filter(is_read=False)
+    elif status_filter == 'read':
+        qs = qs.filter(is_read=True)
+
+    cursor = decode_cursor(before) if before else None
+    if cursor:
+        created_at, pk = cursor
+        # created_at__lte — граница диапазона по индексу: страница не перечитывает более новые строки
+        qs = qs.filter(Q(created_at__lt=created_at) | Q(pk__lt=pk), created_at__lte=created_at)
+    return qs.order_by('-created_at', '-id')
+
+
+def inbox_page(recipient, status_filter='all', before=None, limit=INBOX_PAGE_SIZES[0]):
+    """
+    Страница входящих по ключу (created_at, id) — без OFFSET и COUNT.
+    status_filter: 'all', 'unread' или 'read'. Возвращает (уведомления, курсор следующей страницы или None).
+    """
+    page = list(inbox_queryset(recipient, status_filter, before)[:limit + 1])
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    return page[:limit], next_cursor
+
+
+def recount_unread(users=None):
+    """Пересчитывает счетчики с нуля (по всем пользователям или переданным). Возвращает число исправленных."""
+    users = User.objects.all() if users is None else users
+    actual = users.annotate(
+        actual=Count('notifications', filter=Q(notifications__is_read=False))
+    ).exclude(unread_notifications=F('actual')).values_list('pk', 'actual')
+    fixed = 0
+    for pk, count in actual:
+        User.objects.filter(pk=pk).update(unread_notifications=count)
+        fixed += 1
+    return fixed
@@ -0,0 +1,23 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Notification
+from django.db import transaction
+from .services import adjust_unread, publish_notifications
+
+
+@receiver(post_save, sender=Notification)
+def track_unread_on_save(sender, instance, created, **kwargs):
+    """Одиночное создание или смена is_read через save() меняет счетчик получателя"""
+    was_unread = False if created else not getattr(instance, '_loaded_is_read', instance.is_read)
+    is_unread = not instance.is_read
+    if was_unread != is_unread:
+        adjust_unread({instance.recipient_id: 1 if is_unread else -1})
+    instance._loaded_is_read = instance.is_read
+    if created:
+        transaction.on_commit(lambda: publish_notifications([instance]))
+
+
+@receiver(post_delete, sender=Notification)
+def track_unread_on_delete(sender, instance, **kwargs):
+    if not getattr(instance, '_loaded_is_read', instance.is_read):
+        adjust_unread({instance.recipient_id: -1})
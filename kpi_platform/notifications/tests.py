@@ -1,3 +1,308 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+from datetime import timedelta
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from core.testing import assert_uses_index, full_scans
+from users.models import User
+from . import broker as broker_module
+from .broker import InProcessBroker
+from .models import Notification
+from .services import (
+    decode_cursor, encode_cursor, inbox_page, inbox_queryset, mark_read, notify, recount_unread
+)
+
+
+class BrokerFanOutTests(SimpleTestCase):
+    """Стенд для пути рассылки: много подписчиков, публикация из другого потока."""
+
+    async def test_fan_out_reaches_every_subscriber_of_the_user(self):
+        broker = InProcessBroker()
+        users, per_user = 200, 10
+        subscriptions = [broker.subscribe(user_id) for user_id in range(users) for _ in range(per_user)]
+        self.assertEqual(broker.subscriber_count(), users * per_user)
+
+        # Публикация идет из синхронного кода (on_commit в потоке запроса), а не из цикла событий
+        def publish_all():
+            for user_id in range(users):
+                broker.publish(user_id, {'type': 'notification', 'user': user_id})
+
+        await asyncio.to_thread(publish_all)
+        events = await asyncio.gather(*(s.get(timeout=5) for s in subscriptions))
+
+        self.assertEqual([e['user'] for e in events], [s.user_id for s in subscriptions])
+        self.assertTrue(all(s.queue.empty() for s in subscriptions))
+
+    async def test_slow_subscriber_keeps_only_latest_events(self):
+        broker = InProcessBroker()
+        subscription = broker.subscribe(1)
+        for i in range(broker.queue_size + 10):
+            broker.publish(1, {'n': i})
+        await asyncio.sleep(0)
+
+        received = [(await subscription.get(timeout=1))['n'] for _ in range(broker.queue_size)]
+        self.assertEqual(received, list(range(10, broker.queue_size + 10)))
+
+    async def test_closed_subscription_is_forgotten(self):
+        broker = InProcessBroker()
+        subscription = broker.subscribe(1)
+        subscription.close()
+        self.assertEqual(broker.subscriber_count(), 0)
+        self.assertFalse(broker.has_subscribers([1]))
+        self.assertEqual(broker.publish(1, {'n': 1}), 0)
+
+
+class UnreadCounterTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='reader')
+        self.sender = User.objects.create(username='sender')
+
+    def unread(self):
+        return User.objects.values_list('unread_notifications', flat=True).get(pk=self.user.pk)
+
+    def test_notify_and_single_create_increment(self):
+        notify([Notification(recipient=self.user, message=f"m{i}") for i in range(3)]
+               + [Notification(recipient=self.user, message="old", is_read=True)])
+        self.assertEqual(self.unread(), 3)
+
+        Notification.objects.create(recipient=self.user, message="single")
+        self.assertEqual(self.unread(), 4)
+
+        # Смена is_read и удаление через save()/delete() тоже двигают счетчик
+        notification = Notification.objects.filter(recipient=self.user, is_read=False).first()
+        notification.is_read = True
+        notification.save()
+        self.assertEqual(self.unread(), 3)
+        Notification.objects.filter(recipient=self.user, is_read=False).first().delete()
+        self.assertEqual(self.unread(), 2)
+
+    def test_mark_read_selected_and_all(self):
+        created = notify([Notification(recipient=self.user, message=f"m{i}") for i in range(4)])
+        notify([Notification(recipient=self.sender, message="other")])
+        user = User.objects.get(pk=self.user.pk)
+
+        self.assertEqual(mark_read(user, [created[0].pk, created[1].pk]), 2)
+        self.assertEqual(user.unread_notifications, 2)
+        self.assertEqual(self.unread(), 2)
+        # Повторная пометка тех же уведомлений счетчик не уменьшает
+        self.assertEqual(mark_read(user, [created[0].pk]), 0)
+
+        self.assertEqual(mark_read(user), 2)
+        self.assertEqual((user.unread_notifications, self.unread()), (0, 0))
+        self.assertEqual(User.objects.get(pk=self.sender.pk).unread_notifications, 1)
+
+    def test_lagging_counter_is_clamped_at_zero(self):
+        # Уведомления, созданные до появления счетчика: в БД непрочитанные, счетчик — 0
+        created = Notification.objects.bulk_create([Notification(recipient=self.user, message=f"m{i}") for i in range(3)])
+        notification = Notification.objects.get(pk=created[0].pk)
+        notification.is_read = True
+        notification.save()
+        self.assertEqual(self.unread(), 0)
+
+        notify([Notification(recipient=self.user, message="new")])
+        self.assertEqual(mark_read(User.objects.get(pk=self.user.pk)), 3)
+        self.assertEqual(self.unread(), 0)
+        Notification.objects.create(recipient=self.user, message="unread")
+        Notification.objects.filter(recipient=self.user, is_read=False).get().delete()
+        self.assertEqual(self.unread(), 0)
+
+        # Команда выравнивает счетчики по непрочитанным уведомлениям
+        Notification.objects.bulk_create([Notification(recipient=self.user, message="bulk")])
+        call_command('recount_unread_notifications', stdout=io.StringIO())
+        self.assertEqual(self.unread(), Notification.objects.filter(recipient=self.user, is_read=False).count())
+        self.assertEqual(self.unread(), 1)
+
+    def test_full_user_save_keeps_counter(self):
+        stale = User.objects.get(pk=self.user.pk)
+        notify([Notification(recipient=self.user, message="m")])
+
+        stale.first_name = "Имя"
+        stale.save()
+        self.assertEqual(self.unread(), 1)
+        self.assertEqual(User.objects.get(pk=self.user.pk).first_name, "Имя")
+
+    def test_navigation_badge_outside_home_page(self):
+        notify([Notification(recipient=self.user, message=f"m{i}") for i in range(2)])
+        self.client.force_login(self.user)
+        # Счетчик в меню есть на любой странице; под WSGI base.html опрашивает его, а не открывает поток
+        with override_settings(NOTIFICATIONS_STREAM_ENABLED=False):
+            response = self.client.get(reverse('my_kpi_list'))
+        self.assertContains(response, '<span class="badge rounded-pill bg-warning text-dark" data-unread-count>2</span>',
+                            html=True)
+        self.assertNotContains(response, 'EventSource(')
+        self.assertContains(response, reverse('notification_unread'))
+
+        with override_settings(NOTIFICATIONS_STREAM_ENABLED=True):
+            response = self.client.get(reverse('my_kpi_list'))
+        self.assertContains(response, f'new EventSource("{reverse("notification_stream")}")')
+        self.assertNotContains(response, reverse('notification_unread'))
+
+    def test_unread_count_endpoint(self):
+        response = self.client.get(reverse('notification_unread'))
+        self.assertEqual(response.status_code, 302)
+
+        notify([Notification(recipient=self.user, message=f"m{i}") for i in range(2)])
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('notification_unread'))
+        self.assertEqual(response.json(), {'unread': 2})
+
+    def test_recount_fixes_drift(self):
+        notify([Notification(recipient=self.user, message=f"m{i}") for i in range(2)])
+        User.objects.filter(pk=self.user.pk).update(unread_notifications=7)
+        User.objects.filter(pk=self.sender.pk).update(unread_notifications=1)
+
+        self.assertEqual(recount_unread(), 2)
+        self.assertEqual(self.unread(), 2)
+        self.assertEqual(User.objects.get(pk=self.sender.pk).unread_notifications, 0)
+        out = io.StringIO()
+        call_command('recount_unread_notifications', stdout=out)
+        self.assertIn("Исправлено счетчиков: 0", out.getvalue())
+
+
+class InboxPagingTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='reader')
+        self.client.force_login(self.user)
+        notify([Notification(recipient=self.user, message=f"m{i}", is_read=i % 3 == 0) for i in range(13)])
+        notify([Notification(recipient=User.objects.create(username='other'), message="чужое")])
+        # Группы с одинаковым временем: порядок внутри решает id
+        moments = [timezone.now() - timedelta(minutes=i // 4) for i in range(13)]
+        for notification, moment in zip(Notification.objects.filter(recipient=self.user).order_by('id'), moments):
+            Notification.objects.filter(pk=notification.pk).update(created_at=moment)
+
+    def expected(self, **filters):
+        return list(Notification.objects.filter(recipient=self.user, **filters)
+                    .order_by('-created_at', '-id').values_list('pk', flat=True))
+
+    def walk(self, **params):
+        pages, before = [], None
+        while True:
+            response = self.client.get(reverse('notification_list'), {**params, **({'before': before} if before else {})})
+            pages.append([n.pk for n in response.context['notifications']])
+            before = response.context['next_cursor']
+            if before is None:
+                return pages
+
+    def test_pages_follow_created_at_and_id(self):
+        expected = self.expected()
+        for per_page in (1, 4, 5, 13, 50):
+            with self.subTest(per_page=per_page):
+                pages = self.walk(per_page=per_page)
+                self.assertEqual([pk for page in pages for pk in page], expected)
+                self.assertTrue(all(len(page) == per_page for page in pages[:-1]))
+        # Просмотр страниц пометил прочитанными все входящие пользователя, и только их
+        self.assertFalse(Notification.objects.filter(recipient=self.user, is_read=False).exists())
+        self.assertTrue(Notification.objects.filter(recipient__username='other', is_read=False).exists())
+
+    def test_unread_filter_pages_while_marking_read(self):
+        expected = self.expected(is_read=False)
+        pages = self.walk(filter='unread', per_page=3)
+        self.assertEqual([pk for page in pages for pk in page], expected)
+        self.assertEqual(User.objects.get(pk=self.user.pk).unread_notifications, 0)
+
+    def test_cursor_roundtrip_and_bad_cursors(self):
+        notification = Notification.objects.filter(recipient=self.user).first()
+        self.assertEqual(decode_cursor(encode_cursor(notification)), (notification.created_at, notification.pk))
+        first_page, _ = inbox_page(self.user)
+        for before in ('', 'abc', '1-2-3', '12-x', '9' * 400 + '-1'):
+            with self.subTest(before=before):
+                page, _ = inbox_page(self.user, before=before)
+                self.assertEqual(page, first_page)
+
+    def test_inbox_uses_index_without_sort(self):
+        cursor = encode_cursor(Notification.objects.filter(recipient=self.user).order_by('-created_at', '-id')[4])
+        for status_filter in ('all', 'unread', 'read'):
+            for before in (None, cursor):
+                with self.subTest(status_filter=status_filter, before=before):
+                    qs = inbox_queryset(self.user, status_filter, before)[:6]
+                    assert_uses_index(self, qs, tables=[Notification])
+                    _, plan = full_scans(qs)
+                    # Порядок берется из индекса, отдельной сортировки нет
+                    self.assertNotIn('TEMP B-TREE', plan)
+                    self.assertNotIn('Sort', plan)
+                    if before and connection.vendor == 'sqlite':
+                        # Курсор — граница диапазона индекса, а не фильтр поверх всех более новых строк
+                        self.assertIn('created_at<?', plan)
+
+
+class NotificationPublishTests(TestCase):
+
+    def setUp(self):
+        self.broker = InProcessBroker()
+        self._saved_broker, broker_module._broker = broker_module._broker, self.broker
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        broker_module._broker = self._saved_broker
+        self.loop.close()
+
+    def subscribe(self, user):
+        async def _subscribe():
+            return self.broker.subscribe(user.pk)
+        return self.loop.run_until_complete(_subscribe())
+
+    def receive(self, subscription):
+        return self.loop.run_until_complete(subscription.get(timeout=1))
+
+    def test_notify_publishes_after_commit_with_unread_count(self):
+        user = User.objects.create(username='stream-user')
+        subscription = self.subscribe(user)
+
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            notify([Notification(recipient=user, message='first'), Notification(recipient=user, message='second')])
+        # До коммита никто ничего не получил
+        self.assertTrue(subscription.queue.empty())
+
+        for callback in callbacks:
+            callback()
+        first, second = self.receive(subscription), self.receive(subscription)
+        self.assertEqual([first['message'], second['message']], ['first', 'second'])
+        self.assertEqual(second['unread'], 2)
+
+    def test_single_create_is_published(self):
+        user = User.objects.create(username='stream-single')
+        subscription = self.subscribe(user)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.create(recipient=user, message='hello')
+
+        event = self.receive(subscription)
+        self.assertEqual(event['type'], 'notification')
+        self.assertEqual(event['unread'], 1)
+
+
+@override_settings(NOTIFICATIONS_STREAM_ENABLED=True)
+class NotificationStreamViewTests(TestCase):
+
+    async def test_stream_requires_login(self):
+        response = await self.async_client.get('/notifications/stream/')
+        self.assertEqual(response.status_code, 403)
+
+    async def test_disabled_stream_tells_client_to_stop(self):
+        user = await User.objects.acreate(username='stream-off')
+        await self.async_client.aforce_login(user)
+        with override_settings(NOTIFICATIONS_STREAM_ENABLED=False):
+            response = await self.async_client.get('/notifications/stream/')
+        self.assertEqual(response.status_code, 204)
+
+    async def test_stream_starts_with_unread_count(self):
+        user = await User.objects.acreate(username='stream-view', unread_notifications=3)
+        await self.async_client.aforce_login(user)
+        response = await self.async_client.get('/notifications/stream/')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+
+        chunks = response.streaming_content
+        self.assertTrue((await anext(chunks)).startswith(b'retry:'))
+        unread = (await anext(chunks)).decode()
+        await chunks.aclose()
+
+        self.assertTrue(unread.startswith('event: unread'))
+        self.assertEqual(json.loads(unread.split('data: ', 1)[1])['unread'], 3)
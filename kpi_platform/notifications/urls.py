@@ -1,6 +1,8 @@
 from django.urls import path
-from .views import NotificationListView
+from .views import NotificationListView, notification_stream, unread_count
 
 urlpatterns = [
     path('', NotificationListView.as_view(), name='notification_list'),
+    path('stream/', notification_stream, name='notification_stream'),
+    path('unread/', unread_count, name='notification_unread'),
 ]
\ No newline at end of file
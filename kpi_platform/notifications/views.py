@@ -1,7 +1,15 @@
+import asyncio
+import json
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
+from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.generic import ListView
 from .models import Notification
+from .broker import get_broker
+from .services import INBOX_PAGE_SIZES, inbox_page, mark_read
 
 
 class NotificationListView(LoginRequiredMixin, ListView):
@@ -9,26 +17,89 @@ class NotificationListView(LoginRequiredMixin, ListView):
     template_name = 'notifications/list.html'
     context_object_name = 'notifications'
 
-    def get_paginate_by(self, queryset):
-        # Получаем количество из URL, по умолчанию 5
-        return self.request.GET.get('per_page', 5)
+    def get_per_page(self):
+        # Количество из URL, по умолчанию 5, не больше максимального из INBOX_PAGE_SIZES
+        try:
+            per_page = int(self.request.GET.get('per_page', INBOX_PAGE_SIZES[0]))
+        except ValueError:
+            return INBOX_PAGE_SIZES[0]
+        return min(max(per_page, 1), INBOX_PAGE_SIZES[-1])
 
-    def get_queryset(self):
-        qs = Notification.objects.filter(recipient=self.request.user)
+    def get_filter(self):
         current_filter = self.request.GET.get('filter', 'all')
-        if current_filter == 'unread':
-            qs = qs.filter(is_read=False)
-        elif current_filter == 'read':
-            qs = qs.filter(is_read=True)
+        return current_filter if current_filter in ('all', 'unread', 'read') else 'all'
 
-        # Помечаем прочитанными
-        qs_to_read = qs.filter(is_read=False)
-        if qs_to_read.exists():
-            qs_to_read.update(is_read=True)
-        return qs
+    def get_queryset(self):
+        page, self.next_cursor = inbox_page(
+            self.request.user,
+            self.get_filter(),
+            before=self.request.GET.get('before'),
+            limit=self.get_per_page(),
+        )
+        # Прочитанными помечаем только показанную страницу — одним UPDATE
+        unread_ids = [n.pk for n in page if not n.is_read]
+        if unread_ids:
+            mark_read(self.request.user, unread_ids)
+        return page
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['current_filter'] = self.request.GET.get('filter', 'all')
-        context['per_page'] = self.get_paginate_by(self.get_queryset())
-        return context
\ No newline at end of file
+        context['current_filter'] = self.get_filter()
+        context['per_page'] = self.get_per_page()
+        context['page_sizes'] = INBOX_PAGE_SIZES
+        context['next_cursor'] = self.next_cursor
+        context['is_first_page'] = not self.request.GET.get('before')
+        return context
+
+
+@login_required
+def unread_count(request):
+    """Счетчик непрочитанных для опроса из base.html, когда поток уведомлений выключен."""
+    response = JsonResponse({'unread': request.user.unread_notifications})
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+SSE_KEEPALIVE_SECONDS = 25
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def notification_stream(request):
+    """
+    Server-Sent Events: новые уведомления и счетчик непрочитанных.
+    Работает под ASGI-сервером (uvicorn/daphne + kpi_platform.asgi): на подключение
+    приходится одна корутина и маленькая очередь, а не поток, поэтому тысячи
+    простаивающих вкладок держатся дешево.
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return HttpResponseForbidden()
+    if not settings.NOTIFICATIONS_STREAM_ENABLED:
+        # Под WSGI соединение заняло бы поток воркера; на 204 EventSource не переподключается
+        return HttpResponse(status=204)
+
+    async def events():
+        # Подписка — внутри генератора: если ответ так и не начнут читать, она не повиснет
+        subscription = get_broker().subscribe(user.pk)
+        try:
+            yield "retry: 5000\n\n"
+            yield _sse('unread', {'type': 'unread', 'unread': user.unread_notifications})
+            while True:
+                try:
+                    event = await subscription.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # Комментарий держит соединение живым через прокси и выявляет отключившихся
+                    yield ": keepalive\n\n"
+                    continue
+                yield _sse(event['type'], event)
+        finally:
+            # При отключении клиента ASGI-обработчик отменяет задачу — ожидание get() прерывается
+            subscription.close()
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from core.utils import exclude_db_maintained
 
 
 class Department(models.Model):
@@ -33,12 +34,20 @@ class User(AbstractUser):
     position = models.ForeignKey(Position, on_delete=models.SET_NULL, null=True, blank=True)
     department = models.ForeignKey(Department, on_delete=models.SET_NULL, null=True, blank=True)
     superior = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='subordinates')
+    # Счетчик непрочитанных уведомлений, ведется notifications.services (F-обновлениями)
+    unread_notifications = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return f"{self.username} ({self.get_role_display()})"
 
+    def save(self, *args, **kwargs):
+        # Счетчик меняется F-обновлениями: загруженный раньше объект не должен затирать его
+        exclude_db_maintained(self, kwargs, ['unread_notifications'])
+        super().save(*args, **kwargs)
+
     @property
     def unread_notifications_count(self):
-        return self.notifications.filter(is_read=False).count()
+        # Без запроса: значение приходит вместе с request.user
+        return self.unread_notifications
 
 